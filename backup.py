@@ -0,0 +1,159 @@
+"""誕生日Botのオンラインバックアップ (SQLite バックアップ API) と復元確認
+
+Botを止めずに、稼働中のデータベースの一貫したスナップショットをバックアップ用ディレクトリに保存する。
+コピーは専用のスレッドで少しずつ (BACKUP_PAGES_PER_STEP ページずつ) 行い、イベントループや
+DBのライタースレッドを待たせない。スナップショットごとに SHA-256 のチェックサムファイルを作成し、
+古いものから削除して keep 個だけ残す。
+
+例: python backup.py --verify backups
+    保存済みのスナップショットをすべて開き、チェックサムと整合性 (PRAGMA integrity_check) を確認する。
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+from typing import List, Optional
+
+BACKUP_PAGES_PER_STEP = 256 # 1ステップでコピーするページ数 (ページサイズ 4KiB で 1MiB)
+BACKUP_STEP_SLEEP = 0.005 # ステップ間の待機秒数 (他のスレッドに処理を譲る)
+BACKUP_PREFIX = 'birthdays-' # スナップショットのファイル名の接頭辞
+BACKUP_SUFFIX = '.db'
+CHECKSUM_SUFFIX = '.sha256' # チェックサムファイルの拡張子 (sha256sum -c で確認できる形式)
+CHECKSUM_CHUNK_SIZE = 1024 * 1024 # チェックサム計算時に一度に読むバイト数
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def verify_snapshot(path: str) -> tuple[bool, str]:
+    """スナップショットのチェックサムと整合性を確認し、(正常か, 内容の説明) を返す"""
+    try:
+        with open(path + CHECKSUM_SUFFIX, encoding='utf-8') as f:
+            expected = f.read().split()[0]
+    except (OSError, IndexError) as e:
+        return False, f"チェックサムファイルを読めません: {e}"
+    actual = file_sha256(path)
+    if actual != expected:
+        return False, f"チェックサムが一致しません (期待値 {expected[:12]}…, 実際 {actual[:12]}…)"
+    try:
+        # 読み取り専用で開き、確認でファイルを書き換えない
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            problems = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+            if problems != ['ok']:
+                return False, f"整合性チェックで問題が見つかりました: {'; '.join(problems[:5])}"
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            birthdays = conn.execute("SELECT count(*) FROM birthdays").fetchone()[0]
+            guilds = conn.execute("SELECT count(*) FROM server_settings").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return False, f"データベースとして開けません: {e}"
+    return True, f"スキーマ v{version}, 誕生日 {birthdays} 件, サーバー設定 {guilds} 件"
+
+class BackupManager:
+    """稼働中のデータベースのスナップショットを作成・ローテーション・確認するクラス
+
+    コピー元の接続で読み取りトランザクションを開いたままコピーするため、途中で他の接続が書き込んでも
+    コピーが最初からやり直しにならず、開始時点の内容がそのまま保存される (WAL では書き込みも止めない)。
+    """
+
+    def __init__(self, source: str, directory: str, keep: int, pages_per_step: int = BACKUP_PAGES_PER_STEP, step_sleep: float = BACKUP_STEP_SLEEP):
+        self.source = source
+        self.directory = directory
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.running = False
+
+    def snapshots(self) -> List[str]:
+        """保存済みのスナップショットのパスを古い順に返す"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(names) if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)]
+
+    async def create(self) -> tuple[str, str]:
+        """スナップショットを作成して古いものを削除し、(保存したファイルのパス, チェックサム) を返す"""
+        if self.running:
+            raise RuntimeError("バックアップを実行中です。")
+        self.running = True
+        try:
+            return await asyncio.to_thread(self._create)
+        finally:
+            self.running = False
+
+    def _create(self) -> tuple[str, str]:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{BACKUP_PREFIX}{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}{BACKUP_SUFFIX}")
+        temporary = path + '.tmp'
+        source = sqlite3.connect(self.source, isolation_level=None)
+        try:
+            target = sqlite3.connect(temporary)
+            try:
+                # 読み取りトランザクションを開き、コピー中はこの時点の内容を読み続ける
+                source.execute("BEGIN")
+                source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+                source.backup(target, pages=self.pages_per_step, progress=self._pause)
+                source.execute("COMMIT")
+                # コピー元の WAL 設定も複製されるため、単体のファイルで完結するよう戻す
+                target.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                target.close()
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        finally:
+            source.close()
+        checksum = file_sha256(temporary)
+        os.replace(temporary, path)
+        with open(path + CHECKSUM_SUFFIX, 'w', encoding='utf-8') as f:
+            f.write(f"{checksum}  {os.path.basename(path)}\n")
+        self.rotate()
+        return path, checksum
+
+    def _pause(self, status: int, remaining: int, total: int):
+        # ステップの合間に少し待ち、ディスクの帯域と GIL を他のスレッド (イベントループ・DBワーカー) に譲る
+        if remaining and self.step_sleep:
+            time.sleep(self.step_sleep)
+
+    def rotate(self) -> List[str]:
+        """新しいものから keep 個を残して古いスナップショットを削除し、削除したパスを返す"""
+        snapshots = self.snapshots()
+        removed = snapshots[:max(0, len(snapshots) - self.keep)]
+        for path in removed:
+            for file in (path, path + CHECKSUM_SUFFIX):
+                if os.path.exists(file):
+                    os.remove(file)
+        return removed
+
+    async def verify_all(self) -> List[tuple[str, bool, str]]:
+        """保存済みのスナップショットをすべて確認し、(パス, 正常か, 内容の説明) の一覧を返す"""
+        return await asyncio.to_thread(lambda: [(path, *verify_snapshot(path)) for path in self.snapshots()])
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='誕生日Botのバックアップを確認します')
+    parser.add_argument('--verify', metavar='DIR', required=True, help='スナップショットを保存したディレクトリ')
+    args = parser.parse_args(argv)
+    snapshots = BackupManager('', args.verify, keep=0).snapshots()
+    if not snapshots:
+        print(f"{args.verify} にスナップショットがありません。")
+        return 1
+    failed = 0
+    for path in snapshots:
+        ok, detail = verify_snapshot(path)
+        failed += not ok
+        print(f"{'OK ' if ok else 'NG '} {os.path.basename(path)}: {detail}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,720 @@
+"""誕生日Botのオフラインベンチマーク
+
+Discord に接続せずに、N サーバー × M 人の誕生日を一時データベースに生成し、
+通知ティック (run_announce_tick) と各スラッシュコマンドのコールバックをスタブの
+Interaction / Guild / TextChannel に対して実行する。結果は JSON で出力するので、
+コミット間で比較して性能の劣化を確認できる。
+
+例: python bench.py --scales 10,1000,50000 --birthdays-per-guild 20 --output bench.json
+
+規模ごとに子プロセスで実行し、ピークメモリ (最大 RSS) を規模ごとに独立して計測する。
+通知送信のレート制限は外し、Bot 側の処理 (DB・組み立て・配信) の速さだけを計る。
+また、遅いクエリの実行中も他のコマンドが待たされないことを確認し、待たされた場合は終了コード 1 で終わる。
+
+例: python bench.py --failover
+    同じデータベースを共有するレプリカを複数プロセスで起動し、通知の途中でリーダーを SIGKILL して、
+    引き継ぎにかかった時間と、通知の重複・取りこぼしがないことを確認する。
+
+例: python bench.py --member-memory
+    1サーバーの全メンバーを保持した場合と、メンション対象だけを保持した場合のメモリ使用量を比べる。
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Optional
+
+DEFAULT_SCALES = '10,1000,50000'
+DEFAULT_BIRTHDAYS_PER_GUILD = 20
+DEFAULT_TICKS = 5
+DEFAULT_COMMAND_ITERATIONS = 200
+DEFAULT_WRITE_BURST = 500 # 同時に送る register_birthday の数
+MENTION_RATIO = 0.5 # メンション対象を設定する誕生日の割合
+SLOW_READ_SECONDS = 1.0 # 遅いクエリの分離の確認で、リーダープールの1本を占有する読み取りの秒数
+SLOW_READ_COMMAND_BOUND = 0.25 # 遅いクエリの実行中に、他のコマンド1回にかかってよい最大秒数
+DEFAULT_FAILOVER_REPLICAS = 3 # フェイルオーバー試験で起動するレプリカ数
+DEFAULT_FAILOVER_KILLS = 2 # フェイルオーバー試験でリーダーを強制終了する回数 (レプリカ数より少なく)
+FAILOVER_GUILDS = 100 # フェイルオーバー試験のサーバー数
+FAILOVER_DAYS = 15 # フェイルオーバー試験で通知する日数 (1日 = 全サーバー分の1ティック)
+FAILOVER_LEASE_TTL = 2.0 # フェイルオーバー試験でのリーダー権の有効期間 (秒)
+FAILOVER_SEND_LATENCY = 0.02 # フェイルオーバー試験での channel.send の疑似遅延 (秒)
+# フェイルオーバー試験で Discord が同じ nonce の投稿を弾く期間 (秒)。本番 (120秒 / リーダー権15秒) と同じく引き継ぎより十分長くする
+FAILOVER_NONCE_WINDOW = 10.0
+FAILOVER_TIMEOUT = 120.0 # フェイルオーバー試験全体の制限時間 (秒)
+FAILOVER_FIRST_FIRE = datetime.datetime(2027, 1, 1, tzinfo=datetime.timezone.utc) # 1日目の通知時刻
+
+MEMBER_MEMORY_MEMBERS = 100000 # メンバーキャッシュのメモリ計測で、1サーバーに保持するメンバー数
+MEMBER_MEMORY_REGISTERED = 500 # メンバーキャッシュのメモリ計測で、メンション対象として解決する人数
+
+# --- スタブ ---
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.discriminator = '0'
+        self.mention = f"<@{user_id}>"
+
+class FakeChannel:
+    def __init__(self, channel_id: int, send_latency: float):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.mention = f"<#{channel_id}>"
+        self.sent = 0
+        self._send_latency = send_latency
+
+    async def send(self, content=None, **kwargs):
+        if self._send_latency:
+            await asyncio.sleep(self._send_latency)
+        self.sent += 1
+
+class SinkChannel(FakeChannel):
+    """送信内容を全レプリカ共通のファイルに1行ずつ追記するチャンネル (フェイルオーバー試験用)"""
+
+    def __init__(self, channel_id: int, send_latency: float, sink_fd: int, replica: str):
+        super().__init__(channel_id, send_latency)
+        self._sink_fd = sink_fd
+        self._replica = replica
+
+    async def send(self, content=None, nonce=None, **kwargs):
+        await super().send(content, **kwargs)
+        # O_APPEND の1回の write は行単位で混ざらない
+        os.write(self._sink_fd, (json.dumps([time.time(), self._replica, nonce]) + '\n').encode())
+
+class FakeGuild:
+    filesize_limit = 25 * 1024 * 1024
+
+    def __init__(self, guild_id: int, channel: FakeChannel):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.channel = channel
+
+    def get_channel(self, channel_id: int):
+        return self.channel if channel_id == self.channel.id else None
+
+    def get_member(self, user_id: int):
+        return None
+
+    async def query_members(self, user_ids=None, limit=5, cache=True, **kwargs):
+        return [FakeUser(user_id, f"member-{user_id}") for user_id in user_ids]
+
+class FakeResponse:
+    def __init__(self):
+        self.calls = 0
+
+    async def send_message(self, *args, **kwargs):
+        self.calls += 1
+
+    async def defer(self, *args, **kwargs):
+        self.calls += 1
+
+    async def edit_message(self, *args, **kwargs):
+        self.calls += 1
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        pass
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, user: FakeUser):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+        self.extras = {}
+
+    async def original_response(self):
+        return None
+
+class FakeAttachment:
+    def __init__(self, filename: str, data: bytes):
+        self.filename = filename
+        self.size = len(data)
+        self._data = data
+
+    async def read(self) -> bytes:
+        return self._data
+
+class ErrorCounter(logging.Handler):
+    """計測中に出た ERROR 以上のログを数える (コマンドが DB エラーなどで早期に返っていないかの確認用)"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+# --- データ生成 ---
+
+def guild_id_for(index: int) -> int:
+    return (1_000_000 + index) << 22
+
+def populate(path: str, guilds: int, per_guild: int, seed: int) -> int:
+    """N サーバー × M 人の誕生日とサーバー設定を一括で書き込み、行数を返す"""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    days = [datetime.date(2000, 1, 1) + datetime.timedelta(days=offset) for offset in range(366)]
+    rows = 0
+    with conn:
+        for index in range(guilds):
+            guild_id = guild_id_for(index)
+            conn.execute("INSERT INTO server_settings (guild_id, announce_channel_id) VALUES (?, ?)", (guild_id, guild_id + 1))
+            batch = []
+            for member in range(per_guild):
+                day = rng.choice(days)
+                mention = 10**17 + index * per_guild + member if rng.random() < MENTION_RATIO else None
+                batch.append((guild_id, f"user{member}", day.strftime('%m/%d'), day.month * 100 + day.day, mention, 1))
+            conn.executemany("INSERT INTO birthdays (guild_id, display_name, birthday, birthday_md, mention_user_id, registered_by_user_id) VALUES (?, ?, ?, ?, ?, ?)", batch)
+            rows += len(batch)
+    conn.execute("ANALYZE")
+    conn.close()
+    return rows
+
+def populate_failover(path: str, guilds: int, days: int):
+    """サーバーごとに、試験する各日に1人ずつ誕生日を登録する"""
+    conn = sqlite3.connect(path)
+    with conn:
+        for index in range(guilds):
+            guild_id = guild_id_for(index)
+            conn.execute("INSERT INTO server_settings (guild_id, announce_channel_id) VALUES (?, ?)", (guild_id, guild_id + 1))
+            batch = []
+            for offset in range(days):
+                day = (FAILOVER_FIRST_FIRE + datetime.timedelta(days=offset)).date()
+                batch.append((guild_id, f"user{offset}", day.strftime('%m/%d'), day.month * 100 + day.day, None, 1))
+            conn.executemany("INSERT INTO birthdays (guild_id, display_name, birthday, birthday_md, mention_user_id, registered_by_user_id) VALUES (?, ?, ?, ?, ?, ?)", batch)
+    conn.close()
+
+def summarize(samples: list, percentile) -> dict:
+    ordered = sorted(samples)
+    return {
+        'n': len(ordered),
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+# --- 1規模分の計測 (子プロセス) ---
+
+async def run_scale(main, guilds: int, per_guild: int, ticks: int, iterations: int, burst: int, send_latency: float, seed: int) -> dict:
+    result = {'guilds': guilds, 'birthdays_per_guild': per_guild}
+    rss_after_import = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started_at = time.perf_counter()
+    await main.db.write(main.setup_database)
+    await main.leader_lease.renew()
+    result['rows'] = await asyncio.get_running_loop().run_in_executor(None, populate, main.DB_NAME, guilds, per_guild, seed)
+    result['populate_seconds'] = round(time.perf_counter() - started_at, 3)
+
+    fake_guilds = {}
+    for index in range(guilds):
+        guild_id = guild_id_for(index)
+        fake_guilds[guild_id] = FakeGuild(guild_id, FakeChannel(guild_id + 1, send_latency))
+    main.bot.get_guild = fake_guilds.get
+
+    started_at = time.perf_counter()
+    await main.load_birthday_calendar()
+    result['load_calendar_seconds'] = round(time.perf_counter() - started_at, 3)
+    started_at = time.perf_counter()
+    await main.load_announce_schedule()
+    result['load_schedule_seconds'] = round(time.perf_counter() - started_at, 3)
+
+    # 通知ティック: 全サーバーを同じ通知時刻にし、日付を1日ずつ進めて (台帳で重複扱いにならないように) 実行する
+    tick_samples = []
+    sent_before = 0
+    first_fire = datetime.datetime(2027, 1, 1, tzinfo=datetime.timezone.utc)
+    for tick in range(ticks):
+        fire_at = first_fire + datetime.timedelta(days=tick)
+        due = [(guild_id, fire_at) for guild_id in fake_guilds]
+        started_at = time.perf_counter()
+        await main.run_announce_tick(due, fire_at)
+        tick_samples.append(time.perf_counter() - started_at)
+    sent = sum(guild.channel.sent for guild in fake_guilds.values()) - sent_before
+    result['tick'] = summarize(tick_samples, main.percentile)
+    result['tick']['ticks_per_second'] = round(len(tick_samples) / sum(tick_samples), 3)
+    result['tick']['announcements_per_tick'] = round(sent / ticks, 1)
+
+    # コマンド: ランダムなサーバー・名前に対して各コールバックを繰り返し実行する
+    rng = random.Random(seed)
+    guild_list = list(fake_guilds.values())
+    user = FakeUser(42, 'bench')
+    mention_target = FakeUser(43, 'target')
+    csv_data = ('name,birthday,mention_user_id\n' + ''.join(f"import{n},{(n % 12) + 1:02}/{(n % 28) + 1:02},\n" for n in range(100))).encode('utf-8')
+
+    def random_name() -> str:
+        return f"user{rng.randrange(per_guild)}"
+
+    scenarios = {
+        'register_birthday': lambda i, n: main.register_birthday.callback(i, name=f"bench{n}", birthday='04/01'),
+        'delete_birthday': lambda i, n: main.delete_birthday.callback(i, name=f"bench{n}"),
+        'list_birthdays': lambda i, n: main.list_birthdays.callback(i),
+        'upcoming': lambda i, n: main.upcoming.callback(i, days=30),
+        'check_mention': lambda i, n: main.check_mention.callback(i, name=random_name()),
+        'set_mention': lambda i, n: main.set_mention.callback(i, name=random_name(), mention_target=mention_target),
+        'check_settings': lambda i, n: main.check_settings.callback(i),
+        'name_autocomplete': lambda i, n: main.birthday_name_autocomplete(i, 'user1'),
+        'export_birthdays': lambda i, n: main.export_birthdays.callback(i, file_format='csv'),
+        'import_birthdays': lambda i, n: main.import_birthdays.callback(i, file=FakeAttachment('bench.csv', csv_data)),
+    }
+    commands = {}
+    for name, scenario in scenarios.items():
+        samples = []
+        for n in range(iterations):
+            interaction = FakeInteraction(rng.choice(guild_list), user)
+            started_at = time.perf_counter()
+            await scenario(interaction, n)
+            samples.append(time.perf_counter() - started_at)
+        commands[name] = summarize(samples, main.percentile)
+    result['commands'] = commands
+
+    # 書き込みの集中: 1つのサーバーで register_birthday が同時に届いた場合を、1件ずつコミットする場合
+    # (DB_WRITE_BATCH_MAX = 1) とまとめてコミットする場合で比べる
+    write_burst = {}
+    batch_max = main.DB_WRITE_BATCH_MAX
+    for number, (mode, mode_batch_max) in enumerate((('per_command', 1), ('batched', batch_max))):
+        main.DB_WRITE_BATCH_MAX = mode_batch_max
+        burst_guild = guild_list[number % len(guild_list)]
+        samples = []
+
+        async def timed_register(n: int):
+            started_at = time.perf_counter()
+            await main.register_birthday.callback(FakeInteraction(burst_guild, user), name=f"burst-{mode}-{n}", birthday='05/05')
+            samples.append(time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(timed_register(n) for n in range(burst)))
+        elapsed = time.perf_counter() - started_at
+        write_burst[mode] = summarize(samples, main.percentile)
+        write_burst[mode]['writes_per_second'] = round(burst / elapsed, 1)
+    main.DB_WRITE_BATCH_MAX = batch_max
+    result['write_burst'] = write_burst
+
+    # 遅いクエリの分離: リーダープールの1本で SLOW_READ_SECONDS 秒かかる読み取りを実行している間も、
+    # 他のコマンドが待たされずに SLOW_READ_COMMAND_BOUND 秒以内に終わることを確認する
+    def slow_read(conn: sqlite3.Connection, seconds: float):
+        conn.create_function('bench_sleep', 1, time.sleep)
+        conn.execute("SELECT bench_sleep(?)", (seconds,)).fetchone()
+
+    isolated = ('check_settings', 'upcoming', 'list_birthdays', 'name_autocomplete', 'register_birthday')
+    samples = []
+    started_at = time.perf_counter()
+    slow = asyncio.ensure_future(main.db.read(slow_read, SLOW_READ_SECONDS))
+    await asyncio.sleep(0.05) # 遅いクエリがワーカースレッドで始まるのを待つ
+    n = 0
+    while not slow.done():
+        interaction = FakeInteraction(rng.choice(guild_list), user)
+        command_started_at = time.perf_counter()
+        await scenarios[isolated[n % len(isolated)]](interaction, iterations + n)
+        samples.append(time.perf_counter() - command_started_at)
+        n += 1
+    await slow
+    slow_query = summarize(samples, main.percentile)
+    slow_query['slow_read_seconds'] = round(time.perf_counter() - started_at, 3)
+    slow_query['max_ms'] = round(max(samples) * 1000, 3)
+    slow_query['ok'] = slow_query['slow_read_seconds'] >= SLOW_READ_SECONDS and max(samples) <= SLOW_READ_COMMAND_BOUND
+    result['slow_query'] = slow_query
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # Linux では KiB
+    result['peak_rss_mib'] = round(peak / 1024, 1)
+    result['rss_after_import_mib'] = round(rss_after_import / 1024, 1)
+    result['db_size_mib'] = round(sum(os.path.getsize(path) for path in (main.DB_NAME, main.DB_NAME + '-wal') if os.path.exists(path)) / 1024 / 1024, 1)
+    return result
+
+def run_worker(args):
+    """子プロセス側: 一時ディレクトリにデータベースを作り、1規模分を計測して JSON を標準出力に書く"""
+    os.environ.setdefault('DISCORD_TOKEN', 'bench') # main.py はトークンがないと終了するため (接続はしない)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        import main
+        logging.disable(logging.WARNING) # ログ出力のコストと量を計測から除く
+        errors = ErrorCounter()
+        logging.getLogger().addHandler(errors)
+        main.DB_NAME = os.path.join(directory, 'bench.db')
+        # レート制限を外した配信クラスに差し替える (Bot 側の処理だけを計る)
+        main.ANNOUNCE_GLOBAL_RATE = (10**9, 1.0)
+        main.ANNOUNCE_CHANNEL_RATE = (10**9, 1.0)
+        main.announcement_dispatcher = main.AnnouncementDispatcher()
+        main.leader_lease.ttl = float('inf') # リーダー権の更新タスクは動かさないため、期限切れにしない
+        try:
+            result = asyncio.run(run_scale(main, args.guilds, args.birthdays_per_guild, args.ticks, args.iterations, args.burst, args.send_latency_ms / 1000, args.seed))
+        finally:
+            main.db.close()
+        result['log_errors'] = errors.count
+    json.dump(result, sys.stdout)
+
+# --- フェイルオーバー試験 ---
+
+def run_failover_replica(args):
+    """子プロセス側: 1つのレプリカとして、リーダーの間だけ全日分の通知ティックを順に実行し続ける
+
+    リーダー権の取得・更新・交代は main.py の leader_heartbeat / become_leader / step_down をそのまま使う。
+    日付の進行だけは実時間のスケジューラの代わりにこのループが行い、どのリーダーも1日目から実行し直す
+    (送信済みの分は通知台帳で除かれるため、引き継いだリーダーは残りの分だけを送る)。
+    """
+    directory = args.failover_replica
+    replica = f"replica-{args.replica_index}"
+    os.environ.setdefault('DISCORD_TOKEN', 'bench')
+    os.environ['REPLICA_ID'] = replica
+    os.environ['LEASE_TTL_SECONDS'] = str(args.lease_ttl)
+    os.environ['BACKUP_INTERVAL_HOURS'] = '0'
+    os.environ['ANNOUNCE_NONCE_WINDOW_SECONDS'] = str(args.nonce_window)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(directory)
+    import main
+    main.DB_NAME = os.path.join(directory, 'failover.db')
+    main.ANNOUNCE_GLOBAL_RATE = (10**9, 1.0)
+    main.ANNOUNCE_CHANNEL_RATE = (10**9, 1.0)
+    main.announcement_dispatcher = main.AnnouncementDispatcher()
+    # 実時間のスケジューラは使わない (取り戻しをなくし、次の通知時刻まで待機させたままにする)
+    main.ANNOUNCE_CATCHUP_WINDOW = datetime.timedelta(0)
+
+    async def ready():
+        pass
+
+    main.bot.wait_until_ready = ready
+    sink_fd = os.open(os.path.join(directory, 'sink.log'), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    fake_guilds = {}
+    for index in range(args.failover_guilds):
+        guild_id = guild_id_for(index)
+        fake_guilds[guild_id] = FakeGuild(guild_id, SinkChannel(guild_id + 1, args.failover_send_latency_ms / 1000, sink_fd, replica))
+    main.bot.get_guild = fake_guilds.get
+    fire_times = [FAILOVER_FIRST_FIRE + datetime.timedelta(days=offset) for offset in range(args.failover_days)]
+
+    async def run():
+        await main.db.write(main.setup_database)
+        if await main.leader_lease.renew():
+            await main.become_leader()
+        main.leader_heartbeat.start()
+        finished_token = None
+        while True:
+            if main.leading and main.leader_lease.token != finished_token:
+                token = main.leader_lease.token
+                await main.load_announce_schedule()
+                for fire_at in fire_times:
+                    if not main.leading:
+                        break
+                    await main.run_announce_tick([(guild_id, fire_at) for guild_id in fake_guilds], fire_at)
+                else:
+                    finished_token = token
+            await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+
+async def check_lease_reacquire(main, ttl: float) -> dict:
+    """同じレプリカが期限切れ・手放した後にリーダー権を取り直したとき、新しいトークンが振られ、
+    前の期間に取得したまま残った通知 (claimed / sending) を取り直せることを確認する"""
+    await main.db.write(main.setup_database)
+    lease = main.LeaderLease(main.db, 'reacquire', 'replica-reacquire', ttl)
+    keys = [(guild_id_for(0), '2027-01-01'), (guild_id_for(1), '2027-01-01')]
+    tokens = []
+    reclaimed = []
+    # 1回目は手元の期限切れ (ライターの詰まりなど、DB上の期限は残っている)、2回目は手放した後に取り直す
+    for expire in (lambda: setattr(lease, '_valid_until', 0.0), lease.release):
+        await lease.renew()
+        tokens.append(lease.token)
+        await main.db.write(main.claim_announcements, keys, lease.token)
+        await main.db.write(main.start_announcement, *keys[1], lease.token)
+        result = expire()
+        if asyncio.iscoroutine(result):
+            await result
+        await lease.renew()
+        tokens.append(lease.token)
+        reclaimed.append(len(await main.db.write(main.claim_announcements, keys, lease.token)))
+    return {
+        'tokens': tokens,
+        'reclaimed': reclaimed,
+        'ok': all(tokens[i + 1] > tokens[i] for i in range(0, len(tokens), 2)) and reclaimed == [len(keys)] * 2,
+    }
+
+def run_failover(args) -> dict:
+    """親プロセス側: レプリカを起動し、送信の途中でリーダーを強制終了して結果を集計する"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('DISCORD_TOKEN', 'bench')
+    import main
+    logging.disable(logging.INFO)
+    expected = {}
+    for index in range(args.failover_guilds):
+        guild = FakeGuild(guild_id_for(index), FakeChannel(0, 0))
+        for offset in range(args.failover_days):
+            announcement = main.Announcement(guild, None, '', None, (FAILOVER_FIRST_FIRE + datetime.timedelta(days=offset)).date())
+            expected[announcement.nonce] = (guild.id, offset)
+
+    with tempfile.TemporaryDirectory() as directory:
+        main.DB_NAME = os.path.join(directory, 'reacquire.db')
+        try:
+            reacquire = asyncio.run(check_lease_reacquire(main, args.lease_ttl))
+        finally:
+            main.db.close()
+        path = os.path.join(directory, 'failover.db')
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        main.setup_database(conn)
+        conn.commit()
+        conn.close()
+        populate_failover(path, args.failover_guilds, args.failover_days)
+        sink_path = os.path.join(directory, 'sink.log')
+        open(sink_path, 'w').close()
+
+        replicas: dict[str, subprocess.Popen] = {}
+        logs = []
+        for index in range(args.failover_replicas):
+            log = open(os.path.join(directory, f"replica-{index}.log"), 'w')
+            logs.append(log)
+            command = [sys.executable, os.path.abspath(__file__), '--failover-replica', directory, '--replica-index', str(index),
+                       '--lease-ttl', str(args.lease_ttl), '--failover-guilds', str(args.failover_guilds), '--failover-days', str(args.failover_days),
+                       '--failover-send-latency-ms', str(args.failover_send_latency_ms), '--nonce-window', str(args.nonce_window)]
+            replicas[f"replica-{index}"] = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+        def read_sink() -> list:
+            with open(sink_path, encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.endswith('\n')]
+
+        def current_leader() -> Optional[str]:
+            conn = sqlite3.connect(path, timeout=5)
+            try:
+                row = conn.execute("SELECT holder FROM leases WHERE expires_at > ?", (time.time(),)).fetchone()
+            finally:
+                conn.close()
+            return row[0] if row else None
+
+        kills = []
+        killed = set()
+        deadline = time.monotonic() + FAILOVER_TIMEOUT
+        kill_every = len(expected) // (args.failover_kills + 1)
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                lines = read_sink()
+                if len({nonce for _, _, nonce in lines}) >= len(expected):
+                    break
+                # 全体の 1/(回数+1) ずつ送られるごとに、その時点のリーダーを止める (1日分の途中になるよう半日分ずらす)
+                if len(kills) < args.failover_kills and len(lines) >= kill_every * (len(kills) + 1) - args.failover_guilds // 2:
+                    leader = current_leader()
+                    if leader is None or leader in killed:
+                        continue
+                    replicas[leader].send_signal(signal.SIGKILL)
+                    replicas[leader].wait()
+                    killed.add(leader)
+                    kills.append({'replica': leader, 'killed_at': time.time(), 'sent_before_kill': len(lines)})
+            lines = read_sink()
+            conn = sqlite3.connect(path, timeout=5)
+            try:
+                unknown = {(guild_id, local_date) for guild_id, local_date in conn.execute("SELECT guild_id, local_date FROM announce_ledger WHERE status = 'unknown'")}
+            finally:
+                conn.close()
+        finally:
+            for process in replicas.values():
+                if process.poll() is None:
+                    process.terminate()
+            for process in replicas.values():
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            for log in logs:
+                log.close()
+        log_errors = 0
+        for index in range(args.failover_replicas):
+            with open(os.path.join(directory, f"replica-{index}.log"), encoding='utf-8', errors='replace') as f:
+                log_errors += sum(1 for line in f if ':ERROR:' in line or ':CRITICAL:' in line or 'Traceback' in line)
+
+    sends: dict[str, list] = {}
+    for sent_at, replica, nonce in lines:
+        sends.setdefault(nonce, []).append(sent_at)
+    # Discord は最初の投稿から nonce の有効期間内に届いた同じ nonce の投稿を新しく作らない (enforce_nonce)。
+    # 有効期間を過ぎてから届いたもの (--nonce-window 0 ではすべて) は二重投稿として数える
+    deduped = duplicates = 0
+    for posted_at in sends.values():
+        posted_at.sort()
+        for later_at in posted_at[1:]:
+            if later_at - posted_at[0] < args.nonce_window:
+                deduped += 1
+            else:
+                duplicates += 1
+    for kill in kills:
+        after = [sent_at for sent_at, replica, _ in lines if sent_at > kill['killed_at'] and replica != kill['replica']]
+        kill['failover_seconds'] = round(min(after) - kill['killed_at'], 3) if after else None
+        kill['killed_at'] = datetime.datetime.fromtimestamp(kill['killed_at'], datetime.timezone.utc).isoformat(timespec='milliseconds')
+    bound = args.lease_ttl + args.lease_ttl / 3
+    # 投稿されたか確認できず unknown として記録された (ログに出て運用者が確認できる) 通知は、取りこぼしと分けて数える
+    missing = []
+    unconfirmed = []
+    for nonce, (guild_id, offset) in expected.items():
+        if nonce not in sends:
+            local_date = (FAILOVER_FIRST_FIRE + datetime.timedelta(days=offset)).date().isoformat()
+            (unconfirmed if (guild_id, local_date) in unknown else missing).append((guild_id, offset))
+    return {
+        'replicas': args.failover_replicas,
+        'guilds': args.failover_guilds,
+        'days': args.failover_days,
+        'lease_ttl_seconds': args.lease_ttl,
+        'nonce_window_seconds': args.nonce_window,
+        'failover_bound_seconds': round(bound, 3),
+        'expected': len(expected),
+        'delivered': len(sends),
+        'missing': len(missing),
+        'missing_examples': missing[:5],
+        'unknown_not_posted': len(unconfirmed),
+        'unknown_in_ledger': len(unknown),
+        'deduped_by_nonce': deduped,
+        'duplicates': duplicates,
+        'kills': kills,
+        'same_replica_reacquire': reacquire,
+        'log_errors': log_errors,
+        'ok': reacquire['ok'] and not missing and not duplicates and len(kills) == args.failover_kills
+              and all(kill['failover_seconds'] is not None and kill['failover_seconds'] <= bound + 1.0 for kill in kills),
+    }
+
+def member_payload(index: int) -> dict:
+    """Gateway から届くメンバー情報と同じ形式のデータを返す"""
+    user_id = str(10 ** 17 + index)
+    return {
+        'user': {'id': user_id, 'username': f"user{index}", 'discriminator': '0', 'avatar': None, 'global_name': f"User {index}"},
+        'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'nick': None, 'flags': 0,
+    }
+
+def run_member_memory(args) -> dict:
+    """1サーバーの全メンバーを discord.py の Member として保持した場合 (FULL_MEMBER_CACHE=1) と、
+    メンション対象だけを MemberResolver で保持した場合 (既定) のメモリ使用量を tracemalloc で比べる"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('DISCORD_TOKEN', 'bench')
+    import discord
+    import main
+    state = main.bot._connection
+
+    gc.collect()
+    tracemalloc.start()
+    guild = discord.Guild(data={'id': '1', 'name': 'bench', 'member_count': args.member_memory_members}, state=state)
+    for index in range(args.member_memory_members):
+        guild._add_member(discord.Member(data=member_payload(index), guild=guild, state=state))
+    full = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    gc.collect()
+    tracemalloc.start()
+    resolver = main.MemberResolver(main.bot)
+    for index in range(args.member_memory_registered):
+        resolver._store(1, 10 ** 17 + index, main.ResolvedUser(f"User {index}", True))
+    resolved = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        'members': args.member_memory_members,
+        'registered': args.member_memory_registered,
+        'full_member_cache_mib': round(full / 2 ** 20, 2),
+        'member_resolver_mib': round(resolved / 2 ** 20, 3),
+    }
+
+def write_report(report: dict, output: Optional[str]):
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description='誕生日Botのオフラインベンチマーク')
+    parser.add_argument('--scales', default=DEFAULT_SCALES, help=f'計測するサーバー数 (カンマ区切り、既定: {DEFAULT_SCALES})')
+    parser.add_argument('--birthdays-per-guild', type=int, default=DEFAULT_BIRTHDAYS_PER_GUILD, help=f'サーバーごとの誕生日数 (既定: {DEFAULT_BIRTHDAYS_PER_GUILD})')
+    parser.add_argument('--ticks', type=int, default=DEFAULT_TICKS, help=f'規模ごとの通知ティック回数 (既定: {DEFAULT_TICKS})')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_COMMAND_ITERATIONS, help=f'コマンドごとの実行回数 (既定: {DEFAULT_COMMAND_ITERATIONS})')
+    parser.add_argument('--burst', type=int, default=DEFAULT_WRITE_BURST, help=f'同時に送る登録コマンドの数 (既定: {DEFAULT_WRITE_BURST})')
+    parser.add_argument('--send-latency-ms', type=float, default=0.0, help='スタブの channel.send にかける疑似遅延 (ミリ秒)')
+    parser.add_argument('--seed', type=int, default=1, help='データ生成の乱数シード')
+    parser.add_argument('--output', help='結果の JSON を書き出すファイル (省略時は標準出力)')
+    parser.add_argument('--failover', action='store_true', help='性能計測の代わりに、複数レプリカでのリーダー交代の試験を行う')
+    parser.add_argument('--failover-replicas', type=int, default=DEFAULT_FAILOVER_REPLICAS, help=f'起動するレプリカ数 (既定: {DEFAULT_FAILOVER_REPLICAS})')
+    parser.add_argument('--failover-kills', type=int, default=DEFAULT_FAILOVER_KILLS, help=f'リーダーを強制終了する回数 (既定: {DEFAULT_FAILOVER_KILLS})')
+    parser.add_argument('--failover-guilds', type=int, default=FAILOVER_GUILDS, help=argparse.SUPPRESS)
+    parser.add_argument('--failover-days', type=int, default=FAILOVER_DAYS, help=argparse.SUPPRESS)
+    parser.add_argument('--failover-send-latency-ms', type=float, default=FAILOVER_SEND_LATENCY * 1000, help=argparse.SUPPRESS)
+    parser.add_argument('--lease-ttl', type=float, default=FAILOVER_LEASE_TTL, help=f'試験でのリーダー権の有効期間 (秒、既定: {FAILOVER_LEASE_TTL})')
+    parser.add_argument('--nonce-window', type=float, default=FAILOVER_NONCE_WINDOW,
+                        help=f'試験で Discord が同じ nonce の投稿を重複として弾く期間 (秒、既定: {FAILOVER_NONCE_WINDOW:g})。0 では同じ通知の2回目以降の送信をすべて二重投稿として数える')
+    parser.add_argument('--member-memory', action='store_true', help='性能計測の代わりに、メンバーキャッシュの有無によるメモリ使用量を比べる')
+    parser.add_argument('--member-memory-members', type=int, default=MEMBER_MEMORY_MEMBERS, help=argparse.SUPPRESS)
+    parser.add_argument('--member-memory-registered', type=int, default=MEMBER_MEMORY_REGISTERED, help=argparse.SUPPRESS)
+    parser.add_argument('--guilds', type=int, help=argparse.SUPPRESS) # 子プロセス用
+    parser.add_argument('--failover-replica', help=argparse.SUPPRESS) # 子プロセス用
+    parser.add_argument('--replica-index', type=int, help=argparse.SUPPRESS) # 子プロセス用
+    args = parser.parse_args()
+
+    if args.guilds is not None:
+        run_worker(args)
+        return
+    if args.failover_replica is not None:
+        run_failover_replica(args)
+        return
+    if args.failover:
+        if not 0 < args.failover_kills < args.failover_replicas:
+            parser.error("--failover-kills は 1 以上、--failover-replicas 未満で指定してください。")
+        report = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'failover': run_failover(args),
+        }
+        write_report(report, args.output)
+        if not report['failover']['ok']:
+            sys.exit(1)
+        return
+    if args.member_memory:
+        write_report({
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'member_memory': run_member_memory(args),
+        }, args.output)
+        return
+
+    results = []
+    for guilds in (int(value) for value in args.scales.split(',')):
+        print(f"{guilds} サーバー × {args.birthdays_per_guild} 人を計測中...", file=sys.stderr)
+        command = [sys.executable, os.path.abspath(__file__), '--guilds', str(guilds), '--birthdays-per-guild', str(args.birthdays_per_guild),
+                   '--ticks', str(args.ticks), '--iterations', str(args.iterations), '--burst', str(args.burst), '--send-latency-ms', str(args.send_latency_ms), '--seed', str(args.seed)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stderr, file=sys.stderr)
+            sys.exit(f"{guilds} サーバーの計測に失敗しました。")
+        results.append(json.loads(completed.stdout))
+        if not results[-1]['slow_query']['ok']:
+            print(f"{guilds} サーバー: 遅いクエリの実行中に他のコマンドが {SLOW_READ_COMMAND_BOUND}秒以上待たされました。", file=sys.stderr)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'parameters': {'birthdays_per_guild': args.birthdays_per_guild, 'ticks': args.ticks, 'iterations': args.iterations, 'burst': args.burst, 'send_latency_ms': args.send_latency_ms, 'seed': args.seed},
+        'scales': results,
+    }
+    write_report(report, args.output)
+    if not all(result['slow_query']['ok'] for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""複数プロセスでシャードを分担して誕生日Botを起動するランチャー
+
+例: python launcher.py --processes 4 --shards 16
+    プロセスごとに連続したシャード範囲 (0-3, 4-7, ...) を割り当て、main.py を子プロセスとして起動する。
+    各プロセスは担当シャードのサーバーだけを通知スケジュールに載せ、SQLite ファイル (WAL) を共有する。
+    子プロセスが異常終了した場合は一定時間待って再起動し、SIGINT / SIGTERM で全プロセスを停止する。
+"""
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+logger = logging.getLogger('launcher')
+
+IDENTIFY_INTERVAL = 5.0 # Discord のログイン (IDENTIFY) はシャードごとに約5秒間隔が必要
+RESTART_DELAY = 10.0 # 異常終了した子プロセスを再起動するまでの秒数
+POLL_INTERVAL = 1.0 # 子プロセスの状態を確認する間隔 (秒)
+
+def shard_ranges(shard_count: int, processes: int) -> list[range]:
+    """shard_count 個のシャードを processes 個の連続した範囲にできるだけ均等に分ける"""
+    base, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        size = base + (1 if index < extra else 0)
+        ranges.append(range(start, start + size))
+        start += size
+    return ranges
+
+def spawn(script: str, index: int, shards: range, shard_count: int, processes: int) -> subprocess.Popen:
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=f"{shards.start}-{shards.stop - 1}", CLUSTER_SIZE=str(processes))
+    if int(os.environ.get('METRICS_PORT', '0')):
+        # メトリクスのポートはプロセスごとに METRICS_PORT, METRICS_PORT+1, ... を割り当てる
+        env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + index)
+    logger.info(f"シャード {shards.start}-{shards.stop - 1} / {shard_count} のプロセスを起動します。")
+    return subprocess.Popen([sys.executable, script], env=env)
+
+def main():
+    parser = argparse.ArgumentParser(description='シャードを複数プロセスに分けて誕生日Botを起動します')
+    parser.add_argument('--processes', type=int, default=2, help='起動するプロセス数 (既定: 2)')
+    parser.add_argument('--shards', type=int, default=None, help='全体のシャード数 (既定: プロセス数と同じ)')
+    parser.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'), help='起動するBotスクリプト')
+    args = parser.parse_args()
+
+    shard_count = args.shards or args.processes
+    if args.processes < 1 or shard_count < args.processes:
+        parser.error("--processes は 1 以上、--shards 以下で指定してください。")
+    ranges = shard_ranges(shard_count, args.processes)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    children: dict[int, subprocess.Popen] = {}
+    restart_at: dict[int, float] = {}
+    for index, shards in enumerate(ranges):
+        if stopping:
+            break
+        children[index] = spawn(args.script, index, shards, shard_count, args.processes)
+        if index + 1 < len(ranges):
+            # 同時にログインするとレート制限にかかるため、前のプロセスのシャード数に応じて間隔を空ける
+            time.sleep(IDENTIFY_INTERVAL * len(shards))
+
+    while not stopping and children:
+        time.sleep(POLL_INTERVAL)
+        now = time.monotonic()
+        for index, child in list(children.items()):
+            code = child.poll()
+            if code is None:
+                continue
+            if code == 0:
+                # トークン不正などで正常終了した場合は再起動しても同じ結果になるため、そのまま外す
+                logger.info(f"シャード {ranges[index].start}-{ranges[index].stop - 1} のプロセスが終了しました。")
+                del children[index]
+                continue
+            if index not in restart_at:
+                logger.warning(f"シャード {ranges[index].start}-{ranges[index].stop - 1} のプロセスが終了しました (終了コード: {code})。{RESTART_DELAY:.0f}秒後に再起動します。")
+                restart_at[index] = now + RESTART_DELAY
+            elif now >= restart_at[index]:
+                del restart_at[index]
+                children[index] = spawn(args.script, index, ranges[index], shard_count, args.processes)
+
+    logger.info("全プロセスを停止します。")
+    for child in children.values():
+        if child.poll() is None:
+            child.terminate()
+    for child in children.values():
+        try:
+            child.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            child.kill()
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,36 @@
 import discord
 from discord.ext import tasks, commands
+import asyncio
+import bisect
+import calendar
+import csv
 import datetime
+import gc
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import os
+import random
+import re
+import reprlib
+import socket
+import string
 from dotenv import load_dotenv
 import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from discord import app_commands # スラッシュコマンド用
-from typing import List, Optional
+from typing import List, Literal, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
 import logging
+import backup
+import metrics
+import profiling
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
@@ -21,124 +45,548 @@ if not DISCORD_TOKEN:
 
 intents = discord.Intents.default()
 intents.message_content = True
-intents.members = True
-bot = commands.Bot(command_prefix='!', intents=intents)
+intents.members = True # ID 指定でのメンバー取得 (query_members) に必要
+# 全サーバーの全メンバーをメモリに保持するとサーバー規模に比例してメモリを使うため、既定ではメンバーを
+# キャッシュせず、メンション対象として登録された人だけを MemberResolver で取得する。FULL_MEMBER_CACHE=1 で従来どおり全員を保持する
+FULL_MEMBER_CACHE = os.getenv('FULL_MEMBER_CACHE', '0') == '1'
+
+def parse_shard_ids(text: Optional[str]) -> Optional[List[int]]:
+    """'0,1,2' や '0-3' 形式のシャードID指定をリストに変換する (未指定なら None)"""
+    if not text or not text.strip():
+        return None
+    shard_ids = []
+    for part in text.split(','):
+        start, _, end = part.strip().partition('-')
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(shard_ids))
+
+# シャード構成。SHARD_COUNT を指定すると AutoShardedBot で起動し、SHARD_IDS でこのプロセスが担当するシャードを絞る
+# (launcher.py が複数プロセスにシャードを割り振る)。未指定なら従来どおり1プロセス・シャードなしで起動する
+try:
+    SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+    SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS'))
+except ValueError:
+    logger.critical("SHARD_COUNT / SHARD_IDS の形式が正しくありません。")
+    exit()
+if (SHARD_IDS is not None and SHARD_COUNT is None) or (SHARD_COUNT is not None and (SHARD_COUNT < 1 or any(not 0 <= shard_id < SHARD_COUNT for shard_id in SHARD_IDS or ()))):
+    logger.critical("SHARD_IDS は 0 以上 SHARD_COUNT 未満で、SHARD_COUNT と一緒に指定してください。")
+    exit()
+LOCAL_SHARD_IDS = frozenset(SHARD_IDS if SHARD_IDS is not None else range(SHARD_COUNT or 1))
+CLUSTER_SIZE = max(1, int(os.getenv('CLUSTER_SIZE', '1'))) # 同じBotトークンで動いているプロセス数 (グローバルなレート上限を分け合う)
+
+class InstrumentedCommandTree(app_commands.CommandTree):
+    """スラッシュコマンドごとの処理時間をメトリクスに記録するコマンドツリー
+
+    開始時刻を interaction_check で記録し、完了は on_app_command_completion、失敗は on_error で記録する。
+    複数レプリカで動かす場合、操作は同じシャードのすべてのレプリカに届く。リーダーの間 (step_down するまで) は
+    リーダー権の更新が遅れていても応答し、スタンバイは他のリーダーが生きていれば応答を任せ、いなければ切り替え中と返す。
+    """
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if not leading:
+            return await self._on_standby(interaction)
+        interaction.extras['started_at'] = time.perf_counter()
+        return True
+
+    @staticmethod
+    async def _on_standby(interaction: discord.Interaction) -> bool:
+        if leader_lease.other_leader_alive:
+            # 先に応答したレプリカの応答が使われるため、ここでは応答しない
+            STANDBY_INTERACTIONS.inc('left_to_leader')
+            return False
+        STANDBY_INTERACTIONS.inc('refused')
+        logger.warning(f"リーダーの切り替え中のため操作を受け付けませんでした (Guild: {interaction.guild_id}, User: {interaction.user.id}, 種類: {interaction.type.name})")
+        if interaction.type == discord.InteractionType.application_command:
+            try:
+                await interaction.response.send_message("Botの切り替え中のため、コマンドを実行できませんでした。数秒後にもう一度お試しください。", ephemeral=True)
+            except discord.HTTPException as e:
+                # 他のレプリカが先に応答した場合など
+                logger.debug(f"切り替え中の応答を送信できませんでした: {e}")
+        return False
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        status = 'check_failed' if isinstance(error, app_commands.CheckFailure) else 'error'
+        record_command_latency(interaction, status)
+        await super().on_error(interaction, error)
+
+def record_command_latency(interaction: discord.Interaction, status: str):
+    started_at = interaction.extras.get('started_at')
+    if started_at is not None and interaction.command is not None:
+        elapsed = time.perf_counter() - started_at
+        COMMAND_SECONDS.observe(elapsed, interaction.command.qualified_name, status)
+        if SLOW_COMMAND_SECONDS and elapsed >= SLOW_COMMAND_SECONDS:
+            logger.warning(f"遅いコマンド: /{interaction.command.qualified_name} {elapsed * 1000:.0f}ms (Guild: {interaction.guild_id}, User: {interaction.user.id}, 結果: {status}, 引数: {format_command_args(interaction)})")
+
+def format_command_args(interaction: discord.Interaction) -> str:
+    """ログ用にコマンドの引数を短い文字列にする (ユーザーやチャンネルなどは ID で表示する)"""
+    return ', '.join(f"{name}={reprlib.repr(getattr(value, 'id', value))}" for name, value in interaction.namespace) or 'なし'
+
+bot_options = dict(command_prefix='!', intents=intents, tree_cls=InstrumentedCommandTree,
+                   member_cache_flags=discord.MemberCacheFlags.from_intents(intents) if FULL_MEMBER_CACHE else discord.MemberCacheFlags.none(),
+                   chunk_guilds_at_startup=FULL_MEMBER_CACHE)
+if SHARD_COUNT is not None:
+    bot = commands.AutoShardedBot(shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_options)
+else:
+    bot = commands.Bot(**bot_options)
+
+def owns_guild(guild_id: int) -> bool:
+    """サーバーがこのプロセスの担当シャードに属するかを返す (Discord のシャード割り当てと同じ計算)"""
+    return SHARD_COUNT is None or (guild_id >> 22) % SHARD_COUNT in LOCAL_SHARD_IDS
 
 DB_NAME = 'birthdays.db'
+DB_READER_THREADS = 4 # 読み取り用ワーカースレッド数 (書き込みは常に1スレッド)
 DEFAULT_ANNOUNCE_HOUR_UTC = 0 # デフォルト通知時刻 (UTC)
 DEFAULT_ANNOUNCE_MINUTE_UTC = 0 # デフォルト通知時刻 (UTC)
 DEFAULT_TIMEZONE_OFFSET = 9.0 # デフォルトのタイムゾーンオフセット (JST)
+DEFAULT_TIMEZONE_NAME = 'Asia/Tokyo' # タイムゾーン未設定時に使う IANA タイムゾーン (DEFAULT_TIMEZONE_OFFSET と同じ時差)
+ANNOUNCE_FIRE_WINDOW = datetime.timedelta(minutes=1) # 通知時刻を過ぎてもこの時間内なら当日分として通知する
+# 起動時・再試行時に、通知時刻を過ぎた当日分を取り戻す猶予時間 (分)
+ANNOUNCE_CATCHUP_WINDOW = datetime.timedelta(minutes=int(os.getenv('ANNOUNCE_CATCHUP_MINUTES', '180')))
+ANNOUNCE_RETRY_INTERVAL = datetime.timedelta(minutes=5) # 送信に失敗した通知を再試行する間隔
+# Discord が同じ nonce の投稿を重複として弾く期間 (「数分」とされるため短めに見積もる)。
+# 送信を試みた後この時間を過ぎた通知は、届いたか確認できないため再送しない
+ANNOUNCE_NONCE_WINDOW = datetime.timedelta(seconds=float(os.getenv('ANNOUNCE_NONCE_WINDOW_SECONDS', '120')))
+AUTOCOMPLETE_MAX_CHOICES = 25 # Discord のオートコンプリート候補数の上限
 # デフォルトの通知メッセージテンプレート
 DEFAULT_ANNOUNCE_MESSAGE = "🎉 今日 {today_date} は {names} さんの誕生日です！おめでとうございます！ {mentions}"
+ANNOUNCE_TEMPLATE_CACHE_SIZE = 1024 # コンパイル済み通知テンプレートを保持する最大数
 
 # --- データベース関連関数 ---
 
+DB_CACHED_STATEMENTS = 256 # 接続ごとにキャッシュするプリペアドステートメント数
+DB_CACHE_SIZE_KIB = 16384 # 接続ごとのページキャッシュサイズ (KiB)
+DB_BUSY_TIMEOUT_MS = 5000 # ロック待ちの最大時間 (ミリ秒)
+DB_HEALTH_CHECK_INTERVAL = 60.0 # 接続のヘルスチェック間隔 (秒)
+DB_WRITE_BATCH_MAX = 64 # write_batched で1トランザクションにまとめる書き込みの最大件数 (1 でまとめない)
+
+# --- メトリクス ---
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1') # メトリクスを公開するアドレス (既定はローカルのみ)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) # 0 なら HTTP エンドポイントを起動しない
+PROCESS_STARTED_MONOTONIC = time.monotonic()
+
+DB_QUERY_SECONDS = metrics.Histogram('birthday_bot_db_query_seconds', 'SQLite 処理の実行時間 (秒)', ('pool', 'operation'))
+DB_QUEUE_WAIT_SECONDS = metrics.Histogram('birthday_bot_db_queue_wait_seconds', 'DBワーカースレッドの空き待ち時間 (秒)', ('pool',))
+DB_ERRORS = metrics.Counter('birthday_bot_db_errors_total', 'SQLite 処理のエラー数', ('pool', 'operation'))
+DB_PENDING = metrics.Gauge('birthday_bot_db_pending', 'DBワーカーで待機中・実行中の処理数', ('pool',))
+ANNOUNCE_TICK_SECONDS = metrics.Histogram('birthday_bot_announce_tick_seconds', '通知ティック1回の所要時間 (秒)')
+ANNOUNCE_GUILDS_DUE = metrics.Counter('birthday_bot_announce_guilds_due_total', '通知時刻を迎えたサーバー数')
+ANNOUNCE_GUILDS_PROCESSED = metrics.Counter('birthday_bot_announce_guilds_processed_total', '誕生日を確認したサーバー数')
+CHANNEL_SEND_SECONDS = metrics.Histogram('birthday_bot_channel_send_seconds', 'channel.send 1回の所要時間 (秒)')
+CHANNEL_SENDS = metrics.Counter('birthday_bot_channel_sends_total', 'channel.send の結果ごとの回数', ('result',))
+DB_WRITE_BATCH_SIZE = metrics.Histogram('birthday_bot_db_write_batch_size', '1回のコミットにまとめた書き込み件数', buckets=(1, 2, 4, 8, 16, 32, 64))
+COMMAND_SECONDS = metrics.Histogram('birthday_bot_command_seconds', 'スラッシュコマンドの処理時間 (秒)', ('command', 'status'))
+STANDBY_INTERACTIONS = metrics.Counter('birthday_bot_standby_interactions_total', 'スタンバイのレプリカが受け取ったコマンドなどの操作数', ('action',))
+metrics.Gauge('birthday_bot_uptime_seconds', 'プロセスの稼働時間 (秒)', function=lambda: time.monotonic() - PROCESS_STARTED_MONOTONIC)
+
+# --- プロファイリング ---
+
+# これより時間のかかった処理を、サーバー・引数などの情報付きで警告ログに出す (0 で無効)
+SLOW_COMMAND_SECONDS = float(os.getenv('SLOW_COMMAND_MS', '1000')) / 1000 # スラッシュコマンド
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_MS', '250')) / 1000 # DB処理 (ワーカースレッドでの実行時間)
+SLOW_TICK_SECONDS = float(os.getenv('SLOW_TICK_MS', '5000')) / 1000 # 通知ティック
+SLOW_LOG_SQL_LENGTH = 200 # 遅いDB処理のログに出す SQL の最大文字数
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles') # /profile で取得したプロファイルの保存先
+PROFILE_MAX_SECONDS = 300 # /profile で指定できる最大の取得時間 (秒)
+profile_capture = profiling.ProfileCapture(PROFILE_DIR)
+
 def get_db_connection():
-    """データベース接続を取得する関数"""
+    """チューニング済みのデータベース接続を取得する関数"""
     try:
-        conn = sqlite3.connect(DB_NAME)
+        # 接続はワーカースレッドに固定して使い回すが、終了時に別スレッドから閉じられるよう check_same_thread を外す
+        conn = sqlite3.connect(DB_NAME, cached_statements=DB_CACHED_STATEMENTS, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        # 新しいファイルにだけ効く (WAL に切り替える前に設定する)。既存のファイルは DB_CONVERT_AUTO_VACUUM=1 で起動したときに VACUUM で切り替える
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL") # WAL では NORMAL でもコミット済みデータは壊れない
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store = MEMORY")
         logger.debug("データベース接続成功")
         return conn
     except sqlite3.Error as e:
         logger.error(f"データベース接続エラー: {e}")
         return None
 
-def setup_database():
-    """データベースのセットアップを行う関数"""
-    conn = None
-    try:
-        conn = get_db_connection()
-        if conn is None:
+class AsyncDatabase:
+    """SQLite へのアクセスをワーカースレッドで実行し、await 可能なメソッドとして提供するクラス
+
+    書き込みは専用のライタースレッド1本で直列に、読み取りは小さなリーダープールで並行に実行するため、
+    遅いクエリやロック待ちがあってもイベントループ (ゲートウェイのハートビートや他のコマンド) は止まらない。
+    各ワーカースレッドは長寿命の接続を1本ずつ保持し、一定間隔またはエラー発生後にヘルスチェックを行い、
+    壊れていれば再接続する。
+    read/write に渡す関数は接続を第1引数に受け取り、正常終了時にコミット、例外時にロールバックされる。
+    コマンドからの小さな書き込みは write_batched で、同時に届いた他の書き込みとまとめて1回でコミットする。
+    """
+
+    def __init__(self, reader_threads: int = DB_READER_THREADS):
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix='db-reader')
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._batch: List[tuple] = [] # コミット待ちの (func, args, future)
+        self._batch_flusher: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _is_healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            logger.warning(f"データベース接続のヘルスチェックに失敗しました。再接続します: {e}")
             return False
-        cursor = conn.cursor()
 
-        # birthdays テーブル
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS birthdays (
-                guild_id INTEGER NOT NULL, display_name TEXT NOT NULL COLLATE NOCASE, birthday TEXT NOT NULL,
-                mention_user_id INTEGER, registered_by_user_id INTEGER NOT NULL,
-                PRIMARY KEY (guild_id, display_name) ) ''')
-        logger.info("birthdays テーブルを確認/作成しました。")
-        cursor.execute("PRAGMA table_info(birthdays)")
-        columns_b = [column['name'] for column in cursor.fetchall()]
-        if "mention_user_id" not in columns_b:
-            cursor.execute("ALTER TABLE birthdays ADD COLUMN mention_user_id INTEGER")
-            logger.info("birthdays テーブルに mention_user_id カラムを追加しました。")
-        if "registered_by_user_id" not in columns_b:
-            if "registered_user_id" in columns_b:
-                cursor.execute("ALTER TABLE birthdays RENAME COLUMN registered_user_id TO registered_by_user_id")
-                logger.info("birthdays テーブルの registered_user_id を registered_by_user_id に変更しました。")
+    def _discard(self, conn: sqlite3.Connection):
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._local.conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """現在のワーカースレッドの接続を返す (未接続・異常時は接続し直す)"""
+        conn = getattr(self._local, 'conn', None)
+        now = time.monotonic()
+        if conn is not None and now - self._local.checked_at >= DB_HEALTH_CHECK_INTERVAL:
+            if not self._is_healthy(conn):
+                self._discard(conn)
+                conn = None
+            self._local.checked_at = now
+        if conn is None:
+            conn = get_db_connection()
+            if conn is None:
+                raise sqlite3.OperationalError("データベース接続に失敗しました。")
+            with self._connections_lock:
+                self._connections.append(conn)
+            self._local.conn = conn
+            self._local.checked_at = now
+        return conn
+
+    def _run(self, pool: str, submitted_at: float, func, args):
+        started_at = time.perf_counter()
+        DB_QUEUE_WAIT_SECONDS.observe(started_at - submitted_at, pool)
+        operation = func.__name__.lstrip('_')
+        try:
+            conn = self._connection()
+            result = func(conn, *args)
+            conn.commit()
+            return result
+        except BaseException as e:
+            DB_ERRORS.inc(pool, operation)
+            conn = getattr(self._local, 'conn', None)
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+            if isinstance(e, sqlite3.Error) and not isinstance(e, sqlite3.IntegrityError):
+                # 接続自体が壊れている可能性があるため、次回利用前に必ずヘルスチェックする
+                self._local.checked_at = float('-inf')
+            raise
+        finally:
+            elapsed = time.perf_counter() - started_at
+            DB_QUERY_SECONDS.observe(elapsed, pool, operation)
+            DB_PENDING.dec(pool)
+            if SLOW_QUERY_SECONDS and elapsed >= SLOW_QUERY_SECONDS:
+                logger.warning(f"遅いDB処理: {operation} ({pool}) {elapsed * 1000:.0f}ms 引数: {self._describe_args(args)}")
+
+    @staticmethod
+    def _describe_args(args: tuple) -> str:
+        """ログ用に引数を短くする (SQL 文は長めに残し、それ以外は reprlib で省略する)"""
+        return ', '.join(arg[:SLOW_LOG_SQL_LENGTH] if isinstance(arg, str) and len(arg) > 30 else reprlib.repr(arg) for arg in args) or 'なし'
+
+    async def read(self, func, *args):
+        """読み取り用スレッドで func(conn, *args) を実行する"""
+        DB_PENDING.inc('read')
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._run, 'read', time.perf_counter(), func, args)
+
+    async def write(self, func, *args):
+        """ライタースレッドで func(conn, *args) を1トランザクションとして実行する"""
+        DB_PENDING.inc('write')
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._run, 'write', time.perf_counter(), func, args)
+
+    async def write_batched(self, func, *args):
+        """func(conn, *args) を他の書き込みとまとめて1トランザクションで実行し、コミット後に戻り値を返す
+
+        ライタースレッドが空いていればすぐに実行し、前のコミットの実行中に届いた書き込みは次の1回に
+        (最大 DB_WRITE_BATCH_MAX 件ずつ) まとめる。負荷が低いときに待ち時間は増えない。
+        各書き込みはセーブポイントで区切るため、1件が例外で失敗しても他の書き込みには影響しない。
+        """
+        if DB_WRITE_BATCH_MAX <= 1:
+            return await self.write(func, *args)
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append((func, args, future))
+        if self._batch_flusher is None:
+            self._batch_flusher = asyncio.ensure_future(self._flush_batches())
+        return await future
+
+    async def _flush_batches(self):
+        try:
+            while self._batch:
+                items, self._batch = self._batch[:DB_WRITE_BATCH_MAX], self._batch[DB_WRITE_BATCH_MAX:]
+                DB_WRITE_BATCH_SIZE.observe(len(items))
+                try:
+                    outcomes = await self.write(self._write_batch, [(func, args) for func, args, _ in items])
+                except Exception as e:
+                    # コミット自体に失敗した場合は、まとめた書き込みすべてが失敗
+                    outcomes = [(e, None)] * len(items)
+                for (_, _, future), (error, result) in zip(items, outcomes):
+                    if future.done():
+                        continue # 呼び出し元がキャンセルされた
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(result)
+        finally:
+            self._batch_flusher = None
+
+    @staticmethod
+    def _write_batch(conn: sqlite3.Connection, calls: List[tuple]) -> List[tuple[Optional[Exception], object]]:
+        """まとめた書き込みを1トランザクション内でセーブポイントごとに実行し、(例外, 戻り値) の一覧を返す"""
+        conn.execute("BEGIN IMMEDIATE")
+        outcomes = []
+        for func, args in calls:
+            conn.execute("SAVEPOINT batch_item")
+            try:
+                result = func(conn, *args)
+            except Exception as e:
+                conn.execute("ROLLBACK TO batch_item")
+                outcomes.append((e, None))
             else:
-                cursor.execute("ALTER TABLE birthdays ADD COLUMN registered_by_user_id INTEGER")
-                logger.info("birthdays テーブルに registered_by_user_id カラムを追加しました。")
-
-        # server_settings テーブル
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS server_settings (
-                guild_id INTEGER PRIMARY KEY, announce_channel_id INTEGER NOT NULL,
-                announce_hour_utc INTEGER, announce_minute_utc INTEGER,
-                announce_timezone_offset REAL,
-                announce_message_template TEXT
-            ) ''')
-        logger.info("server_settings テーブルを確認/作成しました。")
-        cursor.execute("PRAGMA table_info(server_settings)")
-        columns_s = {column['name']: column['type'] for column in cursor.fetchall()}
-        if "announce_hour_utc" not in columns_s:
-            cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_hour_utc INTEGER")
-            logger.info("server_settings テーブルに announce_hour_utc カラムを追加しました。")
-        if "announce_minute_utc" not in columns_s:
-            cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_minute_utc INTEGER")
-            logger.info("server_settings テーブルに announce_minute_utc カラムを追加しました。")
-        if "announce_timezone_offset" not in columns_s:
-            cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_timezone_offset REAL")
-            logger.info("server_settings テーブルに announce_timezone_offset カラムを追加しました。")
-        if "announce_message_template" not in columns_s:
-            cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_message_template TEXT")
-            logger.info("server_settings テーブルに announce_message_template カラムを追加しました。")
-
-        conn.commit()
-        logger.info("データベースのセットアップが正常に完了しました。")
-        return True
+                outcomes.append((None, result))
+            conn.execute("RELEASE batch_item")
+        return outcomes
 
-    except sqlite3.Error as e:
-        logger.error(f"データベースセットアップ中のエラー: {e}")
-        if conn:
-            conn.rollback()
-        return False
-    finally:
-        if conn:
+    # fetchone / fetchall / execute はメトリクス上この名前 (operation) で集計される
+    @staticmethod
+    def _fetchone(conn: sqlite3.Connection, sql: str, params: tuple) -> Optional[sqlite3.Row]:
+        return conn.execute(sql, params).fetchone()
+
+    @staticmethod
+    def _fetchall(conn: sqlite3.Connection, sql: str, params: tuple) -> List[sqlite3.Row]:
+        return conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _execute(conn: sqlite3.Connection, sql: str, params: tuple) -> int:
+        return conn.execute(sql, params).rowcount
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.read(self._fetchone, sql, params)
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        return await self.read(self._fetchall, sql, params)
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """書き込みクエリを実行し、影響を受けた行数を返す"""
+        return await self.write(self._execute, sql, params)
+
+    async def execute_batched(self, sql: str, params: tuple = ()) -> int:
+        """書き込みクエリを他の書き込みとまとめてコミットし、影響を受けた行数を返す"""
+        return await self.write_batched(self._execute, sql, params)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
             conn.close()
 
-# --- ヘルパー関数 ---
-def convert_local_to_utc(hour_local: int, minute_local: int, offset_hours: float) -> tuple[int, int]:
-    """指定されたローカル時刻とオフセットをUTC時刻に変換する"""
-    try:
-        tz_local = datetime.timezone(datetime.timedelta(hours=offset_hours))
-        now_dummy = datetime.datetime.now()
-        dt_local = datetime.datetime(now_dummy.year, now_dummy.month, now_dummy.day, hour_local, minute_local, tzinfo=tz_local)
-        dt_utc = dt_local.astimezone(datetime.timezone.utc)
-        return dt_utc.hour, dt_utc.minute
-    except ValueError:
-        logger.error(f"ローカル時刻からUTCへの変換に失敗: hour={hour_local}, min={minute_local}, offset={offset_hours}")
-        return 0, 0
+db = AsyncDatabase()
+
+def migrate_baseline(cursor: sqlite3.Cursor):
+    """スキーマ v1: バージョン管理導入前のどの世代のデータベースも現在の構成にそろえる"""
+    # birthdays テーブル
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS birthdays (
+            guild_id INTEGER NOT NULL, display_name TEXT NOT NULL COLLATE NOCASE, birthday TEXT NOT NULL,
+            mention_user_id INTEGER, registered_by_user_id INTEGER NOT NULL, birthday_md INTEGER,
+            PRIMARY KEY (guild_id, display_name) ) ''')
+    logger.info("birthdays テーブルを確認/作成しました。")
+    cursor.execute("PRAGMA table_info(birthdays)")
+    columns_b = [column['name'] for column in cursor.fetchall()]
+    if "mention_user_id" not in columns_b:
+        cursor.execute("ALTER TABLE birthdays ADD COLUMN mention_user_id INTEGER")
+        logger.info("birthdays テーブルに mention_user_id カラムを追加しました。")
+    if "registered_by_user_id" not in columns_b:
+        if "registered_user_id" in columns_b:
+            cursor.execute("ALTER TABLE birthdays RENAME COLUMN registered_user_id TO registered_by_user_id")
+            logger.info("birthdays テーブルの registered_user_id を registered_by_user_id に変更しました。")
+        else:
+            cursor.execute("ALTER TABLE birthdays ADD COLUMN registered_by_user_id INTEGER")
+            logger.info("birthdays テーブルに registered_by_user_id カラムを追加しました。")
+    if "birthday_md" not in columns_b:
+        # 'MM/DD' を MM*100+DD の整数で保持し、日付検索をインデックスで引けるようにする
+        cursor.execute("ALTER TABLE birthdays ADD COLUMN birthday_md INTEGER")
+        cursor.execute("UPDATE birthdays SET birthday_md = CAST(substr(birthday, 1, 2) AS INTEGER) * 100 + CAST(substr(birthday, 4, 2) AS INTEGER)")
+        logger.info("birthdays テーブルに birthday_md カラムを追加しました。")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_md_guild ON birthdays (birthday_md, guild_id)")
+    # 一覧のキーセットページネーション用 (guild_id, birthday_md, display_name) の順に走査する
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_guild_md_name ON birthdays (guild_id, birthday_md, display_name)")
+
+    # server_settings テーブル
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS server_settings (
+            guild_id INTEGER PRIMARY KEY, announce_channel_id INTEGER NOT NULL,
+            announce_hour_utc INTEGER, announce_minute_utc INTEGER,
+            announce_timezone_offset REAL,
+            announce_message_template TEXT,
+            announce_timezone TEXT, announce_hour_local INTEGER, announce_minute_local INTEGER
+        ) ''')
+    logger.info("server_settings テーブルを確認/作成しました。")
+    cursor.execute("PRAGMA table_info(server_settings)")
+    columns_s = {column['name']: column['type'] for column in cursor.fetchall()}
+    if "announce_hour_utc" not in columns_s:
+        cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_hour_utc INTEGER")
+        logger.info("server_settings テーブルに announce_hour_utc カラムを追加しました。")
+    if "announce_minute_utc" not in columns_s:
+        cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_minute_utc INTEGER")
+        logger.info("server_settings テーブルに announce_minute_utc カラムを追加しました。")
+    if "announce_timezone_offset" not in columns_s:
+        cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_timezone_offset REAL")
+        logger.info("server_settings テーブルに announce_timezone_offset カラムを追加しました。")
+    if "announce_message_template" not in columns_s:
+        cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_message_template TEXT")
+        logger.info("server_settings テーブルに announce_message_template カラムを追加しました。")
+    if "announce_timezone" not in columns_s:
+        cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_timezone TEXT")
+        logger.info("server_settings テーブルに announce_timezone カラムを追加しました。")
+    if "announce_hour_local" not in columns_s:
+        # 夏時間のあるタイムゾーンでもずれないよう、通知時刻はローカル時刻で保持する
+        cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_hour_local INTEGER")
+        cursor.execute("ALTER TABLE server_settings ADD COLUMN announce_minute_local INTEGER")
+        cursor.execute("SELECT guild_id, announce_hour_utc, announce_minute_utc, announce_timezone_offset FROM server_settings WHERE announce_hour_utc IS NOT NULL AND announce_minute_utc IS NOT NULL")
+        for row in cursor.fetchall():
+            offset = row['announce_timezone_offset'] if row['announce_timezone_offset'] is not None else DEFAULT_TIMEZONE_OFFSET
+            local_minutes = (row['announce_hour_utc'] * 60 + row['announce_minute_utc'] + round(offset * 60)) % (24 * 60)
+            cursor.execute("UPDATE server_settings SET announce_hour_local = ?, announce_minute_local = ? WHERE guild_id = ?", (local_minutes // 60, local_minutes % 60, row['guild_id']))
+        logger.info("server_settings テーブルに announce_hour_local / announce_minute_local カラムを追加しました。")
+
+    # announce_ledger テーブル (サーバー・ローカル日付ごとの通知状態。再試行・再起動時の二重投稿と取りこぼしを防ぐ)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS announce_ledger (
+            guild_id INTEGER NOT NULL, local_date TEXT NOT NULL,
+            status TEXT NOT NULL, updated_at TEXT NOT NULL,
+            PRIMARY KEY (guild_id, local_date)
+        ) ''')
+    logger.info("announce_ledger テーブルを確認/作成しました。")
+
+def migrate_removed_guilds(cursor: sqlite3.Cursor):
+    """スキーマ v2: Botが退出したサーバーを記録する removed_guilds テーブル (猶予期間後にデータを削除する)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS removed_guilds (
+            guild_id INTEGER PRIMARY KEY, removed_at TEXT NOT NULL
+        ) ''')
+    logger.info("removed_guilds テーブルを確認/作成しました。")
 
-def convert_utc_to_local_str(hour_utc: Optional[int], minute_utc: Optional[int], offset_hours: Optional[float]) -> str:
-    """UTC時刻を指定されたオフセットのローカル時刻文字列 (HH:MM) に変換する"""
+def migrate_leases(cursor: sqlite3.Cursor):
+    """スキーマ v3: 複数レプリカのリーダー選出に使う leases テーブルと、通知台帳の lease_token 列"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY, holder TEXT NOT NULL,
+            token INTEGER NOT NULL, expires_at REAL NOT NULL
+        ) ''')
+    logger.info("leases テーブルを確認/作成しました。")
+    cursor.execute("PRAGMA table_info(announce_ledger)")
+    if "lease_token" not in [column['name'] for column in cursor.fetchall()]:
+        # 通知権を取得したリーダーのトークン。これより新しいリーダーだけが送信中の通知を引き継げる
+        cursor.execute("ALTER TABLE announce_ledger ADD COLUMN lease_token INTEGER")
+        logger.info("announce_ledger テーブルに lease_token カラムを追加しました。")
+
+# スキーマ移行処理。i 番目の処理でスキーマを v(i+1) にする。スキーマを変えるときは末尾に追加する (既存の処理は変更しない)
+MIGRATIONS = [
+    migrate_baseline,
+    migrate_removed_guilds,
+    migrate_leases,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def setup_database(conn: sqlite3.Connection) -> bool:
+    """PRAGMA user_version を見て未適用のスキーマ移行だけを実行する関数 (ライタースレッド上で実行される)"""
+    cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        # 複数プロセスが同時に起動しても移行が二重に走らないよう、書き込みロックを取ってから確認し直す
+        cursor.execute("BEGIN IMMEDIATE")
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for number in range(version, SCHEMA_VERSION):
+            MIGRATIONS[number](cursor)
+            logger.info(f"データベースのスキーマを v{number + 1} に移行しました。")
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    elif version > SCHEMA_VERSION:
+        logger.warning(f"データベースのスキーマ (v{version}) がこのバージョンの想定 (v{SCHEMA_VERSION}) より新しいです。")
+    logger.info(f"データベースのセットアップが正常に完了しました (スキーマ v{max(version, SCHEMA_VERSION)})。")
+    return True
+
+# --- ヘルパー関数 ---
+def resolve_timezone(name: Optional[str], offset_hours: Optional[float]) -> datetime.tzinfo:
+    """IANA タイムゾーン名 (優先) または UTC オフセットからタイムゾーンを返す"""
+    if name:
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            logger.error(f"不明なタイムゾーンです: {name}。UTCオフセットを使用します。")
     if offset_hours is None:
-        offset_hours = DEFAULT_TIMEZONE_OFFSET
-    if hour_utc is None or minute_utc is None:
-        hour_utc = DEFAULT_ANNOUNCE_HOUR_UTC
-        minute_utc = DEFAULT_ANNOUNCE_MINUTE_UTC
-    try:
-        tz_local = datetime.timezone(datetime.timedelta(hours=offset_hours))
-        now_dummy = datetime.datetime.now()
-        dt_utc = datetime.datetime(now_dummy.year, now_dummy.month, now_dummy.day, hour_utc, minute_utc, tzinfo=datetime.timezone.utc)
-        dt_local = dt_utc.astimezone(tz_local)
-        return dt_local.strftime("%H:%M")
+        return ZoneInfo(DEFAULT_TIMEZONE_NAME)
+    return datetime.timezone(datetime.timedelta(hours=offset_hours))
+
+def local_fire_time(tz: datetime.tzinfo, day: datetime.date, hour_local: int, minute_local: int) -> datetime.datetime:
+    """指定日のローカル時刻をUTCの日時に変換する (夏時間の切り替わりも考慮される)"""
+    return datetime.datetime(day.year, day.month, day.day, hour_local, minute_local, tzinfo=tz).astimezone(datetime.timezone.utc)
+
+def convert_local_to_utc(hour_local: int, minute_local: int, tz: datetime.tzinfo) -> tuple[int, int]:
+    """指定されたタイムゾーンの今日のローカル時刻をUTC時刻に変換する"""
+    dt_utc = local_fire_time(tz, datetime.datetime.now(tz).date(), hour_local, minute_local)
+    return dt_utc.hour, dt_utc.minute
+
+def normalize_birthday(birthday: str) -> Optional[str]:
+    """'MM/DD' 形式の誕生日をゼロ埋めした 'MM/DD' に正規化する (不正な場合は None)"""
+    try:
+        # 年を省略すると1900年 (平年) として解釈され 02/29 が弾かれるため、うるう年を補って解釈する
+        return datetime.datetime.strptime(f"{birthday}/2000", '%m/%d/%Y').strftime('%m/%d')
     except ValueError:
-        logger.error(f"UTCからローカル時刻文字列への変換に失敗: hour={hour_utc}, min={minute_utc}, offset={offset_hours}")
-        return "不明"
+        return None
+
+MENTION_PATTERN = re.compile(r'<@!?(\d{15,20})>|(\d{15,20})')
+
+def parse_mention_user_id(value) -> tuple[bool, Optional[int]]:
+    """ユーザーID またはメンション文字列 (<@ID>) を解釈し、(正しい形式か, ユーザーID) を返す。空欄はメンションなし"""
+    if value is None:
+        return True, None
+    text = str(value).strip()
+    if not text:
+        return True, None
+    match = MENTION_PATTERN.fullmatch(text)
+    if not match:
+        return False, None
+    return True, int(match.group(1) or match.group(2))
+
+def to_month_day(birthday: str) -> int:
+    """'MM/DD' 形式の誕生日を MM*100+DD の整数に変換する (例: '04/01' -> 401)"""
+    month, day = birthday.split('/')
+    return int(month) * 100 + int(day)
+
+def observed_month_days(day: datetime.date) -> tuple[int, ...]:
+    """その日に祝う誕生日の月日 (MM*100+DD) を返す。平年の 02/28 は 02/29 生まれの分も含む"""
+    month_day = day.month * 100 + day.day
+    if month_day == 228 and not calendar.isleap(day.year):
+        return (228, 229)
+    return (month_day,)
+
+def next_birthday(month_day: int, today: datetime.date) -> datetime.date:
+    """today 以降で最初に誕生日を祝う日を返す (02/29 生まれは平年なら 02/28)"""
+    month, day = divmod(month_day, 100)
+    year = today.year
+    while True:
+        occurrence = datetime.date(year, month, 28 if month_day == 229 and not calendar.isleap(year) else day)
+        if occurrence >= today:
+            return occurrence
+        year += 1
 
 def format_offset(offset: Optional[float]) -> str:
     """UTCオフセットを文字列 (例: UTC+9.0) にフォーマットする"""
@@ -148,27 +596,1254 @@ def format_offset(offset: Optional[float]) -> str:
     abs_offset = abs(offset)
     return f"UTC{sign}{abs_offset}"
 
-# --- Botイベント ---
+def format_timezone(name: Optional[str], offset: Optional[float]) -> str:
+    """タイムゾーンを表示用文字列 (例: America/New_York, UTC+9.0) にフォーマットする"""
+    return name if name else format_offset(offset)
 
-@bot.event
-async def on_ready():
-    logger.info(f'{bot.user} が起動しました')
-    if not setup_database():
-        logger.critical("データベースのセットアップに失敗しました。Botを停止します。")
-        await bot.close()
+class LRUCache:
+    """最大件数 (maxbytes を指定した場合は合計サイズも) を超えると最も長く使われていないエントリから捨てるキャッシュ"""
+
+    def __init__(self, maxsize: int, maxbytes: Optional[int] = None, on_evict=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0 # put で指定されたサイズの合計
+        self._entries: OrderedDict = OrderedDict()
+        self._sizes: dict = {}
+        self._on_evict = on_evict # 上限を超えて捨てたエントリごとに on_evict(key, value) を呼ぶ
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def get(self, key, default=None):
+        try:
+            self._entries.move_to_end(key)
+        except KeyError:
+            return default
+        return self._entries[key]
+
+    def put(self, key, value, nbytes: int = 0):
+        self.nbytes += nbytes - self._sizes.pop(key, 0)
+        if nbytes:
+            self._sizes[key] = nbytes
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes and len(self._entries) > 1):
+            evicted, evicted_value = self._entries.popitem(last=False)
+            self.nbytes -= self._sizes.pop(evicted, 0)
+            if self._on_evict is not None:
+                self._on_evict(evicted, evicted_value)
+
+    def pop(self, key, default=None):
+        self.nbytes -= self._sizes.pop(key, 0)
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+# --- 通知メッセージテンプレート ---
+
+TEMPLATE_NAME_TAG = '<name>' # 誕生者の名前に置き換わる記法 ({names} と同じ)
+TEMPLATE_FIELDS = {'names': '誕生者の名前', 'mentions': 'メンション', 'today_date': '日付 (MM/DD)'} # 使えるプレースホルダー
+
+class TemplateError(ValueError):
+    """通知メッセージテンプレートの書式が正しくない場合の例外 (メッセージはそのまま利用者に表示する)"""
+
+class CompiledTemplate:
+    """解析済みの通知メッセージテンプレート
+
+    固定文字列とプレースホルダーを分けて保持し、描画時はプレースホルダーの位置に値を入れて連結するだけにする。
+    """
+
+    __slots__ = ('_parts', '_fields')
+
+    def __init__(self, parts: List[str], fields: List[tuple[int, str]]):
+        self._parts = tuple(parts)
+        self._fields = tuple(fields) # (parts 内の位置, プレースホルダー名)
+
+    def render(self, **values: str) -> str:
+        parts = list(self._parts)
+        for index, field in self._fields:
+            parts[index] = values[field]
+        return ''.join(parts)
+
+def compile_template(template: str) -> CompiledTemplate:
+    """通知メッセージテンプレートを解析する
+
+    <name> と {names} / {mentions} / {today_date} をプレースホルダーとして扱い、
+    文字としての波括弧は {{ / }} と書く。未知のプレースホルダーや対応しない波括弧は TemplateError を送出する。
+    """
+    parts: List[str] = []
+    fields: List[tuple[int, str]] = []
+    formatter = string.Formatter()
+    for chunk_index, chunk in enumerate(template.split(TEMPLATE_NAME_TAG)):
+        if chunk_index:
+            fields.append((len(parts), 'names'))
+            parts.append('')
+        try:
+            parsed = list(formatter.parse(chunk))
+        except ValueError:
+            raise TemplateError("波括弧 `{` `}` の対応が正しくありません。文字として使う場合は `{{` `}}` と書いてください。") from None
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                parts.append(literal)
+            if field is None:
+                continue
+            if field not in TEMPLATE_FIELDS or spec or conversion:
+                placeholder = '{' + field + ('!' + conversion if conversion else '') + (':' + spec if spec else '') + '}'
+                raise TemplateError(f"不明なプレースホルダー `{placeholder}` があります。使えるのは {', '.join(f'`{{{name}}}`' for name in TEMPLATE_FIELDS)} と `{TEMPLATE_NAME_TAG}` です。")
+            fields.append((len(parts), field))
+            parts.append('')
+    return CompiledTemplate(parts, fields)
+
+DEFAULT_ANNOUNCE_TEMPLATE = compile_template(DEFAULT_ANNOUNCE_MESSAGE)
+announce_templates = LRUCache(ANNOUNCE_TEMPLATE_CACHE_SIZE) # (guild_id, テンプレート文字列) -> CompiledTemplate
+
+def get_announce_template(guild_id: int, template: Optional[str]) -> CompiledTemplate:
+    """サーバーの通知テンプレートのコンパイル結果を返す (テンプレート文字列を版として (guild_id, 文字列) でキャッシュする)
+
+    設定時に検証済みのはずだが、以前のバージョンで保存された不正なテンプレートはデフォルトで代用する。
+    """
+    if not template:
+        return DEFAULT_ANNOUNCE_TEMPLATE
+    key = (guild_id, template)
+    compiled = announce_templates.get(key)
+    if compiled is None:
+        try:
+            compiled = compile_template(template)
+        except TemplateError as e:
+            logger.error(f"サーバー {guild_id} のメッセージテンプレートが不正なため、デフォルトを使用します: {e}")
+            compiled = DEFAULT_ANNOUNCE_TEMPLATE
+        announce_templates.put(key, compiled)
+    return compiled
+
+# --- サーバー設定キャッシュ ---
+
+SETTINGS_COLUMNS = ('announce_channel_id', 'announce_hour_utc', 'announce_minute_utc', 'announce_timezone_offset', 'announce_message_template',
+                    'announce_timezone', 'announce_hour_local', 'announce_minute_local')
+
+class GuildSettings:
+    """server_settings の1行分をメモリ上に保持するクラス"""
+
+    __slots__ = ('guild_id', 'tz') + SETTINGS_COLUMNS
+
+    def __init__(self, row: sqlite3.Row):
+        self.guild_id = row['guild_id']
+        for column in SETTINGS_COLUMNS:
+            setattr(self, column, row[column])
+        self.tz = resolve_timezone(self.announce_timezone, self.announce_timezone_offset)
+
+    @property
+    def zone_key(self) -> str:
+        """同じタイムゾーンのサーバーをまとめるためのキー"""
+        if self.announce_timezone:
+            return self.announce_timezone
+        return format_offset(self.announce_timezone_offset) if self.announce_timezone_offset is not None else DEFAULT_TIMEZONE_NAME
+
+    @property
+    def is_default_time(self) -> bool:
+        return self.announce_hour_local is None or self.announce_minute_local is None
+
+    @property
+    def announce_time_local(self) -> tuple[int, int]:
+        """通知時刻 (ローカル時刻) を返す。未設定ならデフォルト (UTC 0:00 相当のローカル時刻)"""
+        if not self.is_default_time:
+            return self.announce_hour_local, self.announce_minute_local
+        default_utc = datetime.datetime.now(datetime.timezone.utc).replace(hour=DEFAULT_ANNOUNCE_HOUR_UTC, minute=DEFAULT_ANNOUNCE_MINUTE_UTC)
+        default_local = default_utc.astimezone(self.tz)
+        return default_local.hour, default_local.minute
+
+class SettingsCache:
+    """サーバー設定の書き込みスルー型キャッシュ
+
+    読み取りは初回のみDBから読み込み (存在しないことも記憶する)、以降はメモリから返す。
+    書き込みは変更された列だけを INSERT ... ON CONFLICT DO UPDATE する単一の文で行い、
+    同じトランザクション内で読み直した行でキャッシュを置き換える。
+    """
+
+    def __init__(self, database: AsyncDatabase):
+        self._db = database
+        self._settings: dict[int, Optional[GuildSettings]] = {}
+        self._complete = False # 全サーバー分を読み込み済みなら、キャッシュにないサーバーは設定なしとみなす
+
+    def __len__(self) -> int:
+        return sum(1 for settings in self._settings.values() if settings is not None)
+
+    def values(self) -> List[GuildSettings]:
+        return [settings for settings in self._settings.values() if settings is not None]
+
+    def peek(self, guild_id: int) -> Optional[GuildSettings]:
+        """DBを参照せずにキャッシュ済みの設定を返す"""
+        return self._settings.get(guild_id)
+
+    async def load_all(self):
+        """全サーバーの設定を読み込む (起動時に1回のみ)"""
+        # 退出したサーバー (削除の猶予期間中) は読み込まず、通知の対象にしない
+        rows = await self._db.fetchall(f"SELECT guild_id, {', '.join(SETTINGS_COLUMNS)} FROM server_settings WHERE guild_id NOT IN (SELECT guild_id FROM removed_guilds)")
+        for row in rows:
+            # 読み込み中に書き込まれた設定のほうが新しいため上書きしない
+            if self._settings.get(row['guild_id']) is None:
+                self._settings[row['guild_id']] = GuildSettings(row)
+        self._complete = True
+
+    async def get(self, guild_id: int) -> Optional[GuildSettings]:
+        """サーバーの設定を返す。未設定なら None"""
+        if guild_id in self._settings or self._complete:
+            return self._settings.get(guild_id)
+        row = await self._db.fetchone(f"SELECT guild_id, {', '.join(SETTINGS_COLUMNS)} FROM server_settings WHERE guild_id = ?", (guild_id,))
+        self._settings.setdefault(guild_id, GuildSettings(row) if row else None)
+        return self._settings[guild_id]
+
+    def forget(self, guild_id: int):
+        """サーバーを設定なしとして扱う (退出したサーバー。DBの行は削除の猶予期間中は残す)"""
+        self._settings[guild_id] = None
+
+    def clear(self):
+        """キャッシュを空にする (次の load_all または get でDBから読み直す)"""
+        self._settings.clear()
+        self._complete = False
+
+    async def reload(self, guild_id: int) -> Optional[GuildSettings]:
+        """サーバーの設定をDBから読み直す (再参加したサーバー)"""
+        row = await self._db.fetchone(f"SELECT guild_id, {', '.join(SETTINGS_COLUMNS)} FROM server_settings WHERE guild_id = ?", (guild_id,))
+        self._settings[guild_id] = GuildSettings(row) if row else None
+        return self._settings[guild_id]
+
+    async def update(self, guild_id: int, **changes) -> Optional[GuildSettings]:
+        """指定された列だけを更新し、更新後の設定を返す
+
+        announce_channel_id を含む場合は行がなければ作成する。含まない場合は既存の行のみ更新し、
+        行がなければ None を返す (announce_channel_id は NOT NULL のため行を作れない)。
+        """
+        unknown = set(changes) - set(SETTINGS_COLUMNS)
+        if unknown:
+            raise ValueError(f"不明な設定列です: {', '.join(sorted(unknown))}")
+        columns = list(changes)
+        assignments = ', '.join(f'{column} = excluded.{column}' for column in columns)
+        if 'announce_channel_id' in changes:
+            sql = f"""
+                INSERT INTO server_settings (guild_id, {', '.join(columns)})
+                VALUES (?, {', '.join('?' * len(columns))})
+                ON CONFLICT(guild_id) DO UPDATE SET {assignments}
+                """
+            params = (guild_id, *changes.values())
+        else:
+            sql = f"UPDATE server_settings SET {', '.join(f'{column} = ?' for column in columns)} WHERE guild_id = ?"
+            params = (*changes.values(), guild_id)
+
+        def save(conn: sqlite3.Connection) -> Optional[sqlite3.Row]:
+            conn.execute(sql, params)
+            return conn.execute(f"SELECT guild_id, {', '.join(SETTINGS_COLUMNS)} FROM server_settings WHERE guild_id = ?", (guild_id,)).fetchone()
+
+        row = await self._db.write(save)
+        self._settings[guild_id] = GuildSettings(row) if row else None
+        return self._settings[guild_id]
+
+settings_cache = SettingsCache(db)
+
+# --- 名前の前方一致インデックス ---
+
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+def nocase_key(name: str) -> str:
+    """SQLite の COLLATE NOCASE と同じ比較キー (ASCII のみ大文字小文字を無視) を返す"""
+    return name.translate(_ASCII_LOWER)
+
+class NameIndex:
+    """サーバーごとの登録名を casefold したキーでソートして保持し、bisect で前方一致検索するクラス
+
+    サーバーごとに初回のみDBから読み込み、以降は register/delete で差分更新するため、
+    オートコンプリートの入力ごとにDBへ問い合わせない。
+    """
+
+    def __init__(self, database: AsyncDatabase):
+        self._db = database
+        self._entries: dict[int, List[tuple[str, str]]] = {} # guild_id -> [(casefold した名前, 名前)] (ソート済み)
+        self._loading: dict[int, asyncio.Task] = {}
+        self._dirty: set[int] = set() # 読み込み中に更新されたサーバー (読み込み結果を破棄する)
+
+    @staticmethod
+    def _load(conn: sqlite3.Connection, guild_id: int) -> List[tuple[str, str]]:
+        rows = conn.execute("SELECT display_name FROM birthdays WHERE guild_id = ?", (guild_id,)).fetchall()
+        return sorted((row['display_name'].casefold(), row['display_name']) for row in rows)
+
+    async def _ensure(self, guild_id: int) -> List[tuple[str, str]]:
+        entries = self._entries.get(guild_id)
+        if entries is not None:
+            return entries
+        task = self._loading.get(guild_id)
+        if task is None:
+            self._dirty.discard(guild_id)
+            task = self._loading[guild_id] = asyncio.ensure_future(self._db.read(self._load, guild_id))
+        try:
+            entries = await asyncio.shield(task)
+        finally:
+            if self._loading.get(guild_id) is task and task.done():
+                del self._loading[guild_id]
+                if not task.cancelled() and task.exception() is None and guild_id not in self._dirty:
+                    self._entries[guild_id] = task.result()
+        return entries
+
+    def _find(self, entries: List[tuple[str, str]], name: str) -> Optional[int]:
+        """name と NOCASE で一致するエントリの位置を返す"""
+        folded, key = name.casefold(), nocase_key(name)
+        index = bisect.bisect_left(entries, (folded,))
+        while index < len(entries) and entries[index][0] == folded:
+            if nocase_key(entries[index][1]) == key:
+                return index
+            index += 1
+        return None
+
+    def add(self, guild_id: int, name: str):
+        """登録された名前を反映する (読み込み前のサーバーは何もしない)"""
+        entries = self._entries.get(guild_id)
+        if entries is None:
+            if guild_id in self._loading:
+                self._dirty.add(guild_id)
+            return
+        if self._find(entries, name) is None:
+            bisect.insort(entries, (name.casefold(), name))
+
+    def remove(self, guild_id: int, name: str):
+        """削除された名前を反映する"""
+        entries = self._entries.get(guild_id)
+        if entries is None:
+            if guild_id in self._loading:
+                self._dirty.add(guild_id)
+            return
+        index = self._find(entries, name)
+        if index is not None:
+            del entries[index]
+
+    def forget(self, guild_id: int):
+        """サーバーのインデックスを破棄する (次回利用時に読み込み直す)"""
+        self._entries.pop(guild_id, None)
+        if guild_id in self._loading:
+            self._dirty.add(guild_id)
+
+    def clear(self):
+        """全サーバーのインデックスを破棄する"""
+        self._entries.clear()
+        self._dirty.update(self._loading)
+
+    async def complete(self, guild_id: int, prefix: str, limit: int = AUTOCOMPLETE_MAX_CHOICES) -> List[str]:
+        """prefix で始まる名前を最大 limit 件返す (大文字小文字は区別しない)"""
+        entries = await self._ensure(guild_id)
+        folded = prefix.casefold()
+        index = bisect.bisect_left(entries, (folded,))
+        names = []
+        while index < len(entries) and len(names) < limit and entries[index][0].startswith(folded):
+            names.append(entries[index][1])
+            index += 1
+        return names
+
+name_index = NameIndex(db)
+
+# --- 誕生日カレンダー ---
+
+CALENDAR_CHECK_INTERVAL_HOURS = 6 # カレンダーとDBの整合性を確認する間隔 (時間)
+CALENDAR_CHECK_YIELD_EVERY = 1000 # 整合性確認中、この件数のサーバーごとにイベントループへ制御を返す
+CALENDAR_LOAD_FETCH_SIZE = 5000 # カレンダー構築時に一度に読み出す行数
+
+# 月日 (MM*100+DD) -> カレンダーの枠番号 (うるう年の 01/01 を 0 とする通し番号、02/29 を含む366枠)
+MONTH_DAY_SLOTS = {to_month_day(day.strftime('%m/%d')): offset for offset, day in enumerate(datetime.date(2000, 1, 1) + datetime.timedelta(days=n) for n in range(366))}
+
+class CalendarEntry:
+    """カレンダー上の誕生日1件 (名前とメンション対象)"""
+
+    __slots__ = ('name', 'mention_user_id')
+
+    def __init__(self, name: str, mention_user_id: Optional[int]):
+        self.name = name
+        self.mention_user_id = mention_user_id
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CalendarEntry) and self.name == other.name and self.mention_user_id == other.mention_user_id
+
+    def __repr__(self) -> str:
+        return f"CalendarEntry({self.name!r}, {self.mention_user_id!r})"
+
+class BirthdayCalendar:
+    """担当サーバーの誕生日を366日分の枠に保持し、通知時にDBを読まずに誕生者を引くクラス
+
+    各枠は guild_id -> CalendarEntry のタプル (名前の NOCASE 順) の辞書。起動時にDBから1回だけ構築し、
+    以降は登録・メンション変更・削除・インポートのコミット成功後に差分を反映する。
+    ずれが生じていないかは check_consistency で定期的にDBと突き合わせ、違っていたサーバーだけ読み直す。
+    """
+
+    def __init__(self):
+        self._slots: List[dict[int, tuple[CalendarEntry, ...]]] = [{} for _ in range(366)]
+        self._size = 0
+        self._touched: set[int] = set() # 整合性確認中に更新されたサーバー (確認結果で上書きしない)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def load(conn: sqlite3.Connection, guild_id: Optional[int] = None) -> dict[int, dict[int, tuple[CalendarEntry, ...]]]:
+        """DBから guild_id -> {枠番号: エントリのタプル} を読み込む (guild_id を省略すると担当する全サーバー。退出したサーバーは除く)"""
+        cursor = conn.cursor()
+        cursor.row_factory = None # 行数が多いため sqlite3.Row ではなくタプルで受け取る
+        if guild_id is None:
+            cursor.execute("SELECT guild_id, birthday_md, display_name, mention_user_id FROM birthdays WHERE guild_id NOT IN (SELECT guild_id FROM removed_guilds) ORDER BY guild_id, birthday_md, display_name")
+        else:
+            cursor.execute("SELECT guild_id, birthday_md, display_name, mention_user_id FROM birthdays WHERE guild_id = ? ORDER BY birthday_md, display_name", (guild_id,))
+        guilds: dict[int, dict[int, tuple[CalendarEntry, ...]]] = {}
+        # 行は (guild_id, 月日, 名前) 順なので、同じ枠の行をまとめてからタプルにする (途中のリストを残さない)
+        # 担当サーバーかどうかの判定もサーバーが変わったときだけ行う
+        current_guild_id, current_md, days, entries = None, None, None, []
+        while True:
+            rows = cursor.fetchmany(CALENDAR_LOAD_FETCH_SIZE)
+            if not rows:
+                break
+            for row_guild_id, month_day, name, mention_user_id in rows:
+                if row_guild_id != current_guild_id or month_day != current_md:
+                    if entries:
+                        days[MONTH_DAY_SLOTS[current_md]] = tuple(entries)
+                        entries = []
+                    if row_guild_id != current_guild_id:
+                        current_guild_id = row_guild_id
+                        days = guilds.setdefault(row_guild_id, {}) if owns_guild(row_guild_id) else None
+                    current_md = month_day if days is not None and month_day in MONTH_DAY_SLOTS else None
+                if current_md is not None:
+                    entries.append(CalendarEntry(name, mention_user_id))
+        if entries:
+            days[MONTH_DAY_SLOTS[current_md]] = tuple(entries)
+        return guilds
+
+    def replace_all(self, guilds: dict[int, dict[int, tuple[CalendarEntry, ...]]]):
+        """load の結果でカレンダー全体を置き換える"""
+        slots: List[dict[int, tuple[CalendarEntry, ...]]] = [{} for _ in range(366)]
+        size = 0
+        for guild_id, days in guilds.items():
+            for slot, entries in days.items():
+                slots[slot][guild_id] = entries
+                size += len(entries)
+        self._slots = slots
+        self._size = size
+
+    def replace_guild(self, guild_id: int, days: Optional[dict[int, tuple[CalendarEntry, ...]]]):
+        """サーバー1つ分を load の結果で置き換える (days が None ならサーバーを消す)"""
+        self._touched.add(guild_id)
+        for slot in self._slots:
+            self._size -= len(slot.pop(guild_id, ()))
+        for slot, entries in (days or {}).items():
+            self._slots[slot][guild_id] = entries
+            self._size += len(entries)
+
+    def forget(self, guild_id: int):
+        self.replace_guild(guild_id, None)
+
+    def _find(self, guild_id: int, name: str, month_day: Optional[int] = None) -> tuple[Optional[dict], Optional[int]]:
+        """name と NOCASE で一致するエントリの (枠, 位置) を返す (month_day が分かっていればその枠だけを探す)"""
+        key, length = nocase_key(name), len(name)
+        slots = (self._slots[MONTH_DAY_SLOTS[month_day]],) if month_day in MONTH_DAY_SLOTS else self._slots
+        for slot in slots:
+            entries = slot.get(guild_id)
+            if entries:
+                for index, entry in enumerate(entries):
+                    # NOCASE は文字数を変えないため、長さが違う名前は変換せずに除外する
+                    if len(entry.name) == length and nocase_key(entry.name) == key:
+                        return slot, index
+        return None, None
+
+    def _delete(self, guild_id: int, slot: dict, index: int) -> CalendarEntry:
+        entries = slot[guild_id]
+        if len(entries) == 1:
+            del slot[guild_id]
+        else:
+            slot[guild_id] = entries[:index] + entries[index + 1:]
+        self._size -= 1
+        return entries[index]
+
+    def set(self, guild_id: int, name: str, month_day: int, mention_user_id: Optional[int], previous_month_day: Optional[int] = None, is_new: bool = False):
+        """登録・上書きを反映する (既存の名前は DB と同じく元の表記のまま残す)
+
+        上書き前の月日 (previous_month_day) や新規登録であること (is_new) が分かっていれば、全枠を探さずに済む。
+        """
+        if not owns_guild(guild_id):
+            return
+        self._touched.add(guild_id)
+        slot, index = (None, None) if is_new else self._find(guild_id, name, previous_month_day)
+        if slot is not None:
+            name = self._delete(guild_id, slot, index).name
+        target = self._slots[MONTH_DAY_SLOTS[month_day]]
+        entries = target.get(guild_id, ())
+        key = nocase_key(name)
+        low, high = 0, len(entries)
+        while low < high:
+            middle = (low + high) // 2
+            if nocase_key(entries[middle].name) < key:
+                low = middle + 1
+            else:
+                high = middle
+        target[guild_id] = entries[:low] + (CalendarEntry(name, mention_user_id),) + entries[low:]
+        self._size += 1
+
+    def set_mention(self, guild_id: int, name: str, mention_user_id: Optional[int]):
+        """メンション設定の変更を反映する"""
+        self._touched.add(guild_id)
+        slot, index = self._find(guild_id, name)
+        if slot is not None:
+            entries = slot[guild_id]
+            slot[guild_id] = entries[:index] + (CalendarEntry(entries[index].name, mention_user_id),) + entries[index + 1:]
+
+    def remove(self, guild_id: int, name: str):
+        """削除を反映する"""
+        self._touched.add(guild_id)
+        slot, index = self._find(guild_id, name)
+        if slot is not None:
+            self._delete(guild_id, slot, index)
+
+    def lookup(self, guild_id: int, month_day: int) -> tuple[CalendarEntry, ...]:
+        """サーバーのその月日の誕生者を返す (I/O なし)"""
+        return self._slots[MONTH_DAY_SLOTS[month_day]].get(guild_id, ())
+
+    async def check_consistency(self, database: AsyncDatabase) -> List[int]:
+        """DB と突き合わせ、内容が違っていたサーバーを DB の内容で直してその guild_id の一覧を返す
+
+        DB の読み込み後に更新されたサーバーは、更新の反映で最新になっているため比較しない。
+        """
+        self._touched = set()
+        snapshot = await database.read(self.load)
+        current: dict[int, dict[int, tuple[CalendarEntry, ...]]] = {}
+        for number, slot in enumerate(self._slots):
+            for guild_id, entries in slot.items():
+                current.setdefault(guild_id, {})[number] = entries
+        repaired = []
+        for count, guild_id in enumerate(set(snapshot) | set(current), start=1):
+            if guild_id not in self._touched:
+                days = snapshot.get(guild_id, {})
+                if current.get(guild_id, {}) != days:
+                    self.replace_guild(guild_id, days)
+                    repaired.append(guild_id)
+            if count % CALENDAR_CHECK_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+        return repaired
+
+birthday_calendar = BirthdayCalendar()
+metrics.Gauge('birthday_bot_calendar_entries', 'メモリ上の誕生日カレンダーの件数', function=lambda: len(birthday_calendar))
+
+gc_frozen = False # 最初のカレンダー構築後に gc.freeze() したか
+
+async def load_birthday_calendar():
+    """担当サーバーの誕生日をDBから読み込んでカレンダーを構築する (リーダーになるたびに読み直す)"""
+    global gc_frozen
+    started_at = time.perf_counter()
+    birthday_calendar.replace_all(await db.read(BirthdayCalendar.load))
+    if not gc_frozen:
+        # カレンダーは常駐するため、GC の世代別走査の対象から外す (件数が多いと以後の GC が毎回全件をたどってしまう)。
+        # 凍結した循環参照のゴミは回収されなくなるため、起動後の最初の構築で回収してから1回だけ行う
+        gc.collect()
+        gc.freeze()
+        gc_frozen = True
+    logger.info(f"誕生日カレンダーを構築しました ({len(birthday_calendar)} 件, {time.perf_counter() - started_at:.2f}秒)。")
+
+@tasks.loop(hours=CALENDAR_CHECK_INTERVAL_HOURS)
+async def calendar_consistency_check():
+    """誕生日カレンダーとDBの内容を定期的に突き合わせ、ずれていたサーバーを読み直すタスク"""
+    if calendar_consistency_check.current_loop == 0:
+        return # 起動直後は構築したばかりなので確認しない
+    started_at = time.perf_counter()
+    try:
+        repaired = await birthday_calendar.check_consistency(db)
+    except sqlite3.Error as e:
+        logger.error(f"誕生日カレンダーの整合性確認中にデータベースエラーが発生しました: {e}")
+        return
+    if repaired:
+        logger.warning(f"誕生日カレンダーがDBと一致しないサーバーを読み直しました: {reprlib.repr(repaired)} ({len(repaired)} サーバー)")
+    logger.info(f"誕生日カレンダーの整合性を確認しました ({len(birthday_calendar)} 件, {time.perf_counter() - started_at:.2f}秒)。")
+
+# --- メンバー解決 ---
+
+MEMBER_CACHE_SIZE = 10000 # 保持するメンバー情報の最大件数
+MEMBER_CACHE_TTL = 3600.0 # サーバーにいるメンバー情報の有効期間 (秒)
+MEMBER_NEGATIVE_TTL = 600.0 # サーバーにいないユーザー情報の有効期間 (秒)
+MEMBER_QUERY_BATCH = 100 # query_members で一度に指定できるユーザーID数の上限
+MEMBER_RESOLVE_TIMEOUT = 2.0 # 1回の解決にかける最大秒数 (インタラクションの応答期限に間に合わせる)
+
+class ResolvedUser:
+    """メンション対象ユーザーの解決結果 (表示名とサーバーに在籍しているか)"""
+
+    __slots__ = ('name', 'in_guild')
+
+    def __init__(self, name: Optional[str], in_guild: bool):
+        self.name = name
+        self.in_guild = in_guild
+
+class MemberResolver:
+    """登録されたメンション対象ユーザーだけを取得し、TTL 付き LRU キャッシュに保持するクラス
+
+    メンバーキャッシュを使わない構成でも、必要な人だけを query_members (members intent がない場合は
+    fetch_member) でまとめて取得する。サーバーにいないユーザーも短い期間キャッシュし、毎回問い合わせない。
+    """
+
+    def __init__(self, client: discord.Client, maxsize: int = MEMBER_CACHE_SIZE):
+        self._client = client
+        self._cache = LRUCache(maxsize) # (guild_id, user_id) -> (有効期限, ResolvedUser)
+
+    def invalidate(self, guild_id: int, user_id: int):
+        self._cache.pop((guild_id, user_id))
+
+    def _store(self, guild_id: int, user_id: int, resolved: ResolvedUser):
+        ttl = MEMBER_CACHE_TTL if resolved.in_guild else MEMBER_NEGATIVE_TTL
+        self._cache.put((guild_id, user_id), (time.monotonic() + ttl, resolved))
+
+    async def _fetch(self, guild: discord.Guild, user_ids: List[int]):
+        """user_ids を取得してキャッシュに格納する (途中で打ち切られても取得済みの分は残る)"""
+        found = set()
+        if self._client.intents.members:
+            for chunk in chunked(user_ids, MEMBER_QUERY_BATCH):
+                for member in await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False):
+                    self._store(guild.id, member.id, ResolvedUser(member.display_name, True))
+                    found.add(member.id)
+        else:
+            for user_id in user_ids:
+                try:
+                    member = await guild.fetch_member(user_id)
+                except discord.NotFound:
+                    continue
+                self._store(guild.id, user_id, ResolvedUser(member.display_name, True))
+                found.add(user_id)
+        for user_id in user_ids:
+            if user_id not in found:
+                user = self._client.get_user(user_id)
+                self._store(guild.id, user_id, ResolvedUser(user.name if user else None, False))
+
+    async def resolve(self, guild: discord.Guild, user_ids: List[int]) -> dict[int, ResolvedUser]:
+        """user_ids の解決結果を返す。取得に失敗・タイムアウトしたユーザーは結果に含めない"""
+        now = time.monotonic()
+        resolved: dict[int, ResolvedUser] = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            member = guild.get_member(user_id)
+            if member:
+                resolved[user_id] = ResolvedUser(member.display_name, True)
+                continue
+            entry = self._cache.get((guild.id, user_id))
+            if entry and entry[0] > now:
+                resolved[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+        if not missing:
+            return resolved
+        try:
+            await asyncio.wait_for(self._fetch(guild, missing), MEMBER_RESOLVE_TIMEOUT)
+        except (asyncio.TimeoutError, discord.HTTPException, discord.ClientException) as e:
+            logger.warning(f"サーバー {guild.id} のメンバー取得に失敗しました ({len(missing)}人): {e!r}")
+        for user_id in missing:
+            entry = self._cache.get((guild.id, user_id))
+            if entry:
+                resolved[user_id] = entry[1]
+        return resolved
+
+member_resolver = MemberResolver(bot)
+
+# --- 通知スケジューラ ---
+
+class AnnounceScheduler:
+    """サーバーごとの次回通知時刻 (UTC) をキーにした最小ヒープで通知対象を管理するクラス
+
+    設定変更時は世代番号を進めて新しいエントリを積み、古いエントリは取り出し時に読み捨てる。
+    1回の取り出しコストは期限を迎えたサーバー数にのみ比例する。
+    ヒープの各エントリは (起床時刻, 世代番号, guild_id, 本来の通知時刻) で、再試行エントリは
+    起床時刻だけを後ろにずらし、本来の通知時刻 (=通知対象の日付) を保ったまま積まれる。
+    """
+
+    MAX_SLEEP_SECONDS = 300 # 時計のずれに備えて、最長でもこの秒数ごとに起床する
+
+    def __init__(self):
+        self._heap: List[tuple[datetime.datetime, int, int, datetime.datetime]] = []
+        self._entries: dict[int, tuple[int, datetime.tzinfo, int, int]] = {} # guild_id -> (世代番号, タイムゾーン, 時, 分 (ローカル))
+        self._generation = 0
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def next_fire_time(tz: datetime.tzinfo, hour_local: int, minute_local: int, now: datetime.datetime, catch_up: datetime.timedelta = ANNOUNCE_FIRE_WINDOW) -> datetime.datetime:
+        """次の通知時刻 (UTC) を返す。直近の通知時刻から catch_up 以内であれば、その (過去の) 時刻を返す"""
+        today_local = now.astimezone(tz).date()
+        fire_times = [local_fire_time(tz, today_local + datetime.timedelta(days=days), hour_local, minute_local) for days in (-1, 0, 1)]
+        last_fire_at = max(fire_at for fire_at in fire_times if fire_at <= now)
+        if now - last_fire_at < catch_up:
+            return last_fire_at
+        return min(fire_at for fire_at in fire_times if fire_at > now)
+
+    @staticmethod
+    def following_fire_time(tz: datetime.tzinfo, hour_local: int, minute_local: int, fire_at: datetime.datetime) -> datetime.datetime:
+        """fire_at の翌日 (ローカル日付) の通知時刻 (UTC) を返す"""
+        next_day = fire_at.astimezone(tz).date() + datetime.timedelta(days=1)
+        return local_fire_time(tz, next_day, hour_local, minute_local)
+
+    def _push(self, wake_at: datetime.datetime, generation: int, guild_id: int, fire_at: datetime.datetime):
+        heapq.heappush(self._heap, (wake_at, generation, guild_id, fire_at))
+        self._changed.set()
+
+    def schedule(self, settings: GuildSettings, now: Optional[datetime.datetime] = None, catch_up: datetime.timedelta = ANNOUNCE_FIRE_WINDOW):
+        """サーバーの通知時刻を登録・更新する (他のプロセスが担当するシャードのサーバーは登録しない)"""
+        if not owns_guild(settings.guild_id):
+            return
+        hour_local, minute_local = settings.announce_time_local
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        self._generation += 1
+        self._entries[settings.guild_id] = (self._generation, settings.tz, hour_local, minute_local)
+        fire_at = self.next_fire_time(settings.tz, hour_local, minute_local, now, catch_up)
+        self._push(fire_at, self._generation, settings.guild_id, fire_at)
+
+    def schedule_retry(self, guild_id: int, fire_at: datetime.datetime, wake_at: datetime.datetime):
+        """fire_at 分の通知を wake_at に再試行する (設定が変更された場合は破棄される)"""
+        entry = self._entries.get(guild_id)
+        if entry is not None:
+            self._push(wake_at, entry[0], guild_id, fire_at)
+
+    def clear(self):
+        """すべてのサーバーをスケジュールから外す"""
+        self._entries.clear()
+        self._heap.clear()
+        self._changed.set()
+
+    def remove(self, guild_id: int):
+        """サーバーをスケジュールから外す (ヒープ上のエントリは取り出し時に破棄される)"""
+        if self._entries.pop(guild_id, None) is not None:
+            self._changed.set()
+
+    def _is_current(self, generation: int, guild_id: int) -> bool:
+        entry = self._entries.get(guild_id)
+        return entry is not None and entry[0] == generation
+
+    def seconds_until_next(self, now: datetime.datetime) -> Optional[float]:
+        """次の通知時刻までの秒数を返す。対象がなければ None"""
+        while self._heap and not self._is_current(self._heap[0][1], self._heap[0][2]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return (self._heap[0][0] - now).total_seconds()
+
+    def pop_due(self, now: datetime.datetime) -> List[tuple[int, datetime.datetime]]:
+        """起床時刻を迎えた (guild_id, 本来の通知時刻) を取り出し、通常エントリは翌日の同時刻に再登録する"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            wake_at, generation, guild_id, fire_at = heapq.heappop(self._heap)
+            if not self._is_current(generation, guild_id):
+                continue
+            due.append((guild_id, fire_at))
+            if wake_at == fire_at:
+                _, tz, hour_local, minute_local = self._entries[guild_id]
+                next_fire_at = self.following_fire_time(tz, hour_local, minute_local, fire_at)
+                heapq.heappush(self._heap, (next_fire_at, generation, guild_id, next_fire_at))
+        return due
+
+    async def wait_until_due(self):
+        """次の通知時刻まで、または設定が変更されるまで待機する"""
+        while True:
+            self._changed.clear()
+            delay = self.seconds_until_next(datetime.datetime.now(datetime.timezone.utc))
+            if delay is not None and delay <= 0:
+                return
+            timeout = self.MAX_SLEEP_SECONDS if delay is None else min(delay, self.MAX_SLEEP_SECONDS)
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+announce_scheduler = AnnounceScheduler()
+metrics.Gauge('birthday_bot_announce_scheduled_guilds', '通知スケジュールに登録されているサーバー数', function=lambda: len(announce_scheduler))
+
+def format_shards() -> str:
+    """担当シャードを表示用文字列にする"""
+    if SHARD_COUNT is None:
+        return "なし"
+    return f"{','.join(map(str, sorted(LOCAL_SHARD_IDS)))} / {SHARD_COUNT}"
+
+async def load_announce_schedule() -> bool:
+    """全サーバーの設定を読み込み、設定キャッシュと通知スケジューラを初期化する (リーダーになるたびに呼ぶ)"""
+    try:
+        await settings_cache.load_all()
+    except sqlite3.Error as e:
+        logger.error(f"通知スケジュール読み込み中のエラー: {e}")
+        return False
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    # 停止中・再接続中に通知時刻を過ぎたサーバーも、猶予時間内であれば取りこぼさず通知する (重複は台帳で防ぐ)
+    for settings in settings_cache.values():
+        announce_scheduler.schedule(settings, now_utc, catch_up=ANNOUNCE_CATCHUP_WINDOW)
+    logger.info(f"通知スケジュールを読み込みました ({len(announce_scheduler)} サーバー, 担当シャード: {format_shards()})。")
+    return True
+
+COMMAND_SYNC_HASH_FILE = 'command_sync.hash' # 最後に同期したコマンド定義のハッシュを保存するファイル
+
+def command_payload(command) -> dict:
+    """同期で送信されるコマンド1件の定義を返す"""
+    try:
+        return command.to_dict(bot.tree)
+    except TypeError:
+        # 古い discord.py v2.x の to_dict はコマンドツリーを引数に取らない
+        return command.to_dict()
+
+def command_tree_hash() -> str:
+    """同期で送信されるコマンド定義 (とアプリケーションID) のハッシュを返す"""
+    payload = {'application_id': bot.application_id, 'commands': [command_payload(command) for command in bot.tree.get_commands()]}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+async def sync_commands_if_changed():
+    """コマンド定義が前回の同期から変わった場合だけ、グローバルコマンドを同期する
+
+    同期はレート制限の厳しい HTTP 呼び出しのため、起動のたびには行わない。
+    FORCE_COMMAND_SYNC=1 を指定すると変更がなくても同期する。
+    """
+    current = command_tree_hash()
+    try:
+        with open(COMMAND_SYNC_HASH_FILE, encoding='utf-8') as f:
+            last = f.read().strip()
+    except OSError:
+        last = None
+    if current == last and os.getenv('FORCE_COMMAND_SYNC', '0') != '1':
+        logger.info("コマンド定義に変更がないため、同期を省略しました。")
         return
-    conn_check = get_db_connection()
-    if conn_check:
-        conn_check.close()
-        birthday_announce.start()
-        logger.info("誕生日通知タスクを開始しました。")
-    else:
-        logger.error("誕生日通知タスク開始前にデータベース接続を確認できませんでした。")
     try:
         synced = await bot.tree.sync()
         logger.info(f"Synced {len(synced)} commands")
     except Exception as e:
         logger.error(f"コマンド同期エラー: {e}")
+        return
+    try:
+        with open(COMMAND_SYNC_HASH_FILE, 'w', encoding='utf-8') as f:
+            f.write(current)
+    except OSError as e:
+        logger.warning(f"コマンド同期のハッシュを保存できませんでした: {e}")
+
+# --- 退出したサーバーの後片付けと DB 保守 ---
+
+GUILD_PURGE_GRACE_DAYS = int(os.getenv('GUILD_PURGE_GRACE_DAYS', '30')) # 退出したサーバーのデータを削除するまでの猶予日数 (その間に再参加すれば元に戻す)
+# DB保守を行う時刻 (UTC)。既定は日本時間の 3:00 (通知の少ない時間帯)
+MAINTENANCE_TIME_UTC = datetime.time(hour=int(os.getenv('MAINTENANCE_HOUR_UTC', '18')), tzinfo=datetime.timezone.utc)
+MAINTENANCE_VACUUM_PAGES = 1000 # 1回の書き込みで解放する空きページ数 (他の書き込みを長く待たせない)
+MAINTENANCE_ANALYSIS_LIMIT = 1000 # ANALYZE でインデックスごとに調べる行数の上限 (PRAGMA analysis_limit)
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2 # PRAGMA auto_vacuum の値
+# 起動時に既存のファイルを auto_vacuum = INCREMENTAL に切り替える (VACUUM でファイル全体を書き直し、その間は他の書き込みが
+# すべて待たされるため、保守のタスクでは行わない。他のレプリカを止めてから1回だけ指定して起動する)
+DB_CONVERT_AUTO_VACUUM = os.getenv('DB_CONVERT_AUTO_VACUUM') == '1'
+
+removed_guild_ids: set[int] = set() # 担当シャードのうち、退出して削除を待っているサーバー
+
+def mark_guilds_removed(conn: sqlite3.Connection, guild_ids: List[int]):
+    # 退出を繰り返しても最初に退出した日時から猶予期間を数える
+    now = utc_timestamp()
+    conn.executemany("INSERT INTO removed_guilds (guild_id, removed_at) VALUES (?, ?) ON CONFLICT(guild_id) DO NOTHING",
+                     [(guild_id, now) for guild_id in guild_ids])
+
+def unmark_guild_removed(conn: sqlite3.Connection, guild_id: int):
+    conn.execute("DELETE FROM removed_guilds WHERE guild_id = ?", (guild_id,))
+
+def forget_guild(guild_id: int):
+    """退出したサーバーをメモリ上の通知スケジュール・キャッシュから外す (DBの行は猶予期間中は残す)"""
+    removed_guild_ids.add(guild_id)
+    announce_scheduler.remove(guild_id)
+    settings_cache.forget(guild_id)
+    birthday_calendar.forget(guild_id)
+    name_index.forget(guild_id)
+    list_render_cache.forget(guild_id)
+
+async def remove_guild(guild_id: int):
+    """Botが退出したサーバーのデータを削除予定にする"""
+    try:
+        await db.write(mark_guilds_removed, [guild_id])
+    except sqlite3.Error as e:
+        # 記録できなくても通知の対象からは外す (次回起動時の確認で記録し直す)
+        logger.error(f"サーバー {guild_id} の退出を記録できませんでした: {e}")
+    forget_guild(guild_id)
+    logger.info(f"サーバー {guild_id} から退出しました。{GUILD_PURGE_GRACE_DAYS}日後にデータを削除します。")
+
+async def restore_guild(guild_id: int):
+    """削除予定のサーバーに再参加したとき、データを通知スケジュール・カレンダーに戻す"""
+    if guild_id not in removed_guild_ids:
+        return
+    try:
+        await db.write(unmark_guild_removed, guild_id)
+        settings = await settings_cache.reload(guild_id)
+        birthday_calendar.replace_guild(guild_id, (await db.read(BirthdayCalendar.load, guild_id)).get(guild_id))
+    except sqlite3.Error as e:
+        logger.error(f"サーバー {guild_id} のデータを復元できませんでした: {e}")
+        return
+    removed_guild_ids.discard(guild_id)
+    if settings is not None:
+        announce_scheduler.schedule(settings)
+    logger.info(f"サーバー {guild_id} に再参加したため、削除予定だったデータを復元しました。")
+
+def fetch_guild_membership(conn: sqlite3.Connection) -> tuple[List[int], List[int]]:
+    """(データのあるサーバー, 削除予定のサーバー) の guild_id 一覧を返す"""
+    known = [row[0] for row in conn.execute("SELECT guild_id FROM server_settings UNION SELECT guild_id FROM birthdays")]
+    removed = [row[0] for row in conn.execute("SELECT guild_id FROM removed_guilds")]
+    return known, removed
+
+async def reconcile_guild_membership():
+    """起動時、参加中のサーバーとDBを突き合わせる (停止中に退出・再参加したサーバーを反映する)"""
+    if not bot.guilds:
+        logger.warning("参加中のサーバーが取得できないため、退出したサーバーの確認を省略しました。")
+        return
+    try:
+        known, removed = await db.read(fetch_guild_membership)
+    except sqlite3.Error as e:
+        logger.error(f"退出したサーバーの確認中にデータベースエラーが発生しました: {e}")
+        return
+    removed_guild_ids.update(guild_id for guild_id in removed if owns_guild(guild_id))
+    for guild_id in [guild_id for guild_id in removed_guild_ids if bot.get_guild(guild_id) is not None]:
+        await restore_guild(guild_id)
+    missing = [guild_id for guild_id in known if owns_guild(guild_id) and guild_id not in removed_guild_ids and bot.get_guild(guild_id) is None]
+    if not missing:
+        return
+    try:
+        await db.write(mark_guilds_removed, missing)
+    except sqlite3.Error as e:
+        logger.error(f"停止中に退出したサーバーを記録できませんでした: {e}")
+        return
+    for guild_id in missing:
+        forget_guild(guild_id)
+    logger.info(f"停止中に退出したサーバーのデータを削除予定にしました: {reprlib.repr(missing)} ({len(missing)} サーバー)")
+
+def fetch_expired_guilds(conn: sqlite3.Connection, grace_days: int) -> List[int]:
+    return [row[0] for row in conn.execute("SELECT guild_id FROM removed_guilds WHERE removed_at < datetime('now', ?)", (f'-{grace_days} days',))]
+
+def purge_guild(conn: sqlite3.Connection, guild_id: int):
+    """サーバーのデータをすべて削除する (猶予期間中に再参加していれば何もしない)"""
+    if conn.execute("DELETE FROM removed_guilds WHERE guild_id = ?", (guild_id,)).rowcount == 0:
+        return
+    conn.execute("DELETE FROM birthdays WHERE guild_id = ?", (guild_id,))
+    conn.execute("DELETE FROM server_settings WHERE guild_id = ?", (guild_id,))
+    conn.execute("DELETE FROM announce_ledger WHERE guild_id = ?", (guild_id,))
+
+def convert_auto_vacuum(conn: sqlite3.Connection) -> bool:
+    """既存のファイルを VACUUM で作り直して auto_vacuum = INCREMENTAL に切り替え、切り替えた場合は True を返す"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == SQLITE_AUTO_VACUUM_INCREMENTAL:
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+def incremental_vacuum(conn: sqlite3.Connection, pages: int) -> tuple[int, int]:
+    """空きページを最大 pages ページ解放し、(解放したページ数, 残りの空きページ数) を返す"""
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != SQLITE_AUTO_VACUUM_INCREMENTAL:
+        logger.warning(f"データベースが auto_vacuum = INCREMENTAL ではないため、空きページ ({before} ページ) を解放できません。"
+                       "DB_CONVERT_AUTO_VACUUM=1 を指定して1回だけ起動すると切り替わります。")
+        return 0, before
+    # 1ステップで1ページずつ解放されるため、最後まで実行する
+    conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+    after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return before - after, after
+
+def optimize_database(conn: sqlite3.Connection):
+    """統計情報を更新し、WAL ファイルを切り詰める"""
+    conn.execute(f"PRAGMA analysis_limit = {MAINTENANCE_ANALYSIS_LIMIT}")
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+async def run_database_maintenance() -> tuple[int, int]:
+    """猶予期間を過ぎたサーバーのデータを削除してから DB を縮小・最適化し、(削除したサーバー数, 解放したページ数) を返す"""
+    expired = await db.read(fetch_expired_guilds, GUILD_PURGE_GRACE_DAYS)
+    # コマンドの書き込みを長く待たせないよう、サーバーごとに別のトランザクションで削除する
+    for guild_id in expired:
+        await db.write(purge_guild, guild_id)
+        removed_guild_ids.discard(guild_id)
+    freed = 0
+    while True:
+        released, remaining = await db.write(incremental_vacuum, MAINTENANCE_VACUUM_PAGES)
+        freed += released
+        if not released or not remaining:
+            break
+    await db.write(optimize_database)
+    return len(expired), freed
+
+@tasks.loop(time=MAINTENANCE_TIME_UTC)
+async def database_maintenance():
+    """毎日、通知の少ない時間帯に退出したサーバーのデータを削除し、DB を縮小・最適化するタスク"""
+    started_at = time.perf_counter()
+    try:
+        purged, freed = await run_database_maintenance()
+    except sqlite3.Error as e:
+        logger.error(f"DB保守中にデータベースエラーが発生しました: {e}")
+        return
+    logger.info(f"DB保守が完了しました (削除したサーバー: {purged}, 解放したページ: {freed}, {time.perf_counter() - started_at:.2f}秒)。")
+
+# --- バックアップ ---
+
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '24')) # スナップショットを作成する間隔 (時間)。0 で無効
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups') # スナップショットの保存先
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7')) # 残すスナップショットの数
+backup_manager = backup.BackupManager(DB_NAME, BACKUP_DIR, BACKUP_KEEP)
+BACKUP_LAST_SUCCESS = metrics.Gauge('birthday_bot_backup_last_success_timestamp_seconds', '最後にバックアップと確認に成功した時刻 (UNIX 時間)')
+
+def latest_backup_age() -> Optional[float]:
+    """最新のスナップショットが作成されてからの秒数を返す (なければ None)"""
+    snapshots = backup_manager.snapshots()
+    return time.time() - os.path.getmtime(snapshots[-1]) if snapshots else None
+
+@tasks.loop(hours=BACKUP_INTERVAL_HOURS or 24)
+async def database_backup():
+    """稼働中のデータベースのスナップショットを定期的に作成し、開き直して確認するタスク"""
+    started_at = time.perf_counter()
+    try:
+        # ディレクトリの一覧取得もファイル削除 (create 内のローテーション) もイベントループの外で行う
+        age = await asyncio.to_thread(latest_backup_age)
+        if age is not None and age < BACKUP_INTERVAL_HOURS * 3600 * 0.9:
+            return # 再起動のたびに作成しない (前回から間隔の9割以上経っていれば作成する)
+        path, checksum = await backup_manager.create()
+        ok, detail = await asyncio.to_thread(backup.verify_snapshot, path)
+    except (sqlite3.Error, OSError, RuntimeError) as e:
+        logger.error(f"バックアップの作成に失敗しました: {e}")
+        return
+    if not ok:
+        logger.error(f"作成したバックアップ {path} の確認に失敗しました: {detail}")
+        return
+    BACKUP_LAST_SUCCESS.set(time.time())
+    logger.info(f"バックアップを作成しました: {path} ({detail}, SHA-256 {checksum[:12]}…, {time.perf_counter() - started_at:.2f}秒)。")
+
+# --- リーダー選出 (複数レプリカ) ---
+
+# リーダー権の有効期間 (秒)。リーダーが停止すると、最大でこの時間 + 更新間隔のうちに他のレプリカが引き継ぐ
+LEASE_TTL_SECONDS = float(os.getenv('LEASE_TTL_SECONDS', '15'))
+LEASE_RENEW_SECONDS = LEASE_TTL_SECONDS / 3 # リーダー権を更新する間隔 (1回更新に失敗しても期限までに再試行できる)
+# レプリカの識別子 (既定はホスト名・プロセスID・乱数。再起動すると別のレプリカとして扱う)
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}:{os.getpid()}:{random.getrandbits(32):08x}"
+# 同じシャードを担当するレプリカどうしでだけ権利を取り合う
+ANNOUNCE_LEASE_NAME = f"announce:{','.join(map(str, sorted(LOCAL_SHARD_IDS)))}/{SHARD_COUNT or 1}"
+
+class LeaderLease:
+    """DB上の有効期限付きの権利 (リース) で、同じシャードを担当するレプリカのうち1つだけをリーダーにするクラス
+
+    リーダーは renew で期限を延ばし続け、期限が切れた権利は他のレプリカが取得できる。新しく取得するたびに
+    全リースを通して単調に増えるトークン (フェンシングトークン) が振られ、通知台帳には通知権を取ったリーダーの
+    トークンを記録する。手元の期限は DB に書いた期限より前に切れるように数えるため、停止から復帰した
+    元リーダーが、引き継いだリーダーと同時に自分をリーダーだと思うことはない。
+    """
+
+    def __init__(self, database: AsyncDatabase, name: str, holder: str, ttl: float):
+        self._db = database
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.token: Optional[int] = None # 保持中 (または最後に保持した) 権利のトークン
+        self.current_holder: Optional[str] = None # 最後に確認した権利の保持者
+        self.current_expires_at = 0.0 # 最後に確認した権利の期限 (time.time)
+        self._valid_until = 0.0 # この時刻 (time.monotonic) まではリーダー
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    @property
+    def other_leader_alive(self) -> bool:
+        """他のレプリカがリーダーとして動いているはずなら True (期限切れ後も、相手が気づいて止まるまでの更新間隔分は含める)"""
+        return self.current_holder not in (None, self.holder) and time.time() < self.current_expires_at + self.ttl / 3
+
+    @staticmethod
+    def _acquire(conn: sqlite3.Connection, name: str, holder: str, token: Optional[int], ttl: float, renewing: bool) -> tuple[str, int, float, float]:
+        """権利を更新・取得し、(保持者, トークン, 期限, 確認した時刻 (time.monotonic)) を返す
+
+        renewing はこのレプリカが手元の期限内 (リーダーのまま) で更新する場合 True。
+        """
+        # 確認と更新の間に他のレプリカが取得しないよう、書き込みロックを取ってから確認する
+        conn.execute("BEGIN IMMEDIATE")
+        # ライタースレッドの待ち時間を除いて、期限を書き込むのと同じ時点から手元の期限を数える
+        checked_at = time.monotonic()
+        now = time.time()
+        row = conn.execute("SELECT holder, token, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        if row is not None and row['holder'] != holder and row['expires_at'] > now:
+            return row['holder'], row['token'], row['expires_at'], checked_at
+        if not renewing or row is None or row['holder'] != holder or row['token'] != token or row['expires_at'] <= now:
+            # 期限内の更新以外は、同じレプリカが期限切れ・手放した後に取り直す場合 (再起動後を含む) も新しいトークンを振る。
+            # 前の期間に取得したまま残った通知台帳の行を、新しいトークンで取り直せるようにするため
+            token = conn.execute("SELECT coalesce(max(token), 0) + 1 FROM leases").fetchone()[0]
+        conn.execute("""
+            INSERT INTO leases (name, holder, token, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, token = excluded.token, expires_at = excluded.expires_at
+            """, (name, holder, token, now + ttl))
+        return holder, token, now + ttl, checked_at
+
+    @staticmethod
+    def _release(conn: sqlite3.Connection, name: str, holder: str):
+        # 行は消さずに期限だけ切る (トークンが巻き戻らないように)
+        conn.execute("UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?", (name, holder))
+
+    async def renew(self) -> bool:
+        """権利を更新 (持っていなければ取得を試み)、リーダーかどうかを返す"""
+        holder, token, expires_at, checked_at = await self._db.write(self._acquire, self.name, self.holder, self.token, self.ttl, self.is_leader)
+        self.current_holder = holder
+        self.current_expires_at = expires_at
+        if holder == self.holder:
+            self.token = token
+            self._valid_until = checked_at + self.ttl
+        else:
+            self._valid_until = 0.0
+        return self.is_leader
+
+    async def release(self):
+        """権利を手放し、他のレプリカがすぐに引き継げるようにする"""
+        self._valid_until = 0.0
+        await self._db.write(self._release, self.name, self.holder)
+
+    def release_now(self):
+        """停止時に同期的に権利を手放す (イベントループの終了後に呼ぶ)"""
+        if self.token is None:
+            return
+        conn = get_db_connection()
+        if conn is None:
+            return
+        try:
+            self._release(conn, self.name, self.holder)
+            conn.commit()
+            logger.info("リーダー権を手放しました。")
+        except sqlite3.Error as e:
+            logger.warning(f"リーダー権を手放せませんでした (期限切れで他のレプリカが引き継ぎます): {e}")
+        finally:
+            conn.close()
+
+leader_lease = LeaderLease(db, ANNOUNCE_LEASE_NAME, REPLICA_ID, LEASE_TTL_SECONDS)
+leading = False # リーダーとして通知などの定期タスクを動かしているか
+leading_token: Optional[int] = None # リーダーとして通知を始めたときのトークン
+metrics.Gauge('birthday_bot_leader', 'このレプリカがリーダーなら 1', function=lambda: int(leading and leader_lease.is_leader))
+
+def leader_tasks() -> List[tasks.Loop]:
+    """リーダーだけが動かす定期タスク"""
+    loops = [calendar_consistency_check, birthday_announce]
+    if 0 in LOCAL_SHARD_IDS:
+        # DB保守・バックアップはファイル全体が対象のため、複数プロセスで動かす場合もシャード0の担当プロセスだけが行う
+        loops.append(database_maintenance)
+        if BACKUP_INTERVAL_HOURS > 0:
+            loops.append(database_backup)
+    return loops
+
+def start_leader_task(loop: tasks.Loop):
+    if not loop.is_running():
+        loop.start()
+        return
+    # step_down で止めたタスクがまだ終わっていなければ、終わってから開始する
+    loop.get_task().add_done_callback(lambda _: leading and not loop.is_running() and loop.start())
+
+async def become_leader():
+    """リーダーとして通知を引き継ぐ (カレンダー・設定をDBから読み直し、通知スケジュールを作り直して定期タスクを開始する)"""
+    global leading, leading_token
+    # スタンバイ中に他のレプリカが書き込んだ内容を反映するため、メモリ上のキャッシュを捨てて読み直す
+    settings_cache.clear()
+    name_index.clear()
+    list_render_cache.clear()
+    announce_scheduler.clear()
+    await load_birthday_calendar()
+    # 以前のリーダー (前の期間のこのレプリカを含む) が通知しきれなかった分も、取り戻し猶予時間内なら通知し直す
+    if not await load_announce_schedule():
+        logger.error("通知スケジュールを読み込めませんでした。設定変更されたサーバーのみ通知対象になります。")
+    leading = True
+    leading_token = leader_lease.token
+    for loop in leader_tasks():
+        start_leader_task(loop)
+    logger.info(f"リーダーになりました (レプリカ: {REPLICA_ID}, トークン: {leader_lease.token})。誕生日通知タスクを開始しました。")
+
+def step_down():
+    """リーダー権を失ったとき、定期タスクを止めてスタンバイに戻る (送信中だった通知は新しいリーダーが引き継ぐ)"""
+    global leading
+    leading = False
+    for loop in leader_tasks():
+        loop.cancel()
+    announce_scheduler.clear()
+    birthday_calendar.replace_all({})
+    logger.warning(f"リーダー権を失いました (現在の保持者: {leader_lease.current_holder})。通知を停止し、スタンバイに戻ります。")
+
+@tasks.loop(seconds=LEASE_RENEW_SECONDS)
+async def leader_heartbeat():
+    """リーダー権を定期的に更新・取得し、リーダーの交代に合わせて通知を開始・停止するタスク"""
+    try:
+        await leader_lease.renew()
+    except sqlite3.Error as e:
+        logger.warning(f"リーダー権を更新できませんでした: {e}")
+    if leading and leader_lease.is_leader and leader_lease.token != leading_token:
+        # 期限切れの後に取り直して新しいトークンになった場合は、前の期間の通知をやめ、新しいトークンで通知し直す
+        logger.warning(f"リーダー権の期限が切れた後に取り直しました (トークン: {leading_token} → {leader_lease.token})。")
+        step_down()
+    if leader_lease.is_leader and not leading:
+        try:
+            await become_leader()
+        except sqlite3.Error as e:
+            logger.error(f"誕生日カレンダーを構築できなかったため、リーダーを辞退します: {e}")
+            try:
+                await leader_lease.release()
+            except sqlite3.Error:
+                pass
+    elif leading and not leader_lease.is_leader:
+        step_down()
+
+# --- Botイベント ---
+
+@bot.event
+async def setup_hook():
+    """ログイン後・ゲートウェイ接続前に1回だけ行う初期化 (再接続時の on_ready では何もしない)"""
+    try:
+        await db.write(setup_database)
+    except sqlite3.Error as e:
+        logger.error(f"データベースセットアップ中のエラー: {e}")
+        logger.critical("データベースのセットアップに失敗しました。Botを停止します。")
+        raise
+    if DB_CONVERT_AUTO_VACUUM:
+        # リーダー権を取る前に行う (書き直しの間はリーダー権を更新できないため)
+        logger.info("データベースを auto_vacuum = INCREMENTAL に切り替えます (VACUUM)。ファイルが大きい場合は時間がかかります。")
+        started_at = time.perf_counter()
+        try:
+            if await db.write(convert_auto_vacuum):
+                logger.info(f"データベースを auto_vacuum = INCREMENTAL に切り替えました ({time.perf_counter() - started_at:.1f}秒)。")
+            else:
+                logger.info("データベースは既に auto_vacuum = INCREMENTAL です。DB_CONVERT_AUTO_VACUUM の指定は不要です。")
+        except sqlite3.Error as e:
+            logger.error(f"auto_vacuum の切り替えに失敗しました: {e}")
+    # 他のレプリカがリーダーでなければ、ゲートウェイに接続する前にリーダーとして通知の準備を済ませる
+    try:
+        if await leader_lease.renew():
+            await become_leader()
+    except sqlite3.Error as e:
+        logger.critical(f"リーダー権の確認または誕生日カレンダーの構築に失敗しました。Botを停止します: {e}")
+        raise
+    if not leading:
+        logger.info(f"他のレプリカ ({leader_lease.current_holder}) がリーダーのため、スタンバイとして起動します。")
+    leader_heartbeat.start()
+    await sync_commands_if_changed()
+    if METRICS_PORT:
+        try:
+            await metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+            logger.info(f"メトリクスを http://{METRICS_HOST}:{METRICS_PORT}/metrics で公開しました。")
+        except OSError as e:
+            logger.error(f"メトリクス用 HTTP サーバーを起動できませんでした: {e}")
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command: app_commands.Command):
+    record_command_latency(interaction, 'ok')
+
+@bot.event
+async def on_ready():
+    logger.info(f'{bot.user} が起動しました')
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    await remove_guild(guild.id)
+
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    await restore_guild(guild.id)
+
+@bot.event
+async def on_guild_available(guild: discord.Guild):
+    await restore_guild(guild.id)
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    member_resolver.invalidate(member.guild.id, member.id)
+
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    member_resolver.invalidate(payload.guild_id, payload.user.id)
 
 # --- スラッシュコマンド ---
 
@@ -179,86 +1854,68 @@ async def set_announce_channel(interaction: discord.Interaction, channel: discor
     """誕生日通知チャンネルを設定するコマンド"""
     guild_id = interaction.guild_id
     announce_channel_id = channel.id
-    conn = None
+
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
-            return
-        cursor = conn.cursor()
-        # 既存の設定を維持
-        cursor.execute("SELECT announce_hour_utc, announce_minute_utc, announce_timezone_offset, announce_message_template FROM server_settings WHERE guild_id = ?", (guild_id,))
-        current_settings = cursor.fetchone()
-        hour_utc = current_settings['announce_hour_utc'] if current_settings else None
-        minute_utc = current_settings['announce_minute_utc'] if current_settings else None
-        offset = current_settings['announce_timezone_offset'] if current_settings else None
-        template = current_settings['announce_message_template'] if current_settings else None
-        cursor.execute(
-            """
-            INSERT OR REPLACE INTO server_settings
-            (guild_id, announce_channel_id, announce_hour_utc, announce_minute_utc, announce_timezone_offset, announce_message_template)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (guild_id, announce_channel_id, hour_utc, minute_utc, offset, template), )
-        conn.commit()
-        logger.info(f'サーバー {interaction.guild.name} (ID: {guild_id}) の通知チャンネルを {channel.name} (ID: {announce_channel_id}) に設定しました。')
-        await interaction.response.send_message(f'誕生日をお知らせするチャンネルを {channel.mention} に設定しました。')
+        settings = await settings_cache.update(guild_id, announce_channel_id=announce_channel_id)
     except sqlite3.Error as e:
         logger.error(f"set_announce_channel コマンドエラー (Guild: {guild_id}): {e}")
-        if conn:
-            conn.rollback()
         await interaction.response.send_message("データベースエラーが発生しました。設定を保存できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+        return
+    announce_scheduler.schedule(settings)
+    logger.info(f'サーバー {interaction.guild.name} (ID: {guild_id}) の通知チャンネルを {channel.name} (ID: {announce_channel_id}) に設定しました。')
+    await interaction.response.send_message(f'誕生日をお知らせするチャンネルを {channel.mention} に設定しました。')
+
+TIMEZONE_NAMES = sorted(available_timezones())
 
 @bot.tree.command(name='set_announce_time', description='誕生日をお知らせする時刻とタイムゾーンを設定します')
-@app_commands.describe( hour='通知時刻 (時, 0-23)', minute='通知時刻 (分, 0-59)', utc_offset=f'UTCからの時差 (-12.0 ~ +14.0)。例: JSTなら9.0。省略時: {DEFAULT_TIMEZONE_OFFSET:+}')
+@app_commands.describe( hour='通知時刻 (時, 0-23)', minute='通知時刻 (分, 0-59)', utc_offset=f'UTCからの時差 (-12.0 ~ +14.0)。例: JSTなら9.0。省略時: {DEFAULT_TIMEZONE_OFFSET:+}',
+                        timezone='(任意) IANA タイムゾーン名。例: Asia/Tokyo, America/New_York。指定すると夏時間も考慮され、utc_offset より優先されます')
 @app_commands.checks.has_permissions(manage_guild=True)
-async def set_announce_time(interaction: discord.Interaction, hour: app_commands.Range[int, 0, 23], minute: app_commands.Range[int, 0, 59], utc_offset: Optional[app_commands.Range[float, -12.0, 14.0]] = None):
+async def set_announce_time(interaction: discord.Interaction, hour: app_commands.Range[int, 0, 23], minute: app_commands.Range[int, 0, 59], utc_offset: Optional[app_commands.Range[float, -12.0, 14.0]] = None, timezone: Optional[str] = None):
     """誕生日通知時刻を設定するコマンド"""
     guild_id = interaction.guild_id
-    effective_offset = utc_offset if utc_offset is not None else DEFAULT_TIMEZONE_OFFSET
-    hour_utc, minute_utc = convert_local_to_utc(hour, minute, effective_offset)
-    conn = None
-    try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
+    if timezone:
+        try:
+            tz = ZoneInfo(timezone)
+        except (ZoneInfoNotFoundError, ValueError):
+            await interaction.response.send_message(f'タイムゾーン `{timezone}` が見つかりません。`Asia/Tokyo` のような IANA タイムゾーン名で入力してください。', ephemeral=True)
             return
-        cursor = conn.cursor()
-        # 既存のチャンネル・メッセージ設定を維持
-        cursor.execute("SELECT announce_channel_id, announce_message_template FROM server_settings WHERE guild_id = ?", (guild_id,))
-        current_settings = cursor.fetchone()
-        if not current_settings or not current_settings['announce_channel_id']:
+        # 表示・互換用に現在の時差も保存しておく
+        effective_offset = datetime.datetime.now(tz).utcoffset().total_seconds() / 3600
+    else:
+        effective_offset = utc_offset if utc_offset is not None else DEFAULT_TIMEZONE_OFFSET
+        tz = resolve_timezone(None, effective_offset)
+    hour_utc, minute_utc = convert_local_to_utc(hour, minute, tz)
+
+    try:
+        current_settings = await settings_cache.get(guild_id)
+        if not current_settings or not current_settings.announce_channel_id:
             await interaction.response.send_message("先に `/set_announce_channel` で通知チャンネルを設定してください。", ephemeral=True)
             return
-        announce_channel_id = current_settings['announce_channel_id']
-        template = current_settings['announce_message_template'] if current_settings else None
-        cursor.execute(
-            """
-            INSERT OR REPLACE INTO server_settings
-            (guild_id, announce_channel_id, announce_hour_utc, announce_minute_utc, announce_timezone_offset, announce_message_template)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (guild_id, announce_channel_id, hour_utc, minute_utc, effective_offset, template), )
-        conn.commit()
-        local_time_str = f"{hour:02}:{minute:02}"
-        timezone_str = format_offset(effective_offset)
-        utc_time_str = f"{hour_utc:02}:{minute_utc:02} UTC"
-        logger.info(f'サーバー {interaction.guild.name} (ID: {guild_id}) の通知時刻を {local_time_str} ({timezone_str}) / {utc_time_str} に設定しました。')
-        await interaction.response.send_message(f'誕生日をお知らせする時刻を **{local_time_str} ({timezone_str})** ({utc_time_str}) に設定しました。')
+        saved = await settings_cache.update(guild_id, announce_hour_local=hour, announce_minute_local=minute, announce_timezone=timezone or None,
+                                            announce_hour_utc=hour_utc, announce_minute_utc=minute_utc, announce_timezone_offset=effective_offset)
     except sqlite3.Error as e:
         logger.error(f"set_announce_time コマンドエラー (Guild: {guild_id}): {e}")
-        if conn:
-            conn.rollback()
         await interaction.response.send_message("データベースエラーが発生しました。時刻を設定できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+        return
+    if not saved:
+        await interaction.response.send_message("先に `/set_announce_channel` で通知チャンネルを設定してください。", ephemeral=True)
+        return
+    announce_scheduler.schedule(saved)
+    local_time_str = f"{hour:02}:{minute:02}"
+    timezone_str = format_timezone(timezone, effective_offset)
+    utc_time_str = f"{hour_utc:02}:{minute_utc:02} UTC"
+    logger.info(f'サーバー {interaction.guild.name} (ID: {guild_id}) の通知時刻を {local_time_str} ({timezone_str}) / {utc_time_str} に設定しました。')
+    await interaction.response.send_message(f'誕生日をお知らせする時刻を **{local_time_str} ({timezone_str})** ({utc_time_str}) に設定しました。')
+
+@set_announce_time.autocomplete('timezone')
+async def timezone_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    current = current.lower()
+    matches = [name for name in TIMEZONE_NAMES if current in name.lower()]
+    return [app_commands.Choice(name=name, value=name) for name in matches[:AUTOCOMPLETE_MAX_CHOICES]]
 
 @bot.tree.command(name='set_announce_message', description='誕生日通知メッセージのテンプレートを設定します (<name>で名前が入ります)')
-@app_commands.describe(template='メッセージテンプレート文字列。例:「今日は<name>さんの誕生日！🎉」')
+@app_commands.describe(template='メッセージテンプレート文字列。例:「今日は<name>さんの誕生日！🎉 {mentions}」')
 @app_commands.checks.has_permissions(manage_guild=True)
 async def set_announce_message(interaction: discord.Interaction, template: str):
     """誕生日通知メッセージのテンプレートを設定するコマンド"""
@@ -267,103 +1924,79 @@ async def set_announce_message(interaction: discord.Interaction, template: str):
     if len(template) > 1000:
         await interaction.response.send_message("メッセージテンプレートが長すぎます。1000文字以内で設定してください。", ephemeral=True)
         return
-
-    conn = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
-            return
-        cursor = conn.cursor()
+        compiled = compile_template(template)
+    except TemplateError as e:
+        await interaction.response.send_message(f"メッセージテンプレートを設定できません。{e}", ephemeral=True)
+        return
 
-        # 既存のチャンネル・時刻・オフセット設定を維持
-        cursor.execute("SELECT announce_channel_id, announce_hour_utc, announce_minute_utc, announce_timezone_offset FROM server_settings WHERE guild_id = ?", (guild_id,))
-        current_settings = cursor.fetchone()
-        if not current_settings or not current_settings['announce_channel_id']:
+    try:
+        current_settings = await settings_cache.get(guild_id)
+        if not current_settings or not current_settings.announce_channel_id:
             await interaction.response.send_message("先に `/set_announce_channel` で通知チャンネルを設定してください。", ephemeral=True)
             return
-        announce_channel_id = current_settings['announce_channel_id']
-        hour_utc = current_settings['announce_hour_utc']
-        minute_utc = current_settings['announce_minute_utc']
-        offset = current_settings['announce_timezone_offset']
-
-        # メッセージテンプレートを更新
-        cursor.execute(
-            """
-            INSERT OR REPLACE INTO server_settings
-            (guild_id, announce_channel_id, announce_hour_utc, announce_minute_utc, announce_timezone_offset, announce_message_template)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (guild_id, announce_channel_id, hour_utc, minute_utc, offset, template), )
-        conn.commit()
-
-        logger.info(f'サーバー {interaction.guild.name} (ID: {guild_id}) の通知メッセージテンプレートを設定しました: {template}')
-        embed = discord.Embed(title="通知メッセージテンプレート設定完了", description=f"以下のテンプレートを設定しました。\n`<name>`の部分は実際の誕生者の名前に置き換わります。", color=discord.Color.green())
-        embed.add_field(name="設定されたテンプレート", value=f"```{template}```", inline=False)
-        await interaction.response.send_message(embed=embed)
-
+        saved = await settings_cache.update(guild_id, announce_message_template=template)
     except sqlite3.Error as e:
         logger.error(f"set_announce_message コマンドエラー (Guild: {guild_id}): {e}")
-        if conn:
-            conn.rollback()
         await interaction.response.send_message("データベースエラーが発生しました。メッセージテンプレートを設定できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+        return
+    if not saved:
+        await interaction.response.send_message("先に `/set_announce_channel` で通知チャンネルを設定してください。", ephemeral=True)
+        return
+
+    announce_templates.put((guild_id, template), compiled)
+    logger.info(f'サーバー {interaction.guild.name} (ID: {guild_id}) の通知メッセージテンプレートを設定しました: {template}')
+    embed = discord.Embed(title="通知メッセージテンプレート設定完了", description=f"以下のテンプレートを設定しました。\n`<name>`の部分は実際の誕生者の名前に置き換わります。", color=discord.Color.green())
+    embed.add_field(name="設定されたテンプレート", value=f"```{template}```", inline=False)
+    embed.add_field(name="使えるプレースホルダー", value="\n".join(f"`{{{name}}}`: {label}" for name, label in TEMPLATE_FIELDS.items()), inline=False)
+    await interaction.response.send_message(embed=embed)
 
 
 @bot.tree.command(name="check_settings", description="現在の通知チャンネル・時刻・メッセージの設定を確認します。")
 async def check_settings(interaction: discord.Interaction):
     """現在の通知設定を確認するコマンド"""
     guild_id = interaction.guild_id
-    conn = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
-            return
-        cursor = conn.cursor()
-        cursor.execute('SELECT announce_channel_id, announce_hour_utc, announce_minute_utc, announce_timezone_offset, announce_message_template FROM server_settings WHERE guild_id = ?', (guild_id,))
-        settings = cursor.fetchone()
-        if not settings or not settings['announce_channel_id']:
-            await interaction.response.send_message("通知チャンネルが設定されていません。 `/set_announce_channel` で設定してください。", ephemeral=True)
-            return
+        settings = await settings_cache.get(guild_id)
+    except sqlite3.Error as e:
+        logger.error(f"check_settings コマンドエラー (Guild: {guild_id}): {e}")
+        await interaction.response.send_message("データベースエラーが発生しました。設定を確認できませんでした。", ephemeral=True)
+        return
+    if not settings or not settings.announce_channel_id:
+        await interaction.response.send_message("通知チャンネルが設定されていません。 `/set_announce_channel` で設定してください。", ephemeral=True)
+        return
+
+    channel_id = settings.announce_channel_id
+    message_template = settings.announce_message_template
 
-        channel_id = settings['announce_channel_id']
-        hour_utc = settings['announce_hour_utc']
-        minute_utc = settings['announce_minute_utc']
-        offset = settings['announce_timezone_offset']
-        message_template = settings['announce_message_template']
-
-        channel = bot.get_channel(channel_id) or (interaction.guild and interaction.guild.get_channel(channel_id))
-        channel_mention = channel.mention if channel else f"不明なチャンネル (ID: {channel_id})"
-
-        local_time_str = convert_utc_to_local_str(hour_utc, minute_utc, offset)
-        timezone_str = format_offset(offset)
-        utc_hour_for_display = hour_utc if hour_utc is not None else DEFAULT_ANNOUNCE_HOUR_UTC
-        utc_minute_for_display = minute_utc if minute_utc is not None else DEFAULT_ANNOUNCE_MINUTE_UTC
-        utc_time_str = f"{utc_hour_for_display:02}:{utc_minute_for_display:02} UTC"
-        time_info = f"通知時刻: **{local_time_str} ({timezone_str})** ({utc_time_str})"
-        if offset is None and (hour_utc is None or minute_utc is None):
-            time_info += " (デフォルト)"
-
-        if message_template:
-            template_info = f"通知メッセージ:\n```\n{message_template}\n```"
-        else:
-            default_display = DEFAULT_ANNOUNCE_MESSAGE.replace("{today_date}", "日付").replace("{names}", "<名前>").replace("{mentions}", "[メンション]")
-            template_info = f"通知メッセージ: デフォルト\n```\n{default_display}\n```"
+    channel = bot.get_channel(channel_id) or (interaction.guild and interaction.guild.get_channel(channel_id))
+    channel_mention = channel.mention if channel else f"不明なチャンネル (ID: {channel_id})"
 
-        message = f"現在の設定:\n- 通知チャンネル: {channel_mention}\n- {time_info}\n- {template_info}"
-        await interaction.response.send_message(message, ephemeral=True)
+    hour_local, minute_local = settings.announce_time_local
+    hour_utc, minute_utc = convert_local_to_utc(hour_local, minute_local, settings.tz)
+    local_time_str = f"{hour_local:02}:{minute_local:02}"
+    timezone_str = format_timezone(settings.announce_timezone, settings.announce_timezone_offset)
+    utc_time_str = f"{hour_utc:02}:{minute_utc:02} UTC"
+    time_info = f"通知時刻: **{local_time_str} ({timezone_str})** ({utc_time_str})"
+    if settings.is_default_time:
+        time_info += " (デフォルト)"
 
-    except sqlite3.Error as e:
-        logger.error(f"check_settings コマンドエラー (Guild: {guild_id}): {e}")
-        await interaction.response.send_message("データベースエラーが発生しました。設定を確認できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+    if message_template:
+        template_info = f"通知メッセージ:\n```\n{message_template}\n```"
+    else:
+        default_display = DEFAULT_ANNOUNCE_MESSAGE.replace("{today_date}", "日付").replace("{names}", "<名前>").replace("{mentions}", "[メンション]")
+        template_info = f"通知メッセージ: デフォルト\n```\n{default_display}\n```"
+
+    message = f"現在の設定:\n- 通知チャンネル: {channel_mention}\n- {time_info}\n- {template_info}"
+    await interaction.response.send_message(message, ephemeral=True)
 
 
+UPSERT_BIRTHDAY_SQL = """
+    INSERT INTO birthdays (guild_id, display_name, birthday, birthday_md, mention_user_id, registered_by_user_id)
+    VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(guild_id, display_name) DO UPDATE SET
+    birthday = excluded.birthday, birthday_md = excluded.birthday_md, mention_user_id = excluded.mention_user_id, registered_by_user_id = excluded.registered_by_user_id
+    """
+
 @bot.tree.command(name='register_birthday', description='名前と誕生日を指定して登録・上書きします')
 @app_commands.describe( name='登録する人の名前 (サーバー内で一意)', birthday='誕生日 (MM/DD形式、例: 01/23)', user='(任意) 誕生日通知でメンションするDiscordユーザー' )
 async def register_birthday(interaction: discord.Interaction, name: str, birthday: str, user: Optional[discord.User] = None):
@@ -371,50 +2004,267 @@ async def register_birthday(interaction: discord.Interaction, name: str, birthda
     guild_id = interaction.guild_id
     registered_by_user_id = interaction.user.id
     mention_user_id = user.id if user else None
-    try:
-        birthday_date = datetime.datetime.strptime(birthday, '%m/%d').strftime('%m/%d')
-    except ValueError:
+    birthday_date = normalize_birthday(birthday)
+    if birthday_date is None:
         await interaction.response.send_message('誕生日の形式が正しくありません。MM/DD (例: 04/01) で入力してください。', ephemeral=True)
         return
 
-    conn = None
+    def save(conn: sqlite3.Connection) -> Optional[sqlite3.Row]:
+        cursor = conn.cursor()
+        cursor.execute("SELECT birthday_md FROM birthdays WHERE guild_id = ? AND display_name = ?", (guild_id, name))
+        previous = cursor.fetchone()
+        cursor.execute(UPSERT_BIRTHDAY_SQL, (guild_id, name, birthday_date, to_month_day(birthday_date), mention_user_id, registered_by_user_id))
+        return previous
+
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
+        previous = await db.write_batched(save)
+    except sqlite3.Error as e:
+        logger.error(f"register_birthday コマンドエラー (Guild: {guild_id}, Name: {name}): {e}")
+        await interaction.response.send_message("データベースエラーが発生しました。登録・更新できませんでした。", ephemeral=True)
+        return
+
+    exists = previous is not None
+    name_index.add(guild_id, name)
+    list_render_cache.bump(guild_id)
+    birthday_calendar.set(guild_id, name, to_month_day(birthday_date), mention_user_id, previous['birthday_md'] if exists else None, is_new=not exists)
+    action_text = "更新" if exists else "登録"
+    if user:
+        user_display = discord.utils.escape_markdown(user.display_name)
+        mention_text = f" (メンション対象: **{user_display}** さん)"
+    else:
+        mention_text = " (メンションなし)"
+
+    log_mention_id = f"メンションID: {mention_user_id}" if mention_user_id else "メンションなし"
+    logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) で誕生日{action_text}: {name} ({birthday_date}), {log_mention_id}, 登録者ID: {registered_by_user_id}")
+    await interaction.response.send_message(f'`{name}` さんの誕生日 ({birthday_date}) を{action_text}しました！{mention_text}', ephemeral=False)
+
+LIST_PAGE_SIZE = 20 # 一覧の1ページあたりの表示件数
+LIST_VIEW_TIMEOUT = 300 # 一覧のボタン操作を受け付ける秒数
+LIST_RENDER_CACHE_SIZE = 4096 # 保持する描画済みページの最大数
+LIST_RENDER_CACHE_BYTES = 8 * 1024 * 1024 # 描画済みページの本文 (UTF-8) の合計サイズの上限
+# メンション対象の在籍状況 (サーバーにいない表示) は登録内容が変わらなくても変わるため、描画済みページはこの秒数で描画し直す
+LIST_RENDER_CACHE_TTL = MEMBER_NEGATIVE_TTL
+
+LIST_RENDER_CACHE_LOOKUPS = metrics.Counter('birthday_bot_list_render_cache_total', '一覧ページの描画キャッシュの参照結果ごとの回数', ('result',))
+
+class ListPage:
+    """描画済みの一覧1ページ (本文・フッターと、前後のページを引くためのキー)"""
+
+    __slots__ = ('description', 'footer', 'first_key', 'last_key', 'has_prev', 'has_next', 'rendered_at')
+
+    def __init__(self, description: str, footer: str, first_key: tuple[int, str], last_key: tuple[int, str], has_prev: bool, has_next: bool):
+        self.description = description
+        self.footer = footer
+        self.first_key = first_key
+        self.last_key = last_key
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.rendered_at = time.monotonic()
+
+class ListRenderCache:
+    """一覧ページの描画結果を (guild_id, データのバージョン, ページの位置) をキーに保持するキャッシュ
+
+    サーバーの誕生日を書き換えるコマンドのたびに bump でバージョンを捨てるため、古いバージョンの
+    ページは参照されなくなり、LRU で追い出される。変更がなければ DB もメンバー解決も使わずに表示できる。
+    バージョンは全サーバー共通の連番から振り、描画済みのページが残っているサーバーの分だけ保持する
+    (最後のページが追い出されたら捨てる。捨てた後も同じ番号は二度と振らない)。
+    """
+
+    def __init__(self):
+        self._versions: dict[int, int] = {} # guild_id -> 現在のバージョン (ページがあるサーバーのみ)
+        self._page_counts: dict[int, int] = {} # guild_id -> 現在のバージョンのページ数
+        self._next_version = itertools.count(1)
+        self._invalidated_at = 0 # 最後に bump・forget した時点の連番 (これ以前に描画を始めたページは保存しない)
+        self._pages = LRUCache(LIST_RENDER_CACHE_SIZE, LIST_RENDER_CACHE_BYTES, on_evict=self._evicted)
+
+    def version(self, guild_id: int) -> int:
+        """描画を始める前に呼び、put に渡すバージョンを返す"""
+        version = self._versions.get(guild_id)
+        return version if version is not None else next(self._next_version)
+
+    def bump(self, guild_id: int):
+        """サーバーの誕生日が変わったことを記録する (それまでの描画結果と描画中のページは使われなくなる)"""
+        self.forget(guild_id)
+
+    def forget(self, guild_id: int):
+        self._versions.pop(guild_id, None)
+        self._page_counts.pop(guild_id, None)
+        self._invalidated_at = next(self._next_version)
+
+    def clear(self):
+        self._pages.clear()
+        self._versions.clear()
+        self._page_counts.clear()
+        self._invalidated_at = next(self._next_version)
+
+    def _evicted(self, key: tuple, page: ListPage):
+        guild_id, version, _ = key
+        if self._versions.get(guild_id) != version:
             return
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM birthdays WHERE guild_id = ? AND display_name = ?", (guild_id, name))
-        exists = cursor.fetchone()
-        cursor.execute(
-            """
-            INSERT INTO birthdays (guild_id, display_name, birthday, mention_user_id, registered_by_user_id)
-            VALUES (?, ?, ?, ?, ?) ON CONFLICT(guild_id, display_name) DO UPDATE SET
-            birthday = excluded.birthday, mention_user_id = excluded.mention_user_id, registered_by_user_id = excluded.registered_by_user_id
-            """,
-            (guild_id, name, birthday_date, mention_user_id, registered_by_user_id)
-        )
-        conn.commit()
+        self._page_counts[guild_id] -= 1
+        if not self._page_counts[guild_id]:
+            del self._versions[guild_id], self._page_counts[guild_id]
+
+    def get(self, guild_id: int, page_key: tuple) -> Optional[ListPage]:
+        version = self._versions.get(guild_id)
+        key = (guild_id, version, page_key)
+        page = self._pages.get(key) if version is not None else None
+        if page is not None and time.monotonic() - page.rendered_at >= LIST_RENDER_CACHE_TTL:
+            self._evicted(key, self._pages.pop(key))
+            page = None
+        LIST_RENDER_CACHE_LOOKUPS.inc('hit' if page is not None else 'miss')
+        return page
+
+    def put(self, guild_id: int, version: int, page_key: tuple, page: ListPage):
+        """描画を始めた時点のバージョンで保存する (描画中に書き換えがあれば保存しない)"""
+        current = self._versions.get(guild_id)
+        if current is None:
+            if version <= self._invalidated_at:
+                return
+            self._versions[guild_id] = version
+            self._page_counts[guild_id] = 0
+        elif current != version:
+            return
+        key = (guild_id, version, page_key)
+        if key not in self._pages:
+            self._page_counts[guild_id] += 1
+        self._pages.put(key, page, len(page.description.encode('utf-8')) + len(page.footer.encode('utf-8')))
+
+list_render_cache = ListRenderCache()
+
+def fetch_birthday_page(conn: sqlite3.Connection, guild_id: int, key: Optional[tuple[int, str]], backward: bool = False, inclusive: bool = False) -> tuple[List[sqlite3.Row], bool, bool]:
+    """(birthday_md, display_name) をキーにしたキーセットページネーションで1ページ分を取得する
+
+    key の後ろ (backward なら前) の LIST_PAGE_SIZE 件と、前後にさらに行があるかを返す。
+    key が None なら先頭ページ。どの位置でもインデックスを1ページ分 + 1件走査するだけで済む。
+    """
+    columns = "display_name, birthday, birthday_md, mention_user_id"
+    if key is None:
+        rows = conn.execute(f"SELECT {columns} FROM birthdays WHERE guild_id = ? ORDER BY birthday_md, display_name LIMIT ?",
+                            (guild_id, LIST_PAGE_SIZE + 1)).fetchall()
+    elif backward:
+        rows = conn.execute(f"SELECT {columns} FROM birthdays WHERE guild_id = ? AND (birthday_md, display_name) < (?, ?) ORDER BY birthday_md DESC, display_name DESC LIMIT ?",
+                            (guild_id, *key, LIST_PAGE_SIZE + 1)).fetchall()
+    else:
+        operator = '>=' if inclusive else '>'
+        rows = conn.execute(f"SELECT {columns} FROM birthdays WHERE guild_id = ? AND (birthday_md, display_name) {operator} (?, ?) ORDER BY birthday_md, display_name LIMIT ?",
+                            (guild_id, *key, LIST_PAGE_SIZE + 1)).fetchall()
+    has_more = len(rows) > LIST_PAGE_SIZE
+    rows = rows[:LIST_PAGE_SIZE]
+    if backward:
+        rows.reverse()
+    if not rows:
+        return rows, False, False
+    if backward:
+        has_prev = has_more
+        has_next = True
+    else:
+        has_next = has_more
+        first = (rows[0]['birthday_md'], rows[0]['display_name'])
+        has_prev = key is not None and conn.execute("SELECT 1 FROM birthdays WHERE guild_id = ? AND (birthday_md, display_name) < (?, ?) LIMIT 1", (guild_id, *first)).fetchone() is not None
+    return rows, has_prev, has_next
+
+async def resolve_mentions(guild: discord.Guild, rows: List[sqlite3.Row]) -> dict[int, ResolvedUser]:
+    """行のメンション対象ユーザーをまとめて解決する"""
+    return await member_resolver.resolve(guild, [row['mention_user_id'] for row in rows if row['mention_user_id']])
 
-        action_text = "更新" if exists else "登録"
-        if user:
-            user_display = discord.utils.escape_markdown(user.display_name)
-            mention_text = f" (メンション対象: **{user_display}** さん)"
+def format_birthday_line(row: sqlite3.Row, resolved: dict[int, ResolvedUser]) -> str:
+    """一覧の1行 (名前・誕生日・メンション対象) を組み立てる"""
+    mention_user_id = row['mention_user_id']
+    if mention_user_id:
+        resolved_user = resolved.get(mention_user_id)
+        if resolved_user is None or resolved_user.in_guild:
+            # 解決できなかった場合もメンション表記にしておけば、Discord 側で名前が表示される
+            mention_str = f" (<@{mention_user_id}>)"
+        elif resolved_user.name:
+            mention_str = f" ({resolved_user.name} - サーバーにいません)"
         else:
-            mention_text = " (メンションなし)"
+            mention_str = f" (ID: {mention_user_id} - 不明なユーザー)"
+    else:
+        mention_str = " (メンションなし)"
+    return f"**{row['display_name']}**: {row['birthday']}{mention_str}"
 
-        log_mention_id = f"メンションID: {mention_user_id}" if mention_user_id else "メンションなし"
-        logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) で誕生日{action_text}: {name} ({birthday_date}), {log_mention_id}, 登録者ID: {registered_by_user_id}")
-        await interaction.response.send_message(f'`{name}` さんの誕生日 ({birthday_date}) を{action_text}しました！{mention_text}', ephemeral=False)
+class BirthdayListView(discord.ui.View):
+    """誕生日一覧をページ送り・月ジャンプで表示するビュー (ページごとに必要な行だけを取得する)"""
 
-    except sqlite3.Error as e:
-        logger.error(f"register_birthday コマンドエラー (Guild: {guild_id}, Name: {name}): {e}")
-        if conn:
-            conn.rollback()
-        await interaction.response.send_message("データベースエラーが発生しました。登録・更新できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+    def __init__(self, guild: discord.Guild, owner_id: int):
+        super().__init__(timeout=LIST_VIEW_TIMEOUT)
+        self.guild = guild
+        self.owner_id = owner_id
+        self.page: Optional[ListPage] = None
+        self.message: Optional[discord.Message] = None
+
+    async def load(self, key: Optional[tuple[int, str]] = None, backward: bool = False, inclusive: bool = False) -> bool:
+        """ページを読み込み、ボタンの状態を更新する。該当する行がなければ False
+
+        描画済みのページがあればそれを使い、なければ DB から取得・メンバー解決をして描画し、キャッシュに保存する。
+        """
+        page_key = (key, backward, inclusive)
+        page = list_render_cache.get(self.guild.id, page_key)
+        if page is None:
+            version = list_render_cache.version(self.guild.id)
+            rows, has_prev, has_next = await db.read(fetch_birthday_page, self.guild.id, key, backward, inclusive)
+            if not rows:
+                return False
+            resolved = await resolve_mentions(self.guild, rows)
+            page = ListPage(
+                description="\n".join(format_birthday_line(row, resolved) for row in rows),
+                footer=f"{rows[0]['birthday']} 〜 {rows[-1]['birthday']}",
+                first_key=(rows[0]['birthday_md'], rows[0]['display_name']),
+                last_key=(rows[-1]['birthday_md'], rows[-1]['display_name']),
+                has_prev=has_prev,
+                has_next=has_next)
+            list_render_cache.put(self.guild.id, version, page_key, page)
+        self.page = page
+        self.prev_button.disabled = not page.has_prev
+        self.next_button.disabled = not page.has_next
+        return True
+
+    def build_embed(self) -> discord.Embed:
+        embed = discord.Embed(title=f'{self.guild.name} の誕生日一覧', color=discord.Color.blue())
+        embed.description = self.page.description
+        embed.set_footer(text=self.page.footer)
+        return embed
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("この一覧を操作できるのはコマンドを実行した人だけです。 `/list_birthdays` を実行してください。", ephemeral=True)
+            return False
+        return True
+
+    async def _show(self, interaction: discord.Interaction, key: tuple[int, str], backward: bool = False, inclusive: bool = False, empty_message: str = "表示できる誕生日がありません。"):
+        try:
+            found = await self.load(key, backward, inclusive)
+        except sqlite3.Error as e:
+            logger.error(f"list_birthdays ページ取得エラー (Guild: {self.guild.id}): {e}")
+            await interaction.response.send_message("データベースエラーが発生しました。一覧を表示できませんでした。", ephemeral=True)
+            return
+        if not found:
+            await interaction.response.send_message(empty_message, ephemeral=True)
+            return
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @discord.ui.button(label='◀ 前へ', style=discord.ButtonStyle.secondary)
+    async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page.first_key, backward=True)
+
+    @discord.ui.button(label='次へ ▶', style=discord.ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, self.page.last_key)
+
+    @discord.ui.select(placeholder='月を選んで移動', options=[discord.SelectOption(label=f"{month}月", value=str(month)) for month in range(1, 13)])
+    async def month_select(self, interaction: discord.Interaction, select: discord.ui.Select):
+        month = int(select.values[0])
+        await self._show(interaction, (month * 100, ''), inclusive=True, empty_message=f"{month}月以降に誕生日の人はいません。")
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
 
 @bot.tree.command(name='list_birthdays', description='このサーバーに登録されている誕生日の一覧を表示します')
 async def list_birthdays(interaction: discord.Interaction):
@@ -424,48 +2274,85 @@ async def list_birthdays(interaction: discord.Interaction):
     if not guild:
         await interaction.response.send_message("サーバー情報を取得できませんでした。", ephemeral=True)
         return
-    conn = None
+    view = BirthdayListView(guild, interaction.user.id)
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
-            return
-        cursor = conn.cursor()
-        cursor.execute('SELECT display_name, birthday, mention_user_id FROM birthdays WHERE guild_id = ? ORDER BY birthday, display_name', (guild_id,))
-        results = cursor.fetchall()
-        if not results:
-            await interaction.response.send_message('まだ誰も誕生日を登録していません。 `/register_birthday` で登録しましょう！', ephemeral=True)
-            return
-        embed = discord.Embed(title=f'{guild.name} の誕生日一覧', color=discord.Color.blue())
-        description_lines = []
-        for row in results:
-            name = row['display_name']
-            birthday = row['birthday']
-            mention_user_id = row['mention_user_id']
-            mention_str = ""
-            if mention_user_id:
-                member = guild.get_member(mention_user_id)
-                if member:
-                    mention_str = f" ({member.mention})"
-                else:
-                    user = bot.get_user(mention_user_id)
-                    mention_str = f" ({user.name} - サーバーにいません)" if user else f" (ID: {mention_user_id} - 不明なユーザー)"
-            else:
-                mention_str = " (メンションなし)"
-            description_lines.append(f"**{name}**: {birthday}{mention_str}")
-        full_description = "\n".join(description_lines)
-        if len(full_description) > 4000:
-            await interaction.response.send_message("登録数が多すぎるため、一部のみ表示します。（将来的にページネーション対応予定）")
-            embed.description = full_description[:4000] + "\n..."
-        else:
-            embed.description = full_description
-        await interaction.response.send_message(embed=embed)
+        found = await view.load()
     except sqlite3.Error as e:
         logger.error(f"list_birthdays コマンドエラー (Guild: {guild_id}): {e}")
         await interaction.response.send_message("データベースエラーが発生しました。一覧を表示できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+        return
+    if not found:
+        await interaction.response.send_message('まだ誰も誕生日を登録していません。 `/register_birthday` で登録しましょう！', ephemeral=True)
+        return
+    await interaction.response.send_message(embed=view.build_embed(), view=view)
+    view.message = await interaction.original_response()
+
+UPCOMING_MAX_DAYS = 365 # /upcoming で指定できる最大日数
+UPCOMING_MAX_ROWS = 25 # /upcoming で表示する最大件数
+
+def fetch_upcoming_birthdays(conn: sqlite3.Connection, guild_id: int, today: datetime.date, days: int, limit: int = UPCOMING_MAX_ROWS) -> tuple[List[tuple[int, sqlite3.Row]], bool]:
+    """today から days 日後までに誕生日を迎える人を (残り日数, 行) の残り日数順で最大 limit 件返す
+
+    期間を月日 (birthday_md) の範囲に変換してインデックスを範囲検索するため、
+    走査するのは該当する行だけで済む。年をまたぐ場合は「今日〜12/31」と「01/01〜終了日」の2回に分ける。
+    2つ目の戻り値は limit 件を超える該当者がいるかどうか。
+    """
+    end = today + datetime.timedelta(days=days)
+    start_md = today.month * 100 + today.day
+    end_md = max(observed_month_days(end))
+    if end.year == today.year:
+        ranges = [(start_md, end_md)]
+    else:
+        # 1年分を指定した場合に同じ月日を2回数えないよう、2つ目の範囲は今日の前日までで打ち切る
+        ranges = [(start_md, 1231), (101, min(end_md, start_md - 1))]
+    rows = []
+    for low, high in ranges:
+        if low > high or len(rows) > limit:
+            continue
+        rows.extend(conn.execute(
+            "SELECT display_name, birthday, birthday_md, mention_user_id FROM birthdays WHERE guild_id = ? AND birthday_md BETWEEN ? AND ? ORDER BY birthday_md, display_name LIMIT ?",
+            (guild_id, low, high, limit + 1 - len(rows))).fetchall())
+    upcoming = [((next_birthday(row['birthday_md'], today) - today).days, row) for row in rows]
+    upcoming = [item for item in upcoming if item[0] <= days]
+    upcoming.sort(key=lambda item: item[0])
+    return upcoming[:limit], len(upcoming) > limit
+
+@bot.tree.command(name='upcoming', description='これから指定した日数以内に誕生日を迎える人を表示します')
+@app_commands.describe(days=f'何日先までを表示するか (1〜{UPCOMING_MAX_DAYS}、既定: 30)')
+async def upcoming(interaction: discord.Interaction, days: app_commands.Range[int, 1, UPCOMING_MAX_DAYS] = 30):
+    """サーバーのタイムゾーンでの今日から days 日以内の誕生日を、近い順に表示するコマンド"""
+    guild_id = interaction.guild_id
+    guild = interaction.guild
+    if not guild:
+        await interaction.response.send_message("サーバー情報を取得できませんでした。", ephemeral=True)
+        return
+    try:
+        settings = await settings_cache.get(guild_id)
+        tz = settings.tz if settings else resolve_timezone(None, None)
+        today = datetime.datetime.now(tz).date()
+        upcoming_rows, truncated = await db.read(fetch_upcoming_birthdays, guild_id, today, days)
+    except sqlite3.Error as e:
+        logger.error(f"upcoming コマンドエラー (Guild: {guild_id}): {e}")
+        await interaction.response.send_message("データベースエラーが発生しました。誕生日を取得できませんでした。", ephemeral=True)
+        return
+    if not upcoming_rows:
+        await interaction.response.send_message(f'今後 {days} 日以内に誕生日を迎える人はいません。', ephemeral=True)
+        return
+
+    resolved = await resolve_mentions(guild, [row for _, row in upcoming_rows])
+    lines = []
+    for days_left, row in upcoming_rows:
+        label = "今日" if days_left == 0 else "明日" if days_left == 1 else f"あと{days_left}日"
+        line = f"`{label}` {format_birthday_line(row, resolved)}"
+        if row['birthday_md'] == 229 and not calendar.isleap((today + datetime.timedelta(days=days_left)).year):
+            line += " ※今年は 02/28 にお祝い"
+        lines.append(line)
+    embed = discord.Embed(title=f'{guild.name} の今後 {days} 日間の誕生日', description="\n".join(lines), color=discord.Color.blue())
+    footer = f"{today.strftime('%Y/%m/%d')} ({settings.zone_key if settings else DEFAULT_TIMEZONE_NAME}) 基準"
+    if truncated:
+        footer += f" ・ 近い順に {UPCOMING_MAX_ROWS} 件まで表示"
+    embed.set_footer(text=footer)
+    await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="check_mention", description="指定した名前の人のメンション設定を確認します。")
 @app_commands.describe(name='確認する人の名前')
@@ -476,35 +2363,27 @@ async def check_mention(interaction: discord.Interaction, name: str):
     if not guild:
         await interaction.response.send_message("サーバー情報を取得できませんでした。", ephemeral=True)
         return
-    conn = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
-            return
-        cursor = conn.cursor()
-        cursor.execute('SELECT mention_user_id FROM birthdays WHERE guild_id = ? AND display_name = ?', (guild_id, name))
-        result = cursor.fetchone()
-        if not result:
-            await interaction.response.send_message(f'`{name}` さんの誕生日は登録されていません。', ephemeral=True)
-            return
-        mention_user_id = result['mention_user_id']
-        if mention_user_id:
-            member = guild.get_member(mention_user_id)
-            if member:
-                message = f'`{name}` さんの誕生日は `{member.mention}` にメンションされる設定です。'
-            else:
-                user = bot.get_user(mention_user_id)
-                message = f'`{name}` さんの誕生日は `{user.name}` (ID: {mention_user_id}, サーバーにいません) にメンションされる設定です。' if user else f'`{name}` さんの誕生日は 不明なユーザー (ID: {mention_user_id}) にメンションされる設定です。'
-        else:
-            message = f'`{name}` さんの誕生日はメンションされない設定です。'
-        await interaction.response.send_message(message, ephemeral=True)
+        result = await db.fetchone('SELECT mention_user_id FROM birthdays WHERE guild_id = ? AND display_name = ?', (guild_id, name))
     except sqlite3.Error as e:
         logger.error(f"check_mention コマンドエラー (Guild: {guild_id}, Name: {name}): {e}")
         await interaction.response.send_message("データベースエラーが発生しました。確認できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+        return
+    if not result:
+        await interaction.response.send_message(f'`{name}` さんの誕生日は登録されていません。', ephemeral=True)
+        return
+    mention_user_id = result['mention_user_id']
+    if mention_user_id:
+        resolved_user = (await member_resolver.resolve(guild, [mention_user_id])).get(mention_user_id)
+        if resolved_user is None or resolved_user.in_guild:
+            message = f'`{name}` さんの誕生日は <@{mention_user_id}> にメンションされる設定です。'
+        elif resolved_user.name:
+            message = f'`{name}` さんの誕生日は `{resolved_user.name}` (ID: {mention_user_id}, サーバーにいません) にメンションされる設定です。'
+        else:
+            message = f'`{name}` さんの誕生日は 不明なユーザー (ID: {mention_user_id}) にメンションされる設定です。'
+    else:
+        message = f'`{name}` さんの誕生日はメンションされない設定です。'
+    await interaction.response.send_message(message, ephemeral=True)
 
 @bot.tree.command(name="set_mention", description="指定した名前の人のメンション設定を変更します。")
 @app_commands.describe( name='設定を変更する人の名前', mention_target='(任意) メンションを有効にする場合、対象ユーザーを指定。指定しない場合はメンション無効化。')
@@ -512,184 +2391,736 @@ async def set_mention(interaction: discord.Interaction, name: str, mention_targe
     """指定した名前のメンション設定を変更するコマンド"""
     guild_id = interaction.guild_id
     new_mention_user_id = mention_target.id if mention_target else None
-    conn = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
-            return
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM birthdays WHERE guild_id = ? AND display_name = ?", (guild_id, name))
-        exists = cursor.fetchone()
-        if not exists:
-            await interaction.response.send_message(f'`{name}` さんの誕生日は登録されていません。まず `/register_birthday` で登録してください。', ephemeral=True)
-            return
-        cursor.execute( 'UPDATE birthdays SET mention_user_id = ? WHERE guild_id = ? AND display_name = ?', (new_mention_user_id, guild_id, name) )
-        conn.commit()
-
-        if mention_target:
-            mention_target_display = discord.utils.escape_markdown(mention_target.display_name)
-            message = f'`{name}` さんの誕生日通知メンションを **{mention_target_display}** さんに設定しました。'
-            log_message = f"メンションを有効化 (対象: {mention_target.name}#{mention_target.discriminator}, ID: {new_mention_user_id})"
-        else:
-            message = f'`{name}` さんの誕生日通知メンションを無効化しました。'
-            log_message = "メンションを無効化"
-
-        logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) でメンション設定変更: {name} - {log_message}")
-        await interaction.response.send_message(message, ephemeral=False)
-
+        updated_rows = await db.execute_batched('UPDATE birthdays SET mention_user_id = ? WHERE guild_id = ? AND display_name = ?', (new_mention_user_id, guild_id, name))
     except sqlite3.Error as e:
         logger.error(f"set_mention コマンドエラー (Guild: {guild_id}, Name: {name}): {e}")
-        if conn:
-            conn.rollback()
         await interaction.response.send_message("データベースエラーが発生しました。設定を変更できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+        return
+    if updated_rows == 0:
+        await interaction.response.send_message(f'`{name}` さんの誕生日は登録されていません。まず `/register_birthday` で登録してください。', ephemeral=True)
+        return
+    birthday_calendar.set_mention(guild_id, name, new_mention_user_id)
+    list_render_cache.bump(guild_id)
+
+    if mention_target:
+        mention_target_display = discord.utils.escape_markdown(mention_target.display_name)
+        message = f'`{name}` さんの誕生日通知メンションを **{mention_target_display}** さんに設定しました。'
+        log_message = f"メンションを有効化 (対象: {mention_target.name}#{mention_target.discriminator}, ID: {new_mention_user_id})"
+    else:
+        message = f'`{name}` さんの誕生日通知メンションを無効化しました。'
+        log_message = "メンションを無効化"
+
+    logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) でメンション設定変更: {name} - {log_message}")
+    await interaction.response.send_message(message, ephemeral=False)
 
 @bot.tree.command(name="delete_birthday", description="登録した誕生日を名前で削除します。")
 @app_commands.describe(name='削除する誕生日情報の名前')
 async def delete_birthday(interaction: discord.Interaction, name: str):
     """名前を指定して誕生日情報を削除するコマンド"""
     guild_id = interaction.guild_id
-    conn = None
     try:
-        conn = get_db_connection()
-        if conn is None:
-            await interaction.response.send_message("データベース接続に失敗しました。", ephemeral=True)
-            return
-        cursor = conn.cursor()
-        cursor.execute( 'DELETE FROM birthdays WHERE guild_id = ? AND display_name = ?', (guild_id, name), )
-        deleted_rows = cursor.rowcount
-        conn.commit()
-        if deleted_rows > 0:
-            logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) で誕生日削除: {name}")
-            await interaction.response.send_message(f'`{name}` さんの誕生日情報を削除しました！', ephemeral=True)
-        else:
-            await interaction.response.send_message(f'`{name}` さんの誕生日は登録されていません。', ephemeral=True)
+        deleted_rows = await db.execute_batched('DELETE FROM birthdays WHERE guild_id = ? AND display_name = ?', (guild_id, name))
     except sqlite3.Error as e:
         logger.error(f"delete_birthday コマンドエラー (Guild: {guild_id}, Name: {name}): {e}")
-        if conn:
-            conn.rollback()
         await interaction.response.send_message("データベースエラーが発生しました。削除できませんでした。", ephemeral=True)
-    finally:
-        if conn:
-            conn.close()
+        return
+    if deleted_rows > 0:
+        name_index.remove(guild_id, name)
+        birthday_calendar.remove(guild_id, name)
+        list_render_cache.bump(guild_id)
+        logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) で誕生日削除: {name}")
+        await interaction.response.send_message(f'`{name}` さんの誕生日情報を削除しました！', ephemeral=True)
+    else:
+        await interaction.response.send_message(f'`{name}` さんの誕生日は登録されていません。', ephemeral=True)
 
-# --- 定期実行タスク ---
+@delete_birthday.autocomplete('name')
+@set_mention.autocomplete('name')
+@check_mention.autocomplete('name')
+async def birthday_name_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    """登録済みの名前を前方一致で候補表示する (メモリ上のインデックスのみ参照)"""
+    if interaction.guild_id is None:
+        return []
+    try:
+        names = await name_index.complete(interaction.guild_id, current)
+    except sqlite3.Error as e:
+        logger.error(f"名前の入力候補取得エラー (Guild: {interaction.guild_id}): {e}")
+        return []
+    # Discord の候補は100文字まで
+    return [app_commands.Choice(name=name, value=name) for name in names if len(name) <= 100]
 
-@tasks.loop(minutes=1)
-async def birthday_announce():
-    """毎分実行し、設定された時刻になったサーバーの誕生日を確認・通知するタスク"""
-    now_utc = datetime.datetime.now(datetime.timezone.utc)
-    current_hour_utc = now_utc.hour
-    current_minute_utc = now_utc.minute
-    loop_interval_minutes = 1
+def format_latency(histogram: metrics.Histogram, *prefix) -> str:
+    """ヒストグラムの p50 / p99 と件数を表示用文字列にする"""
+    count = histogram.count(*prefix)
+    if not count:
+        return "記録なし"
+    return f"p50 {histogram.quantile(0.5, *prefix) * 1000:.1f}ms / p99 {histogram.quantile(0.99, *prefix) * 1000:.1f}ms ({count}回)"
 
-    jst = datetime.timezone(datetime.timedelta(hours=9))
-    today_jst_str = datetime.datetime.now(jst).strftime('%m/%d')
-    logger.debug(f"誕生日通知タスク実行チェック: {now_utc.strftime('%Y-%m-%d %H:%M')} UTC")
-    conn = None
-    processed_guilds = set()
+@bot.tree.command(name='bot_stats', description='Botの稼働状況 (処理時間・送信結果など) を表示します (管理者向け)')
+@app_commands.default_permissions(administrator=True)
+@app_commands.checks.has_permissions(administrator=True)
+async def bot_stats(interaction: discord.Interaction):
+    """メトリクスの要約を表示するコマンド (Prometheus のエンドポイントがなくても確認できるように)"""
+    uptime = int(time.monotonic() - PROCESS_STARTED_MONOTONIC)
+    embed = discord.Embed(title='Botの稼働状況', color=discord.Color.dark_grey())
+    embed.add_field(name='プロセス', value=f"稼働時間: {uptime // 3600}時間{uptime % 3600 // 60}分\nサーバー数: {len(bot.guilds)}\n担当シャード: {format_shards()}", inline=False)
+    embed.add_field(name='通知ティック', value=(
+        f"{format_latency(ANNOUNCE_TICK_SECONDS)}\n"
+        f"通知時刻を迎えたサーバー: {int(ANNOUNCE_GUILDS_DUE.value())} / 確認済み: {int(ANNOUNCE_GUILDS_PROCESSED.value())}\n"
+        f"スケジュール登録: {len(announce_scheduler)} / 送信待ち: {announcement_dispatcher.pending}"), inline=False)
+    embed.add_field(name='データベース', value=(
+        f"読み取り: {format_latency(DB_QUERY_SECONDS, 'read')}\n"
+        f"書き込み: {format_latency(DB_QUERY_SECONDS, 'write')}\n"
+        f"エラー: {int(DB_ERRORS.value())} / 待機中: {int(DB_PENDING.value('read') + DB_PENDING.value('write'))}"), inline=False)
+    send_results = ', '.join(f"{result}: {int(count)}" for (result,), count in sorted(CHANNEL_SENDS.series().items()))
+    embed.add_field(name='通知送信', value=f"{format_latency(CHANNEL_SEND_SECONDS)}\n{send_results or '送信なし'}", inline=False)
+    command_names = sorted({key[0] for key in COMMAND_SECONDS.label_values()}, key=lambda name: -COMMAND_SECONDS.count(name))[:10]
+    embed.add_field(name='コマンド (実行回数上位)', value="\n".join(f"`/{name}`: {format_latency(COMMAND_SECONDS, name)}" for name in command_names) or "記録なし", inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name='profile', description='一定時間プロファイルを取得してファイルに保存します (Botのオーナー専用)')
+@app_commands.describe(mode='cpu: 関数ごとの処理時間 (cProfile) / memory: メモリ確保の増加 (tracemalloc)', seconds=f'取得する秒数 (1〜{PROFILE_MAX_SECONDS})')
+@app_commands.default_permissions(administrator=True)
+async def profile(interaction: discord.Interaction, mode: Literal['cpu', 'memory'] = 'cpu', seconds: app_commands.Range[int, 1, PROFILE_MAX_SECONDS] = 30):
+    """cProfile / tracemalloc のプロファイルを時間を区切って取得し、PROFILE_DIR に保存するコマンド"""
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("このコマンドはBotのオーナーのみ実行できます。", ephemeral=True)
+        return
+    if profile_capture.running_mode is not None:
+        await interaction.response.send_message(f"すでにプロファイル ({profile_capture.running_mode}) を取得中です。終わるまでお待ちください。", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    logger.info(f"プロファイル ({mode}) を {seconds}秒間取得します (User: {interaction.user.id})。")
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("誕生日通知タスク: データベースに接続できません。")
+        path, summary = await profile_capture.capture(mode, seconds)
+    except (OSError, RuntimeError) as e:
+        logger.error(f"プロファイルの取得に失敗しました: {e}")
+        await interaction.followup.send(f"プロファイルの取得に失敗しました: {e}", ephemeral=True)
+        return
+    logger.info(f"プロファイル ({mode}) を {path} に保存しました。")
+    # 応答には要約の先頭だけを載せる (全体は保存したファイルを参照)
+    excerpt = summary if len(summary) <= 1800 else summary[:1800] + '\n...'
+    await interaction.followup.send(f"プロファイルを `{path}` に保存しました。\n```\n{excerpt}\n```", ephemeral=True)
+
+# --- 一括インポート・エクスポート ---
+
+IMPORT_MAX_BYTES = 1024 * 1024 # 取り込めるファイルの最大サイズ
+IMPORT_MAX_ROWS = 5000 # 1回で取り込める最大件数
+IMPORT_MAX_ERROR_LINES = 15 # 応答に表示するエラー行数の上限
+EXPORT_FETCH_SIZE = 500 # エクスポート時に一度に読み出す行数
+BIRTHDAY_FILE_COLUMNS = ('name', 'birthday', 'mention_user_id') # インポート・エクスポートファイルの列 (キー)
+
+def read_birthday_records(text: str, is_json: bool) -> List[tuple[str, object, object, object]]:
+    """CSV / JSON のテキストを (行ラベル, 名前, 誕生日, メンション) のリストに変換する (値は未検証)
+
+    ファイル全体の形式が壊れている場合や件数が多すぎる場合は ValueError を送出する。
+    """
+    records = []
+    if is_json:
+        data = json.loads(text)
+        if not isinstance(data, list):
+            raise ValueError("JSON はオブジェクトの配列である必要があります。")
+        for number, item in enumerate(data, start=1):
+            if isinstance(item, dict):
+                records.append((f"{number}件目", item.get('name'), item.get('birthday'), item.get('mention_user_id')))
+            else:
+                records.append((f"{number}件目", None, None, None))
+    else:
+        reader = csv.reader(io.StringIO(text))
+        header_checked = False
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            if not header_checked:
+                header_checked = True
+                if row[0].strip().lower() in ('name', '名前'):
+                    continue
+            label = f"{reader.line_num}行目"
+            records.append((label, row[0] if len(row) > 0 else None, row[1] if len(row) > 1 else None, row[2] if len(row) > 2 else None))
+    if len(records) > IMPORT_MAX_ROWS:
+        raise ValueError(f"件数が多すぎます ({len(records)}件)。1回で取り込めるのは {IMPORT_MAX_ROWS} 件までです。")
+    return records
+
+def validate_birthday_records(records: List[tuple[str, object, object, object]]) -> tuple[List[tuple[str, str, Optional[int]]], List[str]]:
+    """/register_birthday と同じ規則で各行を検証し、(名前, 'MM/DD', メンションID) のリストとエラー一覧を返す
+
+    不正な行があっても他の行は取り込めるよう、エラーは行ラベル付きで集める。
+    同じ名前 (大文字小文字を区別しない) が複数ある場合は最初の行を採用する。
+    """
+    valid = []
+    errors = []
+    seen: dict[str, str] = {}
+    for label, name, birthday, mention in records:
+        name = name.strip() if isinstance(name, str) else ''
+        if not name:
+            errors.append(f"{label}: 名前がありません。")
+            continue
+        birthday_date = normalize_birthday(birthday.strip()) if isinstance(birthday, str) else None
+        if birthday_date is None:
+            errors.append(f"{label}: 誕生日の形式が正しくありません (MM/DD)。")
+            continue
+        ok, mention_user_id = parse_mention_user_id(mention)
+        if not ok:
+            errors.append(f"{label}: メンション対象はユーザーID か <@ユーザーID> で指定してください。")
+            continue
+        key = nocase_key(name)
+        if key in seen:
+            errors.append(f"{label}: 同じ名前が {seen[key]} にもあるためスキップしました。")
+            continue
+        seen[key] = label
+        valid.append((name, birthday_date, mention_user_id))
+    return valid, errors
+
+def import_birthdays_rows(conn: sqlite3.Connection, guild_id: int, rows: List[tuple[str, str, Optional[int]]], registered_by_user_id: int) -> int:
+    """検証済みの行を1トランザクションでまとめて登録・上書きし、新規に追加された件数を返す"""
+    count_sql = "SELECT COUNT(*) FROM birthdays WHERE guild_id = ?"
+    before = conn.execute(count_sql, (guild_id,)).fetchone()[0]
+    conn.executemany(UPSERT_BIRTHDAY_SQL, ((guild_id, name, birthday_date, to_month_day(birthday_date), mention_user_id, registered_by_user_id)
+                                           for name, birthday_date, mention_user_id in rows))
+    return conn.execute(count_sql, (guild_id,)).fetchone()[0] - before
+
+def export_birthdays_to(conn: sqlite3.Connection, guild_id: int, fp, file_format: str) -> int:
+    """サーバーの誕生日を fp に CSV / JSON で書き出し、件数を返す
+
+    結果セット全体をメモリに載せないよう、EXPORT_FETCH_SIZE 件ずつ読み出しては書き込む。
+    JSON のユーザーIDは桁あふれを避けるため文字列で出力する。
+    """
+    cursor = conn.execute("SELECT display_name, birthday, mention_user_id FROM birthdays WHERE guild_id = ? ORDER BY birthday_md, display_name", (guild_id,))
+    text = io.TextIOWrapper(fp, encoding='utf-8', newline='')
+    count = 0
+    if file_format == 'json':
+        text.write('[')
+    else:
+        writer = csv.writer(text)
+        writer.writerow(BIRTHDAY_FILE_COLUMNS)
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            mention_user_id = str(row['mention_user_id']) if row['mention_user_id'] else None
+            if file_format == 'json':
+                record = dict(zip(BIRTHDAY_FILE_COLUMNS, (row['display_name'], row['birthday'], mention_user_id)))
+                text.write((',\n ' if count else '\n ') + json.dumps(record, ensure_ascii=False))
+            else:
+                writer.writerow((row['display_name'], row['birthday'], mention_user_id or ''))
+            count += 1
+    if file_format == 'json':
+        text.write('\n]\n')
+    text.flush()
+    text.detach() # fp は呼び出し側で送信に使うため閉じない
+    return count
+
+@bot.tree.command(name='import_birthdays', description='CSV / JSON ファイルから誕生日をまとめて登録・上書きします')
+@app_commands.describe(file='name,birthday,mention_user_id の列を持つ CSV、または同じキーを持つオブジェクト配列の JSON')
+@app_commands.checks.has_permissions(manage_guild=True)
+async def import_birthdays(interaction: discord.Interaction, file: discord.Attachment):
+    """添付ファイルの誕生日を検証し、1トランザクションで一括登録・上書きするコマンド"""
+    guild_id = interaction.guild_id
+    if file.size > IMPORT_MAX_BYTES:
+        await interaction.response.send_message(f"ファイルが大きすぎます。{IMPORT_MAX_BYTES // 1024} KiB 以下のファイルを指定してください。", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        data = await file.read()
+    except discord.HTTPException as e:
+        logger.error(f"import_birthdays 添付ファイル取得エラー (Guild: {guild_id}): {e}")
+        await interaction.followup.send("添付ファイルを読み込めませんでした。", ephemeral=True)
+        return
+    try:
+        text = data.decode('utf-8-sig')
+        is_json = file.filename.lower().endswith('.json') or text.lstrip().startswith('[')
+        records = read_birthday_records(text, is_json)
+    except UnicodeDecodeError:
+        await interaction.followup.send("ファイルは UTF-8 で保存してください。", ephemeral=True)
+        return
+    except (ValueError, csv.Error) as e: # json.JSONDecodeError は ValueError のサブクラス
+        await interaction.followup.send(f"ファイルを読み込めませんでした: {e}", ephemeral=True)
+        return
+
+    rows, errors = validate_birthday_records(records)
+    added = 0
+    if rows:
+        def save(conn: sqlite3.Connection) -> tuple[int, dict[int, dict[int, tuple[CalendarEntry, ...]]]]:
+            # カレンダーには同じトランザクション内で読み直したサーバー全体を反映する
+            return import_birthdays_rows(conn, guild_id, rows, interaction.user.id), BirthdayCalendar.load(conn, guild_id)
+
+        try:
+            added, calendar_days = await db.write(save)
+        except sqlite3.Error as e:
+            logger.error(f"import_birthdays コマンドエラー (Guild: {guild_id}): {e}")
+            await interaction.followup.send("データベースエラーが発生しました。1件も登録されていません。", ephemeral=True)
             return
-        cursor = conn.cursor()
-        cursor.execute('SELECT guild_id, announce_channel_id, announce_hour_utc, announce_minute_utc, announce_message_template FROM server_settings')
-        settings = cursor.fetchall()
-        if not settings:
-            logger.debug("誕生日通知タスク: 通知設定されているサーバーがありません。")
+        name_index.forget(guild_id)
+        list_render_cache.bump(guild_id)
+        if owns_guild(guild_id):
+            birthday_calendar.replace_guild(guild_id, calendar_days.get(guild_id))
+
+    logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) で誕生日を一括インポート: {len(rows)}件 (新規 {added}件), エラー {len(errors)}件, 実行者ID: {interaction.user.id}")
+    lines = [f"{len(rows)} 件を取り込みました (新規 {added} 件・上書き {len(rows) - added} 件)。"]
+    if errors:
+        lines.append(f"取り込めなかった行が {len(errors)} 件あります:")
+        lines.extend(f"- {error}" for error in errors[:IMPORT_MAX_ERROR_LINES])
+        if len(errors) > IMPORT_MAX_ERROR_LINES:
+            lines.append(f"…ほか {len(errors) - IMPORT_MAX_ERROR_LINES} 件")
+    await interaction.followup.send("\n".join(lines), ephemeral=True)
+
+@bot.tree.command(name='export_birthdays', description='このサーバーの誕生日をファイルに書き出します')
+@app_commands.describe(file_format='ファイル形式 (既定: csv)')
+@app_commands.checks.has_permissions(manage_guild=True)
+async def export_birthdays(interaction: discord.Interaction, file_format: Literal['csv', 'json'] = 'csv'):
+    """サーバーの誕生日を一時ファイルに書き出して添付で送るコマンド (/import_birthdays で読み込める形式)"""
+    guild_id = interaction.guild_id
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    with tempfile.TemporaryFile() as fp:
+        try:
+            count = await db.read(export_birthdays_to, guild_id, fp, file_format)
+        except sqlite3.Error as e:
+            logger.error(f"export_birthdays コマンドエラー (Guild: {guild_id}): {e}")
+            await interaction.followup.send("データベースエラーが発生しました。書き出せませんでした。", ephemeral=True)
             return
+        if count == 0:
+            await interaction.followup.send('まだ誰も誕生日を登録していません。 `/register_birthday` で登録しましょう！', ephemeral=True)
+            return
+        size = fp.tell()
+        if interaction.guild and size > interaction.guild.filesize_limit:
+            await interaction.followup.send("ファイルが大きすぎるため送信できません。", ephemeral=True)
+            return
+        fp.seek(0)
+        logger.info(f"サーバー {interaction.guild.name} (ID: {guild_id}) で誕生日をエクスポート: {count}件 ({file_format}, {size} bytes)")
+        await interaction.followup.send(f"{count} 件の誕生日を書き出しました。", file=discord.File(fp, filename=f"birthdays_{guild_id}.{file_format}"), ephemeral=True)
+
+# --- 定期実行タスク ---
+
+ANNOUNCE_MAX_CONCURRENCY = 8 # 同時に送信する通知の最大数
+# 全体の送信上限 (回数, 秒)。Discord のグローバル上限 50回/秒 より余裕を持たせ、同じトークンのプロセス間で等分する
+ANNOUNCE_GLOBAL_RATE = (max(1, 40 // CLUSTER_SIZE), 1.0)
+ANNOUNCE_CHANNEL_RATE = (5, 5.0) # チャンネルごとの送信上限 (回数, 秒)
+ANNOUNCE_MAX_RETRIES = 4 # 429 や一時的なHTTPエラー時の再試行回数
+ANNOUNCE_RETRY_BASE_DELAY = 1.0 # 再試行の基本待機秒数 (指数バックオフ)
+
+class RateLimiter:
+    """トークンバケット方式のレート制限 (per 秒あたり rate 回まで)"""
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate / self.per)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+
+class Announcement:
+    """1サーバー1日分の誕生日通知 (送信結果も保持する)"""
+
+    __slots__ = ('guild', 'channel', 'message', 'fire_at', 'local_date', 'sent', 'retryable', 'maybe_sent', 'latency')
+
+    def __init__(self, guild: discord.Guild, channel: discord.abc.Messageable, message: str, fire_at: datetime.datetime, local_date: datetime.date):
+        self.guild = guild
+        self.channel = channel
+        self.message = message
+        self.fire_at = fire_at
+        self.local_date = local_date
+        self.sent = False
+        self.retryable = False # 一時的なエラーで送信できなかった場合 True
+        self.maybe_sent = False # 失敗した送信のうち、Discord に届いて投稿された可能性があるものがあれば True
+        self.latency: Optional[float] = None # 配信開始から送信完了までの秒数
+
+    @property
+    def nonce(self) -> str:
+        """サーバーと日付から決まる nonce。再送時に Discord 側で重複投稿として弾かれる"""
+        return hashlib.blake2b(f"{self.guild.id}:{self.local_date.isoformat()}".encode(), digest_size=8).hexdigest()
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """昇順ソート済みの値から q (0-100) パーセンタイルを返す (最近傍法)"""
+    index = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+class AnnouncementDispatcher:
+    """誕生日通知を並行数とレート制限の範囲内で並行送信するクラス
+
+    429 や 5xx などの一時的なエラーは指数バックオフ (429 は retry_after 優先) で再試行し、
+    1回の配信ごとに送信遅延の分布をログに出力する。
+    """
+
+    def __init__(self, max_concurrency: int = ANNOUNCE_MAX_CONCURRENCY):
+        self.pending = 0 # 送信待ち・送信中の通知数
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._global_limiter = RateLimiter(*ANNOUNCE_GLOBAL_RATE)
+        self._channel_limiters: dict[int, RateLimiter] = {}
 
-        for setting in settings:
-            guild_id = setting['guild_id']
-            if guild_id in processed_guilds:
+    def _channel_limiter(self, channel_id: int) -> RateLimiter:
+        limiter = self._channel_limiters.get(channel_id)
+        if limiter is None:
+            limiter = self._channel_limiters[channel_id] = RateLimiter(*ANNOUNCE_CHANNEL_RATE)
+        return limiter
+
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+        """再試行すべきエラーなら待機秒数を、そうでなければ None を返す"""
+        backoff = ANNOUNCE_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.8, 1.2)
+        if isinstance(error, discord.RateLimited):
+            return error.retry_after
+        if isinstance(error, discord.Forbidden):
+            return None
+        if isinstance(error, discord.HTTPException):
+            if error.status == 429:
+                retry_after = error.response.headers.get('Retry-After') if error.response is not None else None
+                return float(retry_after) if retry_after else backoff
+            return backoff if error.status >= 500 else None
+        if isinstance(error, (asyncio.TimeoutError, OSError)):
+            return backoff
+        return None
+
+    @staticmethod
+    def _may_have_posted(error: Exception) -> bool:
+        """応答を受け取れなかった・サーバー側のエラーなど、失敗しても投稿された可能性があるエラーなら True"""
+        if isinstance(error, discord.HTTPException):
+            return error.status >= 500
+        return isinstance(error, (asyncio.TimeoutError, OSError))
+
+    @staticmethod
+    def _send_result(error: Exception) -> str:
+        """送信エラーをメトリクスのラベルに分類する"""
+        if isinstance(error, discord.Forbidden):
+            return 'forbidden'
+        if isinstance(error, discord.RateLimited) or (isinstance(error, discord.HTTPException) and error.status == 429):
+            return 'rate_limited'
+        if isinstance(error, discord.HTTPException):
+            return 'http_5xx' if error.status >= 500 else 'http_4xx'
+        if isinstance(error, asyncio.TimeoutError):
+            return 'timeout'
+        return 'network_error' if isinstance(error, OSError) else 'error'
+
+    async def _send(self, announcement: Announcement, started_at: float, on_attempt, on_sent):
+        self.pending += 1
+        try:
+            await self._send_with_retry(announcement, started_at, on_attempt)
+            if announcement.sent and on_sent is not None:
+                await on_sent(announcement)
+        finally:
+            self.pending -= 1
+
+    async def _send_with_retry(self, announcement: Announcement, started_at: float, on_attempt):
+        guild, channel = announcement.guild, announcement.channel
+        async with self._semaphore:
+            for attempt in range(ANNOUNCE_MAX_RETRIES + 1):
+                await self._global_limiter.acquire()
+                if not leader_lease.is_leader:
+                    # 権利を失った後に送ると、引き継いだリーダーと二重に送ってしまう
+                    logger.warning(f"...リーダー権を失ったため、サーバー {guild.name} への通知を送信しません。")
+                    return
+                await self._channel_limiter(channel.id).acquire()
+                if attempt == 0 and on_attempt is not None and not await on_attempt(announcement):
+                    return
+                send_started_at = time.perf_counter()
+                try:
+                    await channel.send(announcement.message, nonce=announcement.nonce)
+                    CHANNEL_SEND_SECONDS.observe(time.perf_counter() - send_started_at)
+                    CHANNEL_SENDS.inc('ok')
+                    announcement.sent = True
+                    announcement.latency = time.monotonic() - started_at
+                    logger.info(f"...サーバー {guild.name} のチャンネル {channel.name} に誕生日通知を送信しました。")
+                    return
+                except Exception as e:
+                    CHANNEL_SEND_SECONDS.observe(time.perf_counter() - send_started_at)
+                    CHANNEL_SENDS.inc(self._send_result(e))
+                    announcement.maybe_sent = announcement.maybe_sent or self._may_have_posted(e)
+                    delay = self._retry_delay(e, attempt)
+                    if delay is None or attempt == ANNOUNCE_MAX_RETRIES:
+                        announcement.retryable = delay is not None
+                        if isinstance(e, discord.Forbidden):
+                            logger.error(f"...チャンネル {channel.name} への送信権限がありません。")
+                        elif isinstance(e, discord.HTTPException):
+                            logger.error(f"...通知送信中にHTTPエラー: {e}")
+                        else:
+                            logger.error(f"...通知送信中に予期せぬエラー: {e}")
+                        return
+                    logger.warning(f"...サーバー {guild.name} への通知送信に失敗しました。{delay:.1f}秒後に再試行します ({attempt + 1}/{ANNOUNCE_MAX_RETRIES}): {e}")
+                    await asyncio.sleep(delay)
+
+    async def deliver(self, announcements: List[Announcement], on_attempt=None, on_sent=None):
+        """通知をまとめて並行送信し、送信遅延の分布をログに出力する
+
+        on_attempt(announcement) は最初の送信の直前に呼ばれ、False を返すとその通知は送信しない。
+        on_sent(announcement) は送信に成功した直後に呼ばれる (どちらも await 可能な関数)。
+        """
+        started_at = time.monotonic()
+        try:
+            await asyncio.gather(*(self._send(announcement, started_at, on_attempt, on_sent) for announcement in announcements))
+        finally:
+            self._channel_limiters.clear()
+        latencies = sorted(a.latency for a in announcements if a.latency is not None)
+        failed = len(announcements) - len(latencies)
+        if latencies:
+            logger.info(
+                f"誕生日通知配信: {len(announcements)} 件 (成功 {len(latencies)}, 失敗 {failed}), "
+                f"送信遅延 p50={percentile(latencies, 50):.2f}s p90={percentile(latencies, 90):.2f}s "
+                f"p99={percentile(latencies, 99):.2f}s max={latencies[-1]:.2f}s")
+        else:
+            logger.warning(f"誕生日通知配信: {len(announcements)} 件すべての送信に失敗しました。")
+
+announcement_dispatcher = AnnouncementDispatcher()
+metrics.Gauge('birthday_bot_announce_pending', '送信待ち・送信中の誕生日通知数', function=lambda: announcement_dispatcher.pending)
+
+SQLITE_MAX_IN_PARAMS = 500 # IN 句に渡すパラメータ数の上限 (古いSQLiteの上限999より小さく)
+
+def chunked(items: List[int], size: int = SQLITE_MAX_IN_PARAMS):
+    """リストを size 件ずつに分割して返すジェネレータ"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def utc_timestamp(delta: datetime.timedelta = datetime.timedelta()) -> str:
+    return (datetime.datetime.now(datetime.timezone.utc) + delta).strftime('%Y-%m-%d %H:%M:%S')
+
+# 通知台帳の状態:
+#   claimed: リーダーが通知権を取得した (まだ送信していない)
+#   sending: 送信を始めた (updated_at は最初の送信の直前の時刻)
+#   sent: 送信済み / failed: 投稿されずに失敗した (再試行できる)
+#   unknown: 投稿されたか確認できない (二重投稿を避けるため再送しない)
+def claim_announcements(conn: sqlite3.Connection, keys: List[tuple[int, str]], lease_token: int) -> List[tuple[int, str]]:
+    """(guild_id, ローカル日付) の通知権を台帳上で取得し、取得できたものを返す
+
+    未記録・失敗済みのもの、以前のリーダー (再起動前のこのプロセスを含む) が取得したまま停止したものを取得できる。
+    以前のリーダーが送信を始めていたものは、nonce で重複が弾かれる期間 (ANNOUNCE_NONCE_WINDOW) 内に限って取得し、
+    それより古いものは unknown にして送信しない。送信済みや、このリーダー・より新しいリーダーが取得したものは取得できない。
+    """
+    now = utc_timestamp()
+    nonce_expired_before = utc_timestamp(-ANNOUNCE_NONCE_WINDOW)
+    claimed = []
+    for guild_id, local_date in keys:
+        cursor = conn.execute(
+            """
+            UPDATE announce_ledger SET status = 'unknown', updated_at = ?
+            WHERE guild_id = ? AND local_date = ? AND status = 'sending' AND coalesce(lease_token, 0) < ? AND updated_at <= ?
+            """,
+            (now, guild_id, local_date, lease_token, nonce_expired_before))
+        if cursor.rowcount:
+            logger.error(f"サーバー {guild_id} の {local_date} 分の通知は送信中に中断され、投稿されたか確認できないため再送しません。")
+            continue
+        cursor = conn.execute(
+            """
+            INSERT INTO announce_ledger (guild_id, local_date, status, updated_at, lease_token) VALUES (?, ?, 'claimed', ?, ?)
+            ON CONFLICT(guild_id, local_date) DO UPDATE SET status = 'claimed', updated_at = excluded.updated_at, lease_token = excluded.lease_token
+            WHERE coalesce(announce_ledger.lease_token, 0) <= excluded.lease_token
+              AND (announce_ledger.status = 'failed'
+                   OR (announce_ledger.status IN ('claimed', 'sending') AND coalesce(announce_ledger.lease_token, 0) < excluded.lease_token))
+            """,
+            (guild_id, local_date, now, lease_token))
+        if cursor.rowcount:
+            claimed.append((guild_id, local_date))
+    return claimed
+
+def start_announcement(conn: sqlite3.Connection, guild_id: int, local_date: str, lease_token: int) -> bool:
+    """送信を始める通知を sending にし、このリーダーが通知権を持ち続けていれば True を返す"""
+    cursor = conn.execute("UPDATE announce_ledger SET status = 'sending', updated_at = ? WHERE guild_id = ? AND local_date = ? AND lease_token = ? AND status = 'claimed'",
+                          (utc_timestamp(), guild_id, local_date, lease_token))
+    return cursor.rowcount > 0
+
+def finish_announcements(conn: sqlite3.Connection, results: List[tuple[str, int, str]], lease_token: int):
+    """送信結果 (status, guild_id, ローカル日付) を台帳に記録する (新しいリーダーが引き継いだものは変更しない)"""
+    now = utc_timestamp()
+    conn.executemany("UPDATE announce_ledger SET status = ?, updated_at = ? WHERE guild_id = ? AND local_date = ? AND lease_token = ?",
+                     [(status, now, guild_id, local_date, lease_token) for status, guild_id, local_date in results])
+
+def prune_announce_ledger(conn: sqlite3.Connection, keep_days: int = 7):
+    conn.execute("DELETE FROM announce_ledger WHERE local_date < date('now', ?)", (f'-{keep_days} days',))
+
+@tasks.loop(seconds=0)
+async def birthday_announce():
+    """次の通知時刻まで待機し、通知時刻を迎えたサーバーの誕生日を確認・通知するタスク"""
+    await announce_scheduler.wait_until_due()
+    started_at = time.perf_counter()
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+    due = announce_scheduler.pop_due(now_utc)
+    if not due:
+        return
+    ANNOUNCE_GUILDS_DUE.inc(amount=len(due))
+    try:
+        await run_announce_tick(due, now_utc)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        ANNOUNCE_TICK_SECONDS.observe(elapsed)
+        if SLOW_TICK_SECONDS and elapsed >= SLOW_TICK_SECONDS:
+            logger.warning(f"遅い通知ティック: {elapsed * 1000:.0f}ms (対象サーバー: {len(due)}, 例: {reprlib.repr([guild_id for guild_id, _ in due])})")
+
+async def run_announce_tick(due: List[tuple[int, datetime.datetime]], now_utc: datetime.datetime):
+    """通知時刻を迎えた (guild_id, 通知時刻) の誕生者を取得し、通知を配信する"""
+    # 通知対象日は現在時刻ではなく本来の通知時刻から、サーバーごとのタイムゾーンで求める
+    # (日付をまたいだ取り戻しでも正しい日の誕生者を通知する)。同じタイムゾーン・同じ通知時刻の計算は1回だけ行う
+    local_dates: dict[tuple[str, datetime.datetime], datetime.date] = {}
+    targets = []
+    for guild_id, fire_at in due:
+        setting = settings_cache.peek(guild_id)
+        if setting is None:
+            continue
+        zone_key = (setting.zone_key, fire_at)
+        local_date = local_dates.get(zone_key)
+        if local_date is None:
+            local_date = local_dates[zone_key] = fire_at.astimezone(setting.tz).date()
+        targets.append((setting, fire_at, local_date))
+    ANNOUNCE_GUILDS_PROCESSED.inc(amount=len(targets))
+    logger.debug(f"誕生日通知タスク実行: {now_utc.strftime('%Y-%m-%d %H:%M')} UTC, 対象 {len(targets)} サーバー ({len(local_dates)} タイムゾーン)")
+    pending = []
+
+    for setting, fire_at, local_date in targets:
+        guild_id = setting.guild_id
+        today_local_str = local_date.strftime('%m/%d')
+        announce_channel_id = setting.announce_channel_id
+        hour_local, minute_local = setting.announce_time_local
+        time_source = "デフォルト" if setting.is_default_time else "設定"
+
+        logger.info(f"サーバー {guild_id} の通知時刻 ({hour_local:02}:{minute_local:02} {setting.zone_key}, {time_source}) になりました。誕生日チェック実行。")
+        # 誕生者はメモリ上のカレンダーから引く (DBは読まない)
+        birthdays_today = [entry for month_day in observed_month_days(local_date) for entry in birthday_calendar.lookup(guild_id, month_day)]
+        if birthdays_today:
+            guild = bot.get_guild(guild_id)
+            if not guild:
+                logger.warning(f"...サーバー (ID: {guild_id}) が見つかりません。")
+                continue
+            if not announce_channel_id:
+                logger.warning(f"...サーバー {guild.name} (ID: {guild_id}) の通知チャンネルIDが無効です。")
                 continue
-            announce_channel_id = setting['announce_channel_id']
-            announce_hour_utc = setting['announce_hour_utc']
-            announce_minute_utc = setting['announce_minute_utc']
-            message_template = setting['announce_message_template']
-
-            target_hour_utc = announce_hour_utc if announce_hour_utc is not None else DEFAULT_ANNOUNCE_HOUR_UTC
-            target_minute_utc = announce_minute_utc if announce_minute_utc is not None else DEFAULT_ANNOUNCE_MINUTE_UTC
-            time_source = "設定" if announce_hour_utc is not None else "デフォルト"
-
-            if current_hour_utc == target_hour_utc and target_minute_utc <= current_minute_utc < target_minute_utc + loop_interval_minutes:
-                logger.info(f"サーバー {guild_id} の通知時刻 ({target_hour_utc:02}:{target_minute_utc:02} UTC, {time_source}) の範囲内。誕生日チェック実行。")
-                cursor.execute( 'SELECT display_name, mention_user_id FROM birthdays WHERE birthday = ? AND guild_id = ?', (today_jst_str, guild_id) )
-                birthdays_today = cursor.fetchall()
-                if birthdays_today:
-                    guild = bot.get_guild(guild_id)
-                    if not guild:
-                        logger.warning(f"...サーバー (ID: {guild_id}) が見つかりません。")
-                        continue
-                    if not announce_channel_id:
-                        logger.warning(f"...サーバー {guild.name} (ID: {guild_id}) の通知チャンネルIDが無効です。")
-                        continue
-                    channel = guild.get_channel(announce_channel_id)
-                    if not channel:
-                        logger.warning(f"...サーバー {guild.name} の通知チャンネル (ID: {announce_channel_id}) が見つかりません。")
-                        continue
-
-                    mentions = []
-                    names_only = []
-                    for bday in birthdays_today:
-                        name = bday['display_name']
-                        mention_user_id = bday['mention_user_id']
-                        names_only.append(name)
-                        if mention_user_id:
-                            member = guild.get_member(mention_user_id)
-                            if member:
-                                mentions.append(member.mention)
-                            else:
-                                logger.warning(f"...ユーザー (ID: {mention_user_id}, 名前: {name}) が見つかりません。")
-
-                    celebrants_names = ', '.join(f"**{n}**" for n in names_only)
-                    mention_str = ' '.join(mentions) + (' ' if mentions else '')
-
-                    current_template = message_template if message_template else DEFAULT_ANNOUNCE_MESSAGE
-
-                    try:
-                        message = current_template.replace("<name>", celebrants_names)
-                        # デフォルトテンプレート用のプレースホルダーも置換
-                        message = message.format(
-                            names=celebrants_names,
-                            mentions=mention_str,
-                            today_date=today_jst_str
-                        )
-                    except KeyError as e:
-                        logger.error(f"サーバー {guild_id} のメッセージテンプレートフォーマットエラー: 不明なプレースホルダー {e}")
-                        message = DEFAULT_ANNOUNCE_MESSAGE.format(
-                            names=celebrants_names,
-                            mentions=mention_str,
-                            today_date=today_jst_str
-                        )
-
-                    try:
-                        await channel.send(message)
-                        logger.info(f"...サーバー {guild.name} のチャンネル {channel.name} に誕生日通知を送信しました。")
-                        processed_guilds.add(guild_id)
-                    except discord.Forbidden:
-                        logger.error(f"...チャンネル {channel.name} への送信権限がありません。")
-                    except discord.HTTPException as e:
-                        logger.error(f"...通知送信中にHTTPエラー: {e}")
-                    except Exception as e:
-                        logger.error(f"...通知送信中に予期せぬエラー: {e}")
+            channel = guild.get_channel(announce_channel_id)
+            if not channel:
+                logger.warning(f"...サーバー {guild.name} の通知チャンネル (ID: {announce_channel_id}) が見つかりません。")
+                continue
+            pending.append((setting, guild, channel, fire_at, local_date, birthdays_today))
+        else:
+            logger.info(f"...サーバー {guild_id} では今日 ({today_local_str}) 誕生日の人はいません。")
+
+    # メンション対象はサーバーごとに1回でまとめて解決し、サーバー間は並行に問い合わせる
+    resolved_by_guild = await asyncio.gather(*(member_resolver.resolve(guild, [entry.mention_user_id for entry in birthdays_today if entry.mention_user_id])
+                                               for _, guild, _, _, _, birthdays_today in pending))
+    announcements = []
+    for (setting, guild, channel, fire_at, local_date, birthdays_today), resolved in zip(pending, resolved_by_guild):
+        mentions = []
+        names_only = []
+        for entry in birthdays_today:
+            name = entry.name
+            mention_user_id = entry.mention_user_id
+            names_only.append(name)
+            if mention_user_id:
+                resolved_user = resolved.get(mention_user_id)
+                if resolved_user is None or resolved_user.in_guild:
+                    mentions.append(f"<@{mention_user_id}>")
                 else:
-                    logger.info(f"...サーバー {guild_id} では今日 ({today_jst_str}) 誕生日の人はいません。")
-                    processed_guilds.add(guild_id)
+                    logger.warning(f"...ユーザー (ID: {mention_user_id}, 名前: {name}) が見つかりません。")
+
+        celebrants_names = ', '.join(f"**{n}**" for n in names_only)
+        mention_str = ' '.join(mentions) + (' ' if mentions else '')
+
+        message = get_announce_template(setting.guild_id, setting.announce_message_template).render(
+            names=celebrants_names,
+            mentions=mention_str,
+            today_date=local_date.strftime('%m/%d')
+        )
+
+        announcements.append(Announcement(guild, channel, message, fire_at, local_date))
+
+    if announcements:
+        await deliver_announcements(announcements, now_utc)
+    logger.debug("誕生日通知タスクチェック完了。")
+
+def schedule_announce_retry(guild_id: int, fire_at: datetime.datetime, now_utc: datetime.datetime):
+    """取り戻し猶予時間内であれば、fire_at 分の通知を一定時間後に再試行する"""
+    wake_at = now_utc + ANNOUNCE_RETRY_INTERVAL
+    if wake_at - fire_at < ANNOUNCE_CATCHUP_WINDOW:
+        announce_scheduler.schedule_retry(guild_id, fire_at, wake_at)
+    else:
+        logger.error(f"サーバー {guild_id} の {fire_at.isoformat()} 分の通知は取り戻し猶予時間を過ぎたため再試行しません。")
+
+async def deliver_announcements(announcements: List[Announcement], now_utc: datetime.datetime):
+    """台帳で通知権を取得できたものだけを送信し、結果を台帳に記録する"""
+    # 同じティックに同じサーバー・同じ日の通知が重複して入った場合 (再試行と通常分など) は1件にまとめる
+    announcements = list({(a.guild.id, a.local_date): a for a in announcements}.values())
+    if not leader_lease.is_leader:
+        logger.warning(f"リーダー権を失ったため、{len(announcements)} 件の通知を引き継いだリーダーに任せます。")
+        return
+    lease_token = leader_lease.token
+    keys = [(a.guild.id, a.local_date.isoformat()) for a in announcements]
+    try:
+        claimed = set(await db.write(claim_announcements, keys, lease_token))
     except sqlite3.Error as e:
-        logger.error(f"誕生日通知タスク中にデータベースエラーが発生しました: {e}")
-    finally:
-        if conn:
-            conn.close()
-        logger.debug("誕生日通知タスクチェック完了。")
+        logger.error(f"通知台帳の更新に失敗しました。二重投稿を避けるため送信を延期します: {e}")
+        for a in announcements:
+            schedule_announce_retry(a.guild.id, a.fire_at, now_utc)
+        return
+    skipped = len(announcements) - len(claimed)
+    if skipped:
+        logger.info(f"...{skipped} サーバーは送信済み、または送信中のためスキップしました。")
+    announcements = [a for a, key in zip(announcements, keys) if key in claimed]
+    if not announcements:
+        return
+
+    # 送信の直前に sending、成功した直後に sent を記録する (他の書き込みとまとめてコミットする)。
+    # 配信の途中で停止しても、送信済みの通知は再送されず、送信中だった通知だけが nonce の有効期間内に再送される
+    started: set[tuple[int, str]] = set()
+    recorded: set[tuple[int, str]] = set()
+
+    async def on_attempt(a: Announcement) -> bool:
+        key = (a.guild.id, a.local_date.isoformat())
+        try:
+            if not await db.write_batched(start_announcement, *key, lease_token):
+                logger.warning(f"...サーバー {a.guild.name} の通知は他のリーダーが引き継いだため送信しません。")
+                return False
+        except sqlite3.Error as e:
+            logger.error(f"通知台帳の更新に失敗しました。二重投稿を避けるため送信を延期します: {e}")
+            a.retryable = True
+            return False
+        started.add(key)
+        return True
+
+    async def on_sent(a: Announcement):
+        key = (a.guild.id, a.local_date.isoformat())
+        try:
+            await db.write_batched(finish_announcements, [('sent', *key)], lease_token)
+            recorded.add(key)
+        except sqlite3.Error as e:
+            logger.error(f"通知台帳への送信結果の記録に失敗しました: {e}")
+
+    await announcement_dispatcher.deliver(announcements, on_attempt, on_sent)
+
+    results = []
+    for a in announcements:
+        key = (a.guild.id, a.local_date.isoformat())
+        if a.sent:
+            if key not in recorded:
+                results.append(('sent', *key))
+        elif key in started and a.maybe_sent:
+            # 再試行の時点では nonce による重複防止が切れているため、投稿された可能性があるものは再送しない
+            logger.error(f"...サーバー {a.guild.name} の通知は投稿されたか確認できないため再送しません。")
+            results.append(('unknown', *key))
+        else:
+            results.append(('failed', *key))
+            if a.retryable:
+                schedule_announce_retry(a.guild.id, a.fire_at, now_utc)
+    if not results:
+        return
+    try:
+        await db.write(finish_announcements, results, lease_token)
+    except sqlite3.Error as e:
+        # 記録できなかった行は sending のまま残り、nonce の有効期間内なら次のリーダーが再送し、過ぎていれば unknown になる
+        logger.error(f"通知台帳への送信結果の記録に失敗しました: {e}")
 
 @birthday_announce.before_loop
 async def before_birthday_announce():
     await bot.wait_until_ready()
+    try:
+        await db.write(prune_announce_ledger)
+    except sqlite3.Error as e:
+        logger.warning(f"古い通知台帳の削除に失敗しました: {e}")
+    await reconcile_guild_membership()
     logger.info("誕生日通知タスクの準備完了。ループを開始します。")
 
 # --- Bot実行 ---
@@ -700,3 +3131,6 @@ if __name__ == '__main__':
         logger.critical("Botトークンが無効です。 .env ファイルを確認してください。")
     except Exception as e:
         logger.critical(f"Bot実行中に致命的なエラーが発生しました: {e}")
+    finally:
+        leader_lease.release_now()
+        db.close()
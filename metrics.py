@@ -0,0 +1,226 @@
+"""誕生日Botの軽量メトリクス (カウンター・ゲージ・ヒストグラム) と Prometheus 形式での出力
+
+記録は系列ごとの数値の加算だけで済むようにし、ホットパス (DB処理・送信・コマンド) への影響を小さくする。
+DB のワーカースレッドからも記録されるため、各メトリクスは小さなロックで更新を保護する。
+"""
+import bisect
+import math
+import threading
+from typing import Callable, Iterable, List, Optional
+
+# 秒単位の処理時間向けの既定バケット (1ms 〜 30s)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Registry:
+    """メトリクスの一覧を保持し、Prometheus のテキスト形式に変換するクラス"""
+
+    def __init__(self):
+        self._metrics: List['Metric'] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: 'Metric'):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"メトリクス名が重複しています: {metric.name}")
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class Metric:
+    """ラベルの値の組ごとに系列を持つメトリクスの基底クラス"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: tuple) -> tuple:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} のラベルは {self.labelnames} です (指定: {labels})")
+        return tuple(map(str, labels))
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    """増加のみするカウンター"""
+
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *prefix) -> float:
+        """ラベルの先頭が prefix に一致する系列の合計を返す (prefix を省略すると全系列の合計)"""
+        prefix = tuple(str(value) for value in prefix)
+        with self._lock:
+            return sum(value for key, value in self._values.items() if key[:len(prefix)] == prefix)
+
+    def series(self) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in sorted(self.series().items())]
+
+class Gauge(Metric):
+    """増減する値。function を渡すと、出力時にその戻り値を読む (ラベルなしのみ)"""
+
+    type = 'gauge'
+
+    def __init__(self, *args, function: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if function is not None and self.labelnames:
+            raise ValueError("function を使うゲージにはラベルを付けられません。")
+        self._function = function
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount: float = 1.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, *labels, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels) -> float:
+        if self._function is not None:
+            return float(self._function())
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def series(self) -> dict[tuple, float]:
+        if self._function is not None:
+            return {(): self.value()}
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in sorted(self.series().items())]
+
+class Histogram(Metric):
+    """値の分布をバケットごとの件数・合計・件数で保持するヒストグラム"""
+
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Iterable[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {} # ラベル -> [バケットごとの件数 (+Inf を含む), 合計, 件数]
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _merged(self, prefix: tuple) -> tuple[List[int], float, int]:
+        prefix = tuple(str(value) for value in prefix)
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        number = 0
+        with self._lock:
+            for key, (bucket_counts, series_sum, series_count) in self._series.items():
+                if key[:len(prefix)] != prefix:
+                    continue
+                for index, count in enumerate(bucket_counts):
+                    counts[index] += count
+                total += series_sum
+                number += series_count
+        return counts, total, number
+
+    def count(self, *prefix) -> int:
+        """ラベルの先頭が prefix に一致する系列の観測件数の合計"""
+        return self._merged(prefix)[2]
+
+    def quantile(self, q: float, *prefix) -> Optional[float]:
+        """バケット内を線形補間して q 分位点を推定する (Prometheus の histogram_quantile と同じ考え方)"""
+        counts, _, number = self._merged(prefix)
+        if number == 0:
+            return None
+        rank = q * number
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1] # +Inf バケットは上限が分からないため最後の境界を返す
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def label_values(self) -> List[tuple]:
+        with self._lock:
+            return sorted(self._series)
+
+    def render(self) -> List[str]:
+        lines = []
+        with self._lock:
+            snapshot = {key: (list(counts), total, number) for key, (counts, total, number) in self._series.items()}
+        for key, (counts, total, number) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {number}")
+        return lines
+
+async def start_http_server(host: str, port: int, registry: Registry = REGISTRY):
+    """GET /metrics で Prometheus 形式のメトリクスを返す HTTP サーバーを起動し、AppRunner を返す"""
+    from aiohttp import web # discord.py の依存ライブラリ
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
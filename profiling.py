@@ -0,0 +1,92 @@
+"""誕生日Botの時間指定プロファイル取得 (cProfile / tracemalloc)
+
+運用者が指定した秒数だけプロファイラを有効にし、結果をファイルに保存する。
+取得していない間はプロファイラを一切有効にしないため、通常時の処理には影響しない。
+スナップショットの比較や結果のファイル保存は別スレッドで行い、ヒープが大きくてもイベントループを止めない。
+"""
+import asyncio
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import tracemalloc
+from typing import Optional
+
+PROFILE_TOP_LINES = 25 # 要約テキストに含める上位の行数
+TRACEMALLOC_FRAMES = 10 # tracemalloc で記録するスタックの深さ
+
+class ProfileCapture:
+    """1度に1つだけ、時間を区切ってプロファイルを取得するクラス
+
+    cpu: イベントループのスレッド上の関数呼び出しを cProfile で記録する (DB ワーカースレッドは対象外)。
+    memory: tracemalloc で取得期間中に増えたメモリ確保を割り当て元ごとに記録する。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.running_mode: Optional[str] = None
+
+    async def capture(self, mode: str, seconds: float) -> tuple[str, str]:
+        """プロファイルを seconds 秒取得して保存し、(保存したファイルのパス, 要約テキスト) を返す"""
+        if self.running_mode is not None:
+            raise RuntimeError(f"プロファイル ({self.running_mode}) を取得中です。")
+        if mode not in ('cpu', 'memory'):
+            raise ValueError(f"不明なプロファイルの種類です: {mode}")
+        self.running_mode = mode
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            basename = os.path.join(self.directory, f"{mode}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}")
+            if mode == 'cpu':
+                return await self._capture_cpu(basename, seconds)
+            return await self._capture_memory(basename, seconds)
+        finally:
+            self.running_mode = None
+
+    @staticmethod
+    async def _capture_cpu(basename: str, seconds: float) -> tuple[str, str]:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        return await asyncio.to_thread(ProfileCapture._save_cpu, profiler, basename)
+
+    @staticmethod
+    def _save_cpu(profiler: cProfile.Profile, basename: str) -> tuple[str, str]:
+        path = basename + '.prof' # python -m pstats や snakeviz で開ける
+        profiler.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP_LINES)
+        summary = output.getvalue()
+        with open(basename + '.txt', 'w', encoding='utf-8') as f:
+            f.write(summary)
+        return path, summary
+
+    @staticmethod
+    async def _capture_memory(basename: str, seconds: float) -> tuple[str, str]:
+        # 他で tracemalloc が有効になっている場合はそのまま使い、止めない
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            before = await asyncio.to_thread(tracemalloc.take_snapshot)
+            await asyncio.sleep(seconds)
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+        return await asyncio.to_thread(ProfileCapture._save_memory, before, after, current, peak, basename)
+
+    @staticmethod
+    def _save_memory(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, current: int, peak: int, basename: str) -> tuple[str, str]:
+        path = basename + '.tracemalloc' # tracemalloc.Snapshot.load() で読み込める
+        after.dump(path)
+        lines = [f"追跡中のメモリ: {current / 1024 / 1024:.1f}MiB (ピーク {peak / 1024 / 1024:.1f}MiB)", "取得期間中の増加 (割り当て元ごと):"]
+        lines.extend(str(stat) for stat in after.compare_to(before, 'lineno')[:PROFILE_TOP_LINES])
+        summary = '\n'.join(lines) + '\n'
+        with open(basename + '.txt', 'w', encoding='utf-8') as f:
+            f.write(summary)
+        return path, summary